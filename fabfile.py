@@ -30,9 +30,15 @@ import time
 from io import BytesIO
 from zipfile import ZipFile, ZIP_DEFLATED
 import os
-from datetime import datetime
 import yaml
-from hashlib import md5
+from hashlib import md5, sha256
+from threading import Thread, Lock
+from local_execution.dynamodb import LocalDynamoDB
+from local_execution.s3 import LocalS3, populate_bucket
+from local_execution.s3control import LocalS3Control
+from local_execution.state_machine import LocalLambdaContext, LocalStateMachine, MAX_PAYLOAD_SIZE, load_lambda_module
+from local_execution.sync_engine import sync_buckets
+from local_execution.tuning import tune_function
 
 # Constants
 
@@ -45,12 +51,18 @@ for c in CONSTANTS_TO_ENVIRONMENT:
     if c in globals():
         os.environ[c] = globals()[c]
 
-SLEEP_TIME = 5  # seconds
+MIN_SLEEP_TIME = 1  # seconds
+MAX_SLEEP_TIME = 10  # seconds
+SLEEP_TIME_FACTOR = 1.5  # Multiply the time to sleep by this after each unsuccessful poll.
+
+# IAM
+IAM_POLICY_ARN_CACHE_FILE = '.iam_policy_arn_cache.json'
 
 # Lambda
 LAMBDA_FUNCTION_DEPLOYMENT_BUCKET = USER_HASH + '-' + AWS_DEFAULT_REGION + '-ld'
 LAMBDA_FUNCTION_CODE_URI_PREFIX = 's3://' + LAMBDA_FUNCTION_DEPLOYMENT_BUCKET + '/'
 LAMBDA_FUNCTION_DIRECTORY = 'lambda_functions'
+LAMBDA_FUNCTION_SHARED_DIRECTORY = os.path.join(LAMBDA_FUNCTION_DIRECTORY, 'shared')  # Added to every package.
 LAMBDA_DEFAULT_RUNTIME = 'python2.7'
 LAMBDA_DEFAULT_DESCRIPTION = 'An AWS Lambda function.'
 LAMBDA_DEFAULT_MEMORY_SIZE = 128  # MB
@@ -63,6 +75,9 @@ LAMBDA_DEFAULT_PARAMETERS = {
     'Timeout': LAMBDA_DEFAULT_TIMEOUT,
     'Policies': [LAMBDA_DEFAULT_POLICY],
 }
+LAMBDA_OPTIONAL_PARAMETERS = ['Environment']  # Passed on to CloudFormation if a function has them.
+LAMBDA_TUNING_FILE = 'lambda_tuning.json'  # Settings recommended by `fab tune`, they override the front matter.
+LAMBDA_TUNED_PARAMETERS = ['MemorySize', 'Environment']
 
 
 # Step Functions
@@ -85,6 +100,17 @@ STATE_MACHINE_ROLE_POSTFIX = 'Role'
 STATE_MACHINE_TRUSTED_ENTITY = 'states.' + AWS_DEFAULT_REGION + '.amazonaws.com'
 STATE_MACHINE_DEFAULT_POLICIES = ['AWSLambdaRole']
 
+# The fan-out variant of a state machine lists ahead with FAN_OUT_PLANNER and runs the FAN_OUT_WORKERS on batches of
+# keys in a Distributed Map state, see generate_fan_out_state_machine_definition().
+STATE_MACHINE_FAN_OUT_POSTFIX = 'FanOut'
+FAN_OUT_LISTER = 'list_bucket'
+FAN_OUT_WORKERS = ['copy_keys', 'delete_orphaned_keys']
+FAN_OUT_PLANNER = 'plan_batches'
+FAN_OUT_PLANNER_TIMEOUT = 305  # seconds, the Lambda function has 300.
+FAN_OUT_AGGREGATOR = 'aggregate_batch_results'
+FAN_OUT_AGGREGATOR_TIMEOUT = 20  # seconds, the Lambda function has 15.
+FAN_OUT_MAX_PAYLOAD_SIZE = 262144  # Characters, Distributed Map state machines are held to the current limit.
+
 
 # CloudFormation
 
@@ -133,6 +159,39 @@ CFN_TEMPLATE_OUTPUT = {
     }
 }
 
+CFN_TEMPLATE_CONTINUATION_ROLE_POLICY = {  # Long syncs continue in a new execution of the same state machine.
+    'PolicyName': 'StartContinuation',
+    'PolicyDocument': {
+        'Version': '2012-10-17',
+        'Statement': [
+            {
+                'Effect': 'Allow',
+                'Action': ['states:StartExecution'],
+                'Resource': '*'
+            }
+        ]
+    }
+}
+
+CFN_TEMPLATE_FAN_OUT_ROLE_POLICY = {  # Distributed Map states start child executions and read their items from S3.
+    'PolicyName': 'DistributedMap',
+    'PolicyDocument': {
+        'Version': '2012-10-17',
+        'Statement': [
+            {
+                'Effect': 'Allow',
+                'Action': ['states:StartExecution', 'states:DescribeExecution', 'states:StopExecution'],
+                'Resource': '*'
+            },
+            {
+                'Effect': 'Allow',
+                'Action': ['s3:GetObject'],
+                'Resource': '*'
+            }
+        ]
+    }
+}
+
 CFN_TEMPLATE_STATE_MACHINE = {
    'Type': 'AWS::StepFunctions::StateMachine',
    'Properties': {
@@ -150,6 +209,10 @@ logger.setLevel(logging.WARNING)
 
 lambda_functions = {}
 state_machines = {}
+account_id = None
+policy_arns = None  # Per AWS account: {account_id: {policy_name: policy_arn}}, see get_arn_from_policy_name().
+policy_arns_lock = Lock()
+phase_timings = []
 
 
 # Functions
@@ -177,6 +240,50 @@ def to_camel_case(s):
     return ''.join([i[0].upper() + i[1:].lower() for i in components])
 
 
+def backoff_sleep_times():
+    # Yields increasing times to sleep between polls: Fast for quick operations, but not too chatty for slow ones.
+    sleep_time = MIN_SLEEP_TIME
+    while True:
+        yield sleep_time
+        sleep_time = min(sleep_time * SLEEP_TIME_FACTOR, MAX_SLEEP_TIME)
+
+
+def timed(phase, function, *args):
+    start = time.time()
+    try:
+        return function(*args)
+    finally:
+        phase_timings.append((phase, time.time() - start))
+
+
+def print_phase_timings():
+    print('Phase timings:')
+    for phase, seconds in phase_timings:
+        print('    {0}: {1:.1f}s'.format(phase, seconds))
+
+
+def run_in_parallel(function, args_list):
+    # Run function once per args tuple in its own thread. Returns the results in order, re-raises the first error.
+    results = [None] * len(args_list)
+    errors = []
+
+    def run(i, args):
+        try:
+            results[i] = function(*args)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=run, args=(i, args)) for i, args in enumerate(args_list)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+    return results
+
+
 # S3
 
 def check_bucket(bucket):
@@ -199,8 +306,9 @@ def check_bucket(bucket):
         waiter.wait(Bucket=bucket)
 
 
-def upload_object_to_s3(bucket, key, o):
-    s3 = boto3.client('s3', region_name=AWS_DEFAULT_REGION)
+def upload_object_to_s3(bucket, key, o, s3=None):
+    if s3 is None:
+        s3 = boto3.client('s3', region_name=AWS_DEFAULT_REGION)
 
     s3.put_object(
         Bucket=bucket,
@@ -209,38 +317,72 @@ def upload_object_to_s3(bucket, key, o):
     )
 
 
-def get_timestamp_from_s3_object(bucket, key):
-    s3 = boto3.client('s3', region_name=AWS_DEFAULT_REGION)
+def s3_object_exists(bucket, key, s3=None):
+    if s3 is None:
+        s3 = boto3.client('s3', region_name=AWS_DEFAULT_REGION)
 
     try:
-        response = s3.get_object(
-            Bucket=bucket,
-            Key=key
-        )
-        timestamp = response['LastModified']  # We assume this is UTC.
-    except ClientError:
-        timestamp = datetime(1970, 1, 1, tzinfo=None)
-
-    return (timestamp.replace(tzinfo=None) - datetime(1970, 1, 1, tzinfo=None)).total_seconds()
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if int(e.response['Error']['Code']) == 404:
+            return False
+        raise e
 
 
 # IAM
 
+def get_account_id():
+    global account_id
+
+    if account_id is None:
+        account_id = boto3.client('sts', region_name=AWS_DEFAULT_REGION).get_caller_identity()['Account']
+
+    return account_id
+
+
+def load_policy_arns():
+    global policy_arns
+
+    if policy_arns is None:
+        policy_arns = {}
+        if os.path.exists(IAM_POLICY_ARN_CACHE_FILE):
+            with open(IAM_POLICY_ARN_CACHE_FILE) as f:
+                policy_arns = json.load(f)
+
+    return policy_arns
+
+
+def save_policy_arns():
+    with open(IAM_POLICY_ARN_CACHE_FILE, 'w') as f:
+        f.write(dict_to_normalized_json(policy_arns))
+
+
 def get_arn_from_policy_name(policy_name):
-    iam = boto3.client('iam', region_name=AWS_DEFAULT_REGION)
+    # Listing all policies takes a while, so we remember every policy we've seen, in memory and on disk.
+    with policy_arns_lock:
+        account_policy_arns = load_policy_arns().setdefault(get_account_id(), {})
+        if policy_name in account_policy_arns:
+            return account_policy_arns[policy_name]
 
-    args = {
-        'Scope': 'All'
-    }
-    while True:
-        response = iam.list_policies(**args)
-        for p in response['Policies']:
-            if p['PolicyName'] == policy_name:
-                return p['Arn']
-        if response['IsTruncated']:
-            args['Marker'] = response['Marker']
-        else:
-            return None
+        iam = boto3.client('iam', region_name=AWS_DEFAULT_REGION)
+
+        args = {
+            'Scope': 'All'
+        }
+        try:
+            while True:
+                response = iam.list_policies(**args)
+                for p in response['Policies']:
+                    account_policy_arns[p['PolicyName']] = p['Arn']
+                if policy_name in account_policy_arns:
+                    return account_policy_arns[policy_name]
+                if response['IsTruncated']:
+                    args['Marker'] = response['Marker']
+                else:
+                    return None
+        finally:
+            save_policy_arns()
 
 
 # Lambda
@@ -279,23 +421,84 @@ def populate_lambda_functions_dict():
             yaml_dict = yaml.load(''.join(yaml_lines))
             lambda_function_parameters.update(yaml_dict)
 
+        # Variants are functions of their own with the same package, and parameters that differ, e.g. more memory.
+        variants = lambda_function_parameters.pop('Variants', None) or {}
         lambda_functions[lambda_function_name] = lambda_function_parameters
+        for variant_name, variant_parameters in variants.items():
+            parameters = json.loads(json.dumps(lambda_function_parameters))
+            parameters.update(variant_parameters)
+            parameters['Source'] = lambda_function_name
+            lambda_functions[variant_name] = parameters
 
+    for lambda_function_name, tuned_parameters in load_lambda_tuning().items():
+        if lambda_function_name in lambda_functions:
+            lambda_functions[lambda_function_name].update(
+                (k, v) for k, v in tuned_parameters.items() if k in LAMBDA_TUNED_PARAMETERS
+            )
 
-def generate_code_uri_for_lambda_function(lambda_function_name):
-    return LAMBDA_FUNCTION_CODE_URI_PREFIX + lambda_function_name + '_' + str(int(time.time())) + '.zip'
 
+def load_lambda_tuning():
+    if not os.path.exists(LAMBDA_TUNING_FILE):
+        return {}
+    with open(LAMBDA_TUNING_FILE) as f:
+        return json.load(f)
 
-def find_latest_code_uri_for_lambda_function(lambda_function_name):
-    s3 = boto3.client('s3', region_name=AWS_DEFAULT_REGION)
 
-    response = s3.list_objects_v2(Bucket=LAMBDA_FUNCTION_DEPLOYMENT_BUCKET, Prefix=lambda_function_name + '_')
-    if response['KeyCount'] == 0:
-        return None
-    else:
-        sorted_result = sorted(response['Contents'], key=lambda k: k['LastModified'])
-        latest_key = sorted_result[-1]['Key']
-        return LAMBDA_FUNCTION_CODE_URI_PREFIX + latest_key
+def save_lambda_tuning(lambda_function_name, parameters):
+    # Keeps the settings of the other functions.
+    tuning = load_lambda_tuning()
+    tuning[lambda_function_name] = parameters
+    with open(LAMBDA_TUNING_FILE, 'w') as f:
+        f.write(dict_to_normalized_json(tuning))
+
+
+def get_lambda_function_source(lambda_function_name):
+    # The name of the file a Lambda function comes from, without '.py'.
+    return lambda_functions.get(lambda_function_name, {}).get('Source', lambda_function_name)
+
+
+def get_lambda_function_handler(lambda_function_name):
+    return lambda_functions.get(lambda_function_name, {}).get(
+        'Handler', get_lambda_function_source(lambda_function_name) + '.handler'
+    )
+
+
+def get_lambda_function_package_files(lambda_function_name):
+    # Returns a list of (path, name in ZIP archive) tuples for everything that goes into the deployment package.
+    lambda_function_file_name = get_lambda_function_source(lambda_function_name) + '.py'
+    result = [(os.path.join(LAMBDA_FUNCTION_DIRECTORY, lambda_function_file_name), lambda_function_file_name)]
+
+    if os.path.exists(LAMBDA_FUNCTION_SHARED_DIRECTORY):
+        shared_package_name = os.path.basename(LAMBDA_FUNCTION_SHARED_DIRECTORY)
+        for file_name in sorted(os.listdir(LAMBDA_FUNCTION_SHARED_DIRECTORY)):
+            if file_name.endswith('.py'):
+                result.append((
+                    os.path.join(LAMBDA_FUNCTION_SHARED_DIRECTORY, file_name),
+                    shared_package_name + '/' + file_name
+                ))
+
+    return result
+
+
+def get_lambda_function_code_hash(lambda_function_name):
+    code_hash = sha256()
+    for path, name in get_lambda_function_package_files(lambda_function_name):
+        code_hash.update(name + '\0')
+        with open(path, 'rb') as f:
+            code_hash.update(f.read())
+        code_hash.update('\0')
+
+    return code_hash.hexdigest()
+
+
+def generate_code_key_for_lambda_function(lambda_function_name):
+    # Packages are addressed by the hash of their contents, so unchanged code never needs to be uploaded twice.
+    lambda_function_source = get_lambda_function_source(lambda_function_name)  # Variants share the package.
+    return lambda_function_source + '_' + get_lambda_function_code_hash(lambda_function_source) + '.zip'
+
+
+def generate_code_uri_for_lambda_function(lambda_function_name):
+    return LAMBDA_FUNCTION_CODE_URI_PREFIX + generate_code_key_for_lambda_function(lambda_function_name)
 
 
 def generate_lambda_function_cfn_template(lambda_function_name):
@@ -304,14 +507,14 @@ def generate_lambda_function_cfn_template(lambda_function_name):
     properties = lambda_function_template['Properties']
     lambda_function_definition = lambda_functions[lambda_function_name]
 
-    handler = lambda_function_name + '.handler'
+    handler = get_lambda_function_handler(lambda_function_name)
     properties['Handler'] = handler
 
-    code_uri = find_latest_code_uri_for_lambda_function(lambda_function_name)
+    code_uri = generate_code_uri_for_lambda_function(lambda_function_name)
     properties['CodeUri'] = code_uri
 
     # Overwrite the CloudFormation properties with selected properties from the function definition.
-    for key in LAMBDA_DEFAULT_PARAMETERS.keys():
+    for key in LAMBDA_DEFAULT_PARAMETERS.keys() + LAMBDA_OPTIONAL_PARAMETERS:
         if key in lambda_function_definition and lambda_function_definition[key] is not None:
             properties[key] = lambda_function_definition[key]
 
@@ -340,10 +543,10 @@ def create_lambda_deployment_package(lambda_function_name):
 
     zip_file = BytesIO()
 
-    lambda_function_file_name = lambda_function_name + '.py'
     with ZipFile(zip_file, 'w', ZIP_DEFLATED) as z:
-        print('Adding: ' + lambda_function_file_name + ' to ZIP archive.')
-        z.write(os.path.join(LAMBDA_FUNCTION_DIRECTORY, lambda_function_file_name), lambda_function_file_name)
+        for path, name in get_lambda_function_package_files(lambda_function_name):
+            print('Adding: ' + name + ' to ZIP archive.')
+            z.write(path, name)
 
     return zip_file.getvalue()
 
@@ -361,30 +564,22 @@ def get_lambda_function_info(lambda_function_name):
     return response
 
 
-def update_lambda_function_package(lambda_function_name):
-    lambda_function_path = os.path.join(LAMBDA_FUNCTION_DIRECTORY, lambda_function_name + '.py')
-    latest_code_uri = find_latest_code_uri_for_lambda_function(lambda_function_name)
-    if latest_code_uri is not None:
-        latest_code_key = latest_code_uri.split('/')[-1]
-        latest_code_uri_timestamp = get_timestamp_from_s3_object(LAMBDA_FUNCTION_DEPLOYMENT_BUCKET, latest_code_key)
-        local_code_timestamp = os.path.getmtime(lambda_function_path)
-
-        if local_code_timestamp < latest_code_uri_timestamp:
-            print('Lambda function deployment package for: ' + lambda_function_name + ' on S3 is current.')
-            return
-
-    new_code_uri = generate_code_uri_for_lambda_function(lambda_function_name)
-    _, _, _, new_code_key = new_code_uri.split('/')
+def update_lambda_function_package(lambda_function_name, s3=None):
+    new_code_key = generate_code_key_for_lambda_function(lambda_function_name)
+    if s3_object_exists(LAMBDA_FUNCTION_DEPLOYMENT_BUCKET, new_code_key, s3=s3):
+        print('Lambda function deployment package for: ' + lambda_function_name + ' on S3 is current.')
+        return
 
     print('Creating Lambda function deployment package.')
     lambda_function_deployment_package = create_lambda_deployment_package(lambda_function_name)
     print('Uploading Lambda function deployment package as: ' + new_code_key)
-    upload_object_to_s3(LAMBDA_FUNCTION_DEPLOYMENT_BUCKET, new_code_key, lambda_function_deployment_package)
+    upload_object_to_s3(LAMBDA_FUNCTION_DEPLOYMENT_BUCKET, new_code_key, lambda_function_deployment_package, s3=s3)
 
 
 def update_lambda_function_packages():
-    for lambda_function_name in lambda_functions.keys():
-        update_lambda_function_package(lambda_function_name)
+    s3 = boto3.client('s3', region_name=AWS_DEFAULT_REGION)  # Clients are thread safe, creating them isn't.
+    sources = sorted(set(get_lambda_function_source(name) for name in lambda_functions.keys()))
+    run_in_parallel(update_lambda_function_package, [(name, s3) for name in sources])
 
 
 # Step Functions
@@ -406,21 +601,94 @@ def populate_state_machines_dict():
         state_machines[state_machine_name] = state_machine_dict
 
 
-def generate_state_machine_cfn_template(state_machine_name):
-    result_template = {
-        'Resources': {},
-        'Outputs': {}
-    }
+def get_state_dicts(definition):
+    # Yields the 'States' dicts of a state machine definition and of all its Parallel branches and Map processors.
+    yield definition['States']
+    for state in definition['States'].values():
+        for branch in state.get('Branches', []) + [state.get('ItemProcessor', state.get('Iterator'))]:
+            if branch is not None:
+                for states in get_state_dicts(branch):
+                    yield states
+
+
+def generate_fan_out_state_machine_definition(state_machine_definition):
+    # Returns a variant of the definition that turns each list_bucket -> worker -> ... loop into
+    # plan_batches -> Distributed Map (worker) -> aggregate_batch_results -> ..., or None if there is no such loop.
+    # Each plan lists batches ahead into the scratch bucket, and the Map state processes them in parallel, up to the
+    # maxConcurrency given in the execution input. The states after the worker see the plan instead of the listResult.
+    result = json.loads(json.dumps(state_machine_definition))  # implements deep copy.
+    found = False
+
+    for states in list(get_state_dicts(result)):
+        for lister_name, lister in states.items():
+            if lister.get('Type') != 'Task' or lister.get('Resource') != FAN_OUT_LISTER:
+                continue
+            worker_name = lister.get('Next')
+            worker = states.get(worker_name, {})
+            if worker.get('Resource') not in FAN_OUT_WORKERS:
+                continue
+
+            lister['Resource'] = FAN_OUT_PLANNER
+            lister['ResultPath'] = '$.plan'
+            lister['TimeoutSeconds'] = FAN_OUT_PLANNER_TIMEOUT
+
+            batch_worker = dict((k, v) for k, v in worker.items() if k not in ['InputPath', 'ResultPath', 'Next'])
+            batch_worker['End'] = True
+            aggregator_name = 'Aggregate' + worker_name + 'Results'
+            states[worker_name] = {
+                'Type': 'Map',
+                'ItemReader': {
+                    'Resource': 'arn:aws:states:::s3:getObject',
+                    'ReaderConfig': {
+                        'InputType': 'JSON'
+                    },
+                    'Parameters': {
+                        'Bucket.$': '$.plan.bucket',
+                        'Key.$': '$.plan.key'
+                    }
+                },
+                'ItemProcessor': {
+                    'ProcessorConfig': {
+                        'Mode': 'DISTRIBUTED',
+                        'ExecutionType': 'STANDARD'
+                    },
+                    'StartAt': worker_name + 'Batch',
+                    'States': {
+                        worker_name + 'Batch': batch_worker
+                    }
+                },
+                'MaxConcurrencyPath': '$.plan.maxConcurrency',
+                'InputPath': '$',
+                'ResultPath': '$.batchResults',
+                'OutputPath': '$',
+                'Next': aggregator_name
+            }
+            states[aggregator_name] = {
+                'Type': 'Task',
+                'Resource': FAN_OUT_AGGREGATOR,
+                'InputPath': '$',
+                'ResultPath': '$',
+                'OutputPath': '$',
+                'TimeoutSeconds': FAN_OUT_AGGREGATOR_TIMEOUT,
+                'Next': worker['Next']
+            }
+            found = True
 
-    state_machine_logical_name = to_camel_case(state_machine_name)
+    if not found:
+        return None
+    result['Comment'] = result.get('Comment', '') + ' (fan-out variant)'
+    return result
 
+
+def add_state_machine_cfn_template(result_template, state_machine_logical_name, state_machine_definition, policies):
     state_machine_role_name = state_machine_logical_name + STATE_MACHINE_ROLE_POSTFIX
     state_machine_role_template = generate_role_cfn_template(
         STATE_MACHINE_DEFAULT_POLICIES, STATE_MACHINE_TRUSTED_ENTITY
     )
+    if len(policies) > 0:
+        state_machine_role_template['Properties']['Policies'] = policies
     result_template['Resources'][state_machine_role_name] = state_machine_role_template
 
-    state_machine_definition = state_machines[state_machine_name]
     state_machine_json = json.dumps(state_machine_definition, indent=4)
     state_machine_json_lines = state_machine_json.splitlines()
 
@@ -442,7 +710,7 @@ def generate_state_machine_cfn_template(state_machine_name):
                                     'Arn'
                                 ]
                             },
-                            '",'
+                            '",' if line.rstrip().endswith(',') else '"'
                         ]
                     ]
                 }
@@ -474,6 +742,31 @@ def generate_state_machine_cfn_template(state_machine_name):
 
     result_template['Outputs'][output_name] = output_template
 
+
+def generate_state_machine_cfn_template(state_machine_name):
+    result_template = {
+        'Resources': {},
+        'Outputs': {}
+    }
+
+    state_machine_logical_name = to_camel_case(state_machine_name)
+    state_machine_definition = state_machines[state_machine_name]
+    add_state_machine_cfn_template(
+        result_template,
+        state_machine_logical_name,
+        state_machine_definition,
+        [CFN_TEMPLATE_CONTINUATION_ROLE_POLICY]
+    )
+
+    fan_out_definition = generate_fan_out_state_machine_definition(state_machine_definition)
+    if fan_out_definition is not None:
+        add_state_machine_cfn_template(
+            result_template,
+            state_machine_logical_name + STATE_MACHINE_FAN_OUT_POSTFIX,
+            fan_out_definition,
+            [CFN_TEMPLATE_CONTINUATION_ROLE_POLICY, CFN_TEMPLATE_FAN_OUT_ROLE_POLICY]
+        )
+
     return result_template
 
 
@@ -514,9 +807,14 @@ def generate_cfn_template():
         lambda_function_template = generate_lambda_function_cfn_template(lambda_function_name)
         combine_templates(result, lambda_function_template)
 
-    for state_machine_name in state_machines.keys():
+    # State machine templates need IAM lookups, so we generate them in parallel.
+    state_machine_names = sorted(state_machines.keys())
+    for state_machine_name in state_machine_names:
         print('Generating CloudFormation template for state machine: ' + state_machine_name)
-        state_machine_template = generate_state_machine_cfn_template(state_machine_name)
+    state_machine_templates = run_in_parallel(
+        generate_state_machine_cfn_template, [(name,) for name in state_machine_names]
+    )
+    for state_machine_template in state_machine_templates:
         combine_templates(result, state_machine_template)
 
     return result
@@ -534,10 +832,12 @@ def get_cfn_stack_info():
     return result
 
 
-def create_cfn_change_set():
+def create_cfn_change_set(template=None):
     stack_info = get_cfn_stack_info()
-    print('Generating CloudFormation template.')
-    template = json.dumps(generate_cfn_template(), sort_keys=True, indent=4)
+    if template is None:
+        print('Generating CloudFormation template.')
+        template = generate_cfn_template()
+    template = json.dumps(template, sort_keys=True, indent=4)
 
     cfn = boto3.client('cloudformation', region_name=AWS_DEFAULT_REGION)
     args = {
@@ -554,12 +854,12 @@ def create_cfn_change_set():
         print('CloudFormation stack: ' + CFN_STACK_NAME + ' is in ROLLBACK_COMPLETE state.')
         print('Deleting stack...')
         cfn.delete_stack(StackName=CFN_STACK_NAME)
-        while True:
+        for sleep_time in backoff_sleep_times():
             print('Waiting for stack delete to complete.')
             stack_info = get_cfn_stack_info()
             if stack_info is None or stack_info['StackStatus'] == 'DELETE_COMPLETE':
                 break
-            time.sleep(SLEEP_TIME)
+            time.sleep(sleep_time)
         args['ChangeSetType'] = 'CREATE'
     else:
         print(
@@ -571,7 +871,7 @@ def create_cfn_change_set():
             ChangeSetName=CFN_STACK_CHANGE_SET_NAME,
             StackName=CFN_STACK_NAME
         )
-        while True:
+        for sleep_time in backoff_sleep_times():
             response = cfn.describe_change_set(ChangeSetName=CFN_STACK_CHANGE_SET_NAME, StackName=CFN_STACK_NAME)
             status = response['Status']
             print('Status: ' + status)
@@ -579,15 +879,16 @@ def create_cfn_change_set():
                 exit(1)
             elif status.endswith('COMPLETED'):
                 break
-    except ClientError:
+            time.sleep(sleep_time)
+    except ClientError:  # The change set doesn't exist (anymore).
         pass
 
     response = cfn.create_change_set(**args)
     change_set_id = response['Id']
 
     print('Waiting for CloudFormation change set creation to complete...')
-    while True:
-        time.sleep(SLEEP_TIME)
+    for sleep_time in backoff_sleep_times():
+        time.sleep(sleep_time)
         response = cfn.describe_change_set(ChangeSetName=change_set_id)
         status = response['Status']
         if status == 'FAILED':
@@ -609,7 +910,7 @@ def execute_cfn_change_set(change_set_id):
     print('Executing CloudFormation change set...')
     cfn.execute_change_set(ChangeSetName=change_set_id)
 
-    while True:
+    for sleep_time in backoff_sleep_times():
         response = get_cfn_stack_info()
         if response is None:
             status = 'UNKNOWN'
@@ -626,11 +927,11 @@ def execute_cfn_change_set(change_set_id):
         elif status.endswith('COMPLETE'):
             return
 
-        time.sleep(SLEEP_TIME)
+        time.sleep(sleep_time)
 
 
-def update_cfn_stack():
-    change_set_id = create_cfn_change_set()
+def update_cfn_stack(template=None):
+    change_set_id = create_cfn_change_set(template)
     if change_set_id is not None:
         execute_cfn_change_set(change_set_id)
 
@@ -674,7 +975,11 @@ def get_state_machine_names():
 
     result = []
     for state_machine_name in state_machines.keys():
-        result.append(stack_output_dict[to_camel_case(state_machine_name) + 'Name'])
+        state_machine_logical_name = to_camel_case(state_machine_name)
+        result.append(stack_output_dict[state_machine_logical_name + 'Name'])
+        fan_out_output_name = state_machine_logical_name + STATE_MACHINE_FAN_OUT_POSTFIX + 'Name'
+        if fan_out_output_name in stack_output_dict:
+            result.append(stack_output_dict[fan_out_output_name])
 
     return result
 
@@ -691,18 +996,264 @@ def print_state_machine_names():
             print '    ' + name
 
 
+# Local execution
+
+def format_duration(seconds):
+    if seconds is None:
+        return 'unknown'
+    return '{0}:{1:02d}:{2:02d}'.format(int(seconds) // 3600, int(seconds) // 60 % 60, int(seconds) % 60)
+
+
+def format_sync_progress(sync, previous_keys=None, interval=0):
+    # Some lines about one sync from query_progress. With the keys per branch from interval seconds ago, the
+    # throughput since then, too.
+    lines = [
+        sync['progress'] + ': ' + format_duration(sync['elapsedSeconds']) + ' elapsed, ' +
+        format_duration(sync['etaSeconds']) + ' left, updated ' + str(sync['secondsSinceUpdate']) + 's ago',
+        '    {0} copied, {1} current, {2} deleted, {3:.1f} MB copied ({4:.2f} MB/s)'.format(
+            sync['copied'], sync['current'], sync['deleted'], sync['copiedBytes'] / 1e6,
+            sync['copiedBytesPerSecond'] / 1e6
+        )
+    ]
+    for bucket_to_list in ['source', 'destination']:
+        branch = sync['branches'][bucket_to_list]
+        line = '    {0}: {1} of {2} keys'.format(
+            bucket_to_list, branch['keys'], '?' if branch['estimatedKeys'] is None else branch['estimatedKeys']
+        )
+        if branch['estimateBasis'] is not None:
+            line += ' (' + branch['estimateBasis'] + ')'
+        line += ', {0:.1f} keys/s'.format(branch['keysPerSecond'])
+        if previous_keys is not None and interval > 0:
+            line += ', {0:.1f} keys/s now'.format((branch['keys'] - previous_keys.get(bucket_to_list, 0)) / interval)
+        if 'estimatedBytes' in branch:
+            line += ', {0:.1f} MB in total'.format(branch['estimatedBytes'] / 1e6)
+        line += ', done' if branch['done'] else ', ' + format_duration(branch['etaSeconds']) + ' left'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def print_local_progress(dynamodb, table):
+    # The progress records of a local run, see shared/progress.py.
+    query_progress = load_lambda_module('query_progress', LAMBDA_FUNCTION_DIRECTORY)
+    with dynamodb.installed():
+        syncs = query_progress.handler({'progressTable': table}, LocalLambdaContext('query_progress'))['syncs']
+    print('\nProgress records:')
+    for sync in syncs:
+        print(format_sync_progress(sync))
+
+
+def run_state_machine_locally(state_machine_name, execution_input, s3, fan_out=False, dynamodb=None):
+    state_machine_definition = state_machines[state_machine_name]
+    max_payload_size = MAX_PAYLOAD_SIZE
+    if fan_out:
+        state_machine_definition = generate_fan_out_state_machine_definition(state_machine_definition)
+        if state_machine_definition is None:
+            print('State machine: ' + state_machine_name + ' has no fan-out variant.')
+            return None
+        state_machine_name += ' (fan-out variant)'
+        max_payload_size = FAN_OUT_MAX_PAYLOAD_SIZE
+
+    local_state_machine = LocalStateMachine(
+        state_machine_definition, lambda_function_directory=LAMBDA_FUNCTION_DIRECTORY, region=AWS_DEFAULT_REGION,
+        max_payload_size=max_payload_size,
+        lambda_handlers=dict((name, get_lambda_function_handler(name)) for name in lambda_functions.keys())
+    )
+
+    dynamodb = dynamodb or LocalDynamoDB()
+    s3control = LocalS3Control(s3)  # For 'batchCopyThreshold', see batch_copy.
+    print('Running state machine: ' + state_machine_name + ' locally.')
+    with s3.installed(), dynamodb.installed(), s3control.installed():
+        try:
+            output = local_state_machine.run(execution_input)
+        finally:
+            print(local_state_machine.stats.format_report())
+            print('\nS3 requests: ' + str(sum(s3.request_counts.values())))
+            for operation_name, count in sorted(s3.request_counts.items()):
+                print('    ' + operation_name + ': ' + str(count))
+            if len(dynamodb.request_counts) > 0:
+                print('\nDynamoDB requests: ' + str(sum(dynamodb.request_counts.values())))
+                for operation_name, count in sorted(dynamodb.request_counts.items()):
+                    print('    ' + operation_name + ': ' + str(count))
+            if len(s3control.request_counts) > 0:
+                print('\nS3 Control requests: ' + str(sum(s3control.request_counts.values())))
+                for operation_name, count in sorted(s3control.request_counts.items()):
+                    print('    ' + operation_name + ': ' + str(count))
+
+    return output
+
+
 # Main
 
 @task(default=True)
 def deploy():
-    check_bucket(LAMBDA_FUNCTION_DEPLOYMENT_BUCKET)
-    populate_lambda_functions_dict()
-    populate_state_machines_dict()
-    update_lambda_function_packages()
-    update_cfn_stack()
-    print_state_machine_names()
+    timed('Check deployment bucket', check_bucket, LAMBDA_FUNCTION_DEPLOYMENT_BUCKET)
+    timed('Read Lambda functions', populate_lambda_functions_dict)
+    timed('Read state machines', populate_state_machines_dict)
+    timed('Look up AWS account', get_account_id)  # Also resolves credentials before we start any threads.
+
+    # Packages are addressed by content hash, so the template doesn't have to wait for their upload.
+    _, template = run_in_parallel(timed, [
+        ('Update Lambda function packages', update_lambda_function_packages),
+        ('Generate CloudFormation template', generate_cfn_template)
+    ])
+
+    timed('Update CloudFormation stack', update_cfn_stack, template)
+    timed('Print state machine names', print_state_machine_names)
+    print_phase_timings()
 
 
 @task()
 def delete():
     delete_cfn_stack()
+
+
+@task()
+def run_local(
+    source_keys=1000, destination_keys=1000, object_size=1024, latency=0.0, input_file=None, fan_out='no'
+):
+    # Run the state machine locally against an in-memory S3 stand-in with synthetic buckets. Half of the destination
+    # keys overlap with the source keys, the other half are orphans. Additional execution input can be given as JSON.
+    # With fan_out=yes, the fan-out variant of the state machine is run instead.
+    source_keys = int(source_keys)
+    s3 = LocalS3(latency=float(latency))
+    s3.add_bucket('local-source', AWS_DEFAULT_REGION)
+    s3.add_bucket('local-destination', AWS_DEFAULT_REGION)
+    s3.add_bucket('local-scratch', AWS_DEFAULT_REGION)
+    populate_bucket(s3, 'local-source', source_keys, size=int(object_size))
+    populate_bucket(s3, 'local-destination', int(destination_keys), size=int(object_size), start=source_keys // 2)
+    dynamodb = LocalDynamoDB()
+    dynamodb.add_table('local-rate-budgets', 'budget')  # For 'rateBudgetTable', see shared/rate_budget.py.
+    dynamodb.add_table('local-progress', 'progress')  # For 'progressTable', see shared/progress.py.
+
+    execution_input = {
+        'source': 'local-source',
+        'destination': 'local-destination',
+        'scratchBucket': 'local-scratch'
+    }
+    if input_file is not None:
+        with open(input_file) as f:
+            execution_input.update(json.load(f))
+
+    populate_lambda_functions_dict()  # For the handlers of variants, see run_state_machine_locally.
+    populate_state_machines_dict()
+    for state_machine_name in sorted(state_machines.keys()):
+        run_state_machine_locally(
+            state_machine_name, execution_input, s3, fan_out=str(fan_out).lower() in ['yes', 'true', '1'],
+            dynamodb=dynamodb
+        )
+        if 'progressTable' in execution_input:
+            print_local_progress(dynamodb, execution_input['progressTable'])
+
+
+@task()
+def sync(options_file, processes=None, checkpoint_file=None):
+    # Synchronize a bucket pair from this host with the sync engine, without the state machine. The options are
+    # execution input from a JSON file. A sync started with an existing checkpoint file continues from there.
+    with open(options_file) as f:
+        options = json.load(f)
+    result = sync_buckets(
+        options, processes=None if processes is None else int(processes), checkpoint_file=checkpoint_file
+    )
+    print(json.dumps(result, indent=4, sort_keys=True))
+
+
+@task()
+def sync_local(
+    source_keys=1000, destination_keys=1000, object_size=1024, latency=0.0, input_file=None, checkpoint_file=None
+):
+    # Run the sync engine against an in-memory S3 stand-in with synthetic buckets, like run_local. The shards run in
+    # threads, the buckets only exist in the memory of this process.
+    source_keys = int(source_keys)
+    s3 = LocalS3(latency=float(latency))
+    s3.add_bucket('local-source', AWS_DEFAULT_REGION)
+    s3.add_bucket('local-destination', AWS_DEFAULT_REGION)
+    populate_bucket(s3, 'local-source', source_keys, size=int(object_size))
+    populate_bucket(s3, 'local-destination', int(destination_keys), size=int(object_size), start=source_keys // 2)
+    dynamodb = LocalDynamoDB()
+    dynamodb.add_table('local-rate-budgets', 'budget')
+    dynamodb.add_table('local-progress', 'progress')
+
+    options = {
+        'source': 'local-source',
+        'destination': 'local-destination'
+    }
+    if input_file is not None:
+        with open(input_file) as f:
+            options.update(json.load(f))
+
+    with s3.installed(), dynamodb.installed():
+        start_time = time.time()
+        result = sync_buckets(options, processes=0, checkpoint_file=checkpoint_file)
+        print('Synchronized in: {0:.2f}s'.format(time.time() - start_time))
+        print(json.dumps(result, indent=4, sort_keys=True))
+        print('\nS3 requests: ' + str(sum(s3.request_counts.values())))
+        for operation_name, count in sorted(s3.request_counts.items()):
+            print('    ' + operation_name + ': ' + str(count))
+    if 'progressTable' in options:
+        print_local_progress(dynamodb, options['progressTable'])
+
+
+@task()
+def tune(
+    functions='copy_keys delete_orphaned_keys', memory_sizes='128 256 512 1024 1769', parallelism='5 10 20 40',
+    keys=200, latency=0.02, save='yes'
+):
+    # Benchmark worker functions locally for each memory size and number of threads (lists separated by spaces),
+    # see local_execution/tuning.py. Prints keys per second and the Lambda cost per million keys of each setting, and
+    # saves the recommended one to LAMBDA_TUNING_FILE, for the next deployment.
+    populate_lambda_functions_dict()
+    memory_sizes = [int(m) for m in memory_sizes.split()]
+    parallelisms = [int(p) for p in parallelism.split()]
+
+    def report(trial):
+        print('{memorySize:>10} {parallelism:>8} {keysPerSecond:>10.1f} {costPerMillionKeys:>14.4f}'.format(**trial))
+
+    for lambda_function_name in functions.split():
+        print('Tuning: ' + lambda_function_name + ' with ' + str(keys) + ' keys per invocation, ' + str(latency) +
+              's latency per request.')
+        print('{0:>10} {1:>8} {2:>10} {3:>14}'.format('MemorySize', 'Threads', 'Keys/s', 'USD/M keys'))
+        _, recommended = tune_function(
+            lambda_function_name, memory_sizes, parallelisms, int(keys), float(latency),
+            lambda_functions[lambda_function_name]['Timeout'], report=report
+        )
+        if recommended is None:
+            print('No setting copies a page of keys fast enough, nothing to recommend.\n')
+            continue
+        print('Recommended: MemorySize: ' + str(recommended['memorySize']) + ', threads: ' +
+              str(recommended['parallelism']) + '\n')
+        if str(save).lower() in ['yes', 'true', '1']:
+            save_lambda_tuning(lambda_function_name, {
+                'MemorySize': recommended['memorySize'],
+                'Environment': {'Variables': {'THREAD_PARALLELISM': str(recommended['parallelism'])}},
+                'Benchmark': dict(recommended, keys=int(keys), latency=float(latency))
+            })
+    if str(save).lower() in ['yes', 'true', '1']:
+        print('Saved the recommended settings to: ' + LAMBDA_TUNING_FILE + ', run fab to deploy them.')
+
+
+@task()
+def progress(table, name=None, region=AWS_DEFAULT_REGION, watch=0):
+    # Show how far along the syncs with progress records in the table are, and their estimated time left, with the
+    # query_progress Lambda function run locally. With watch=<seconds>, show them again every so many seconds, with
+    # the throughput since the last time.
+    query_progress = load_lambda_module('query_progress', LAMBDA_FUNCTION_DIRECTORY)
+    event = {
+        'progressTable': table,
+        'progressRegion': region
+    }
+    if name is not None:
+        event['progressName'] = name
+
+    previous_keys = {}
+    previous_time = None
+    while True:
+        syncs = query_progress.handler(event, LocalLambdaContext('query_progress', region))['syncs']
+        now = time.time()
+        for sync in syncs:
+            print(format_sync_progress(sync, previous_keys.get(sync['progress'], None), now - (previous_time or now)))
+            previous_keys[sync['progress']] = dict((b, sync['branches'][b]['keys']) for b in sync['branches'])
+        if float(watch) <= 0:
+            return
+        previous_time = now
+        time.sleep(float(watch))
+        print('')
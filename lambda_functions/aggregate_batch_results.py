@@ -0,0 +1,65 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# YAML front matter with parameters for deployment as a Lambda function.
+#
+# ---
+# Description: "Fan-out variant: Add up the results of the batches processed by a Map state."
+# MemorySize: 128
+# Timeout: 15
+# Policies:
+# ---
+#
+# Input event: The state of a fan-out branch, with the list of per-batch results from copy_keys or
+# delete_orphaned_keys in 'batchResults'.
+#
+# Output: The same state without 'batchResults'. Their totals (see shared/results.py) replace 'copyResult' (when
+# listing the source bucket) or 'deleteResult' (when listing the destination bucket), so checkpoint_progress can add
+# them to the running totals of the execution like the result of a single batch.
+#
+
+# Imports
+
+import logging
+from shared.results import RESULT_ATTRIBUTES, merge_results
+
+
+# Constants
+
+DEBUG = False
+
+
+# Globals
+
+logger = logging.getLogger()
+if DEBUG:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+
+# Functions
+
+def handler(event, _):
+    assert(isinstance(event, dict))
+
+    result_attribute = RESULT_ATTRIBUTES[event['listBucket']]
+    batch_results = event.pop('batchResults', [])
+
+    total = {'batches': 0}
+    for result in batch_results:
+        merge_results(total, result)
+    event[result_attribute] = total
+
+    logger.info('Added up ' + str(len(batch_results)) + ' batch results.')
+
+    return event
@@ -0,0 +1,475 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# YAML front matter with parameters for deployment as a Lambda function.
+#
+# ---
+# Description: "Plan the copies of a large sync into an S3 Batch Operations job, watch it and retry what it left."
+# MemorySize: 256
+# Timeout: 300
+# Policies:
+#     - AmazonS3FullAccess
+#     - Version: '2012-10-17'  # Roles to assume for the source or destination, see shared/clients.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action: 'sts:AssumeRole'
+#               Resource: '*'
+#     - Version: '2012-10-17'  # Batch Operations jobs run with the role given in 'batchCopyRoleArn'.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action:
+#                   - 's3:CreateJob'
+#                   - 's3:DescribeJob'
+#                   - 'iam:PassRole'
+#               Resource: '*'
+#     - Version: '2012-10-17'  # Progress records, see shared/progress.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action:
+#                   - 'dynamodb:GetItem'
+#                   - 'dynamodb:PutItem'
+#                   - 'dynamodb:UpdateItem'
+#               Resource: '*'
+# ---
+#
+# Input event: The execution input (see list_bucket for the listing options and copy_keys for 'compareMode' and
+# 'storageClass'), plus:
+# {
+#     'batchCopyThreshold': 1000000,  # Keys to copy from which on a Batch Operations job copies them, enables this.
+#     'batchCopyRoleArn': 'arn:aws:iam::123456789012:role/sync-batch',  # Required, role the job copies with.
+#     'batchCopyAccountId': '123456789012',  # Optional, account of the job. Default: The account of this function.
+#     'batchCopyPriority': 10,  # Optional, priority of the job among the other jobs of the account.
+#     'scratchBucket': 'scratch-bucket',  # Required, the manifest and the completion report are stored here.
+#     'scratchPrefix': 's3-sync/',  # Optional.
+#     'executionTimeBudget': 1200,  # Optional, seconds, hand off to a continuation execution after this.
+#     'batchCopyResult': { ... },  # The output of the previous invocation, when continuing.
+#     'batchCopyRetryResult': { ... }  # The output of copy_keys for the retryKeys of the previous invocation.
+# }
+#
+# For syncs with many keys to copy, e.g. into a new, empty destination bucket, Amazon S3 can do the copying instead of
+# copy_keys, with a Batch Operations job. The state machine invokes this function before the copy and delete branches,
+# again and again until its 'phase' is 'done':
+#     'planning': The source bucket is listed, and the range of each page listed again in both buckets, with ETags and
+#         sizes. Keys the listings show to be missing from the destination or changed (see listing_shows_change in
+#         shared/listing.py) go into a CSV manifest of the job. The manifest is uploaded in parts of
+#         MANIFEST_PART_SIZE bytes, one multipart upload across invocations, with the rest that doesn't make a part
+#         yet left in the scratch bucket for the next invocation. Other keys are deferred, they need a closer look:
+#         Multipart ETags, archived or empty objects, objects too large for a single copy and keys with the same ETag
+#         in both buckets, whose metadata may differ. Once the listing is done, with fewer keys to copy than the
+#         threshold, the plan is dropped and the copy branch syncs the bucket as usual. Otherwise the job is created.
+#     'running': The job is described once a minute (see the WaitForBatchCopyJob state) until it is complete. If the
+#         job fails or is cancelled, the copy branch syncs the bucket as usual.
+#     'retrying': The deferred keys and the keys of failed copies, from the completion report of the job, are handed
+#         to copy_keys in 'retryKeys', a chunk at a time, just like the pages of the copy branch.
+# Then the checkpoint of the copy branch is set to done, so only the delete branch runs.
+#
+# The job copies objects with CopyObject requests, like copy_keys does for changes the listings show, with the
+# metadata of the source object and the 'storageClass' of the execution input. Its role needs to be able to read the
+# source, write the destination and the scratch bucket, and to be assumed by batchoperations.s3.amazonaws.com. Only
+# for a single, unversioned destination bucket of Amazon S3 (no endpoint URLs), in 'server' copy mode and without
+# rename detection.
+#
+# With a 'progressTable', the listing position of the source bucket, the copies of the job and whether it's done are
+# set in the progress record of the sync, see shared/progress.py.
+#
+# Output: A dict like:
+# {
+#     'phase': 'retrying',  # One of: 'planning', 'running', 'retrying', 'done'.
+#     'handOff': false,  # True if the rest should be left to a continuation execution.
+#     'batchOperations': true,  # Only when done, false if the copy branch has to sync the bucket as usual.
+#     'bucket': 'scratch-bucket', 'prefix': 's3-sync/batch-copies/<id>/',  # Manifest, report and deferred keys.
+#     'token': '...',  # Source listing position, while planning.
+#     'plannedKeys': 1500000, 'plannedBytes': 123456789000, 'deferredKeys': 1000, 'deferredParts': 3,
+#     'jobId': '...',
+#     'retryKeys': {'keys': [ ... ]},  # While retrying: The next chunk of keys for copy_keys.
+#     'totals': {'batchCopied': 1499990, 'batchFailed': 10, 'copied': 20, ... },  # Including the retries.
+#     'progress': { ... }  # Only when done with batchOperations: The checkpoint of the copy branch.
+# }
+#
+
+# Imports
+
+import csv
+import logging
+import boto3
+import json
+from io import BytesIO
+from urllib import quote, unquote
+from uuid import uuid4
+from shared.clients import create_s3_client
+from shared.listing import create_list_filter, is_bucket_list, list_key_range, list_next_page, listing_shows_change
+from shared.profiling import profiled
+from shared.progress import get_elapsed_seconds, is_over_budget, publish_progress
+from shared.results import merge_results
+
+
+# Constants
+
+DEBUG = False
+PREFIX = ''
+START_AFTER = ''
+SCRATCH_PREFIX = 's3-sync/'
+COMPARE_MODE = 'multipart'
+MAX_KEYS = 1000
+EXTRA_LIST_PAGES = 2  # For keys between those of a page, e.g. excluded by a list filter.
+MIN_REMAINING_TIME = 30000  # ms, stop listing and save the plan when less time than this is left.
+MANIFEST_PART_SIZE = 16 * 1024 * 1024  # bytes, the minimum part size of Amazon S3 is 5 MB.
+EXECUTION_TIME_BUDGET = 1200  # seconds, same as in checkpoint_progress.
+PRIORITY = 10
+MANIFEST_FORMAT = 'S3BatchOperations_CSV_20180820'
+REPORT_FORMAT = 'Report_CSV_20180820'
+FINISHED_JOB_STATUSES = ['Complete', 'Failed', 'Cancelled']
+RETRY_KEYS = 1000  # Keys per chunk for copy_keys, like a listing page.
+MAX_RETRY_KEYS_LENGTH = 14400  # JSON characters, half of list_bucket's: The chunk is in the state twice.
+UNSUPPORTED_OPTIONS = ['versioned', 'renameDetection', 'sourceEndpointUrl', 'destinationEndpointUrl']
+
+
+# Globals
+
+logger = logging.getLogger()
+if DEBUG:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+
+# Utility functions
+
+def to_csv(bucket, keys):
+    # Keys in Batch Operations manifests are URL encoded, the same goes for the deferred keys.
+    body = BytesIO()
+    csv.writer(body).writerows([bucket, quote(key.encode('utf-8'), safe='/')] for key in keys)
+    return body.getvalue()
+
+
+def read_csv_keys(s3, bucket, key):
+    # Keys in the second column, like in manifests and completion reports.
+    body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    return [unquote(row[1]).decode('utf-8') for row in csv.reader(BytesIO(body)) if len(row) > 1]
+
+
+def get_deferred_key(result, part):
+    return result['prefix'] + 'deferred/' + str(part).zfill(6) + '.csv'
+
+
+def plan_page(source_s3, destination_s3, source, destination, keys, compare_mode):
+    # Returns the (planned list entries, deferred keys) tuple of a page of source keys.
+    first_key = min(keys)
+    last_key = max(keys)
+    max_pages = len(keys) // MAX_KEYS + EXTRA_LIST_PAGES
+    source_entries, source_listed_until = list_key_range(source_s3, source, first_key, last_key, max_pages)
+    destination_entries, destination_listed_until = list_key_range(
+        destination_s3, destination, first_key, last_key, max_pages
+    )
+    listed_until = min(source_listed_until, destination_listed_until)
+
+    planned = []
+    deferred = []
+    for key in keys:
+        if (
+            key <= listed_until and key in source_entries and
+            listing_shows_change(source_entries[key], destination_entries.get(key, None), compare_mode)
+        ):
+            planned.append(source_entries[key])
+        else:
+            deferred.append(key)
+    return planned, deferred
+
+
+def create_job(event, result, source, destination, account_id, manifest_etag):
+    operation = {
+        'TargetResource': 'arn:aws:s3:::' + destination,
+        'MetadataDirective': 'COPY'
+    }
+    if 'storageClass' in event:
+        operation['StorageClass'] = event['storageClass']
+    if 'checksumAlgorithm' in event or event.get('compareMode', COMPARE_MODE) == 'checksum':
+        operation['ChecksumAlgorithm'] = event.get('checksumAlgorithm', 'CRC32C')
+
+    s3control = boto3.client('s3control', region_name=event['destinationRegion'])
+    return s3control.create_job(
+        AccountId=account_id,
+        ConfirmationRequired=False,
+        Operation={'S3PutObjectCopy': operation},
+        Report={
+            'Bucket': 'arn:aws:s3:::' + result['bucket'],
+            'Format': REPORT_FORMAT,
+            'Enabled': True,
+            'Prefix': result['prefix'] + 'report',
+            'ReportScope': 'FailedTasksOnly'
+        },
+        ClientRequestToken=result['id'],  # A retried invocation gets the same job.
+        Manifest={
+            'Spec': {'Format': MANIFEST_FORMAT, 'Fields': ['Bucket', 'Key']},
+            'Location': {
+                'ObjectArn': 'arn:aws:s3:::' + result['bucket'] + '/' + result['prefix'] + 'manifest.csv',
+                'ETag': manifest_etag
+            }
+        },
+        Priority=event.get('batchCopyPriority', PRIORITY),
+        RoleArn=event['batchCopyRoleArn'],
+        Description='Copy ' + str(result['plannedKeys']) + ' keys from bucket: ' + source + ' to bucket: ' + destination
+    )['JobId']
+
+
+def get_failure_reports(scratch_s3, result, job_id):
+    # Returns the keys of the completion report files with failed tasks.
+    response = scratch_s3.get_object(
+        Bucket=result['bucket'], Key=result['prefix'] + 'report/job-' + job_id + '/manifest.json'
+    )
+    report = json.loads(response['Body'].read())
+    return [r['Key'] for r in report.get('Results', []) if r.get('TaskExecutionStatus', '') == 'failed']
+
+
+def get_retry_file(result, position):
+    # The deferred keys come first, then the completion report files. Returns None after the last file.
+    if position < result['deferredParts']:
+        return get_deferred_key(result, position)
+    position -= result['deferredParts']
+    if position < len(result['failureReports']):
+        return result['failureReports'][position]
+    return None
+
+
+# Functions
+
+def plan(event, context, result, scratch_s3, function_region):
+    source = event['source']
+    destination = event['destination']
+    source_s3 = create_s3_client(event, 'source', function_region)
+    destination_s3 = create_s3_client(event, 'destination', function_region)
+    compare_mode = event.get('compareMode', COMPARE_MODE)
+    list_filter = create_list_filter(event)
+    manifest_key = result['prefix'] + 'manifest.csv'
+    pending_key = result['prefix'] + 'pending.csv'
+
+    if 'uploadId' not in result:
+        result['uploadId'] = scratch_s3.create_multipart_upload(Bucket=result['bucket'], Key=manifest_key)['UploadId']
+    buffer = BytesIO()
+    if result['pendingBytes'] > 0:
+        buffer.write(scratch_s3.get_object(Bucket=result['bucket'], Key=pending_key)['Body'].read())
+
+    def upload_part():
+        part_number = len(result['parts']) + 1
+        response = scratch_s3.upload_part(
+            Bucket=result['bucket'], Key=manifest_key, UploadId=result['uploadId'], PartNumber=part_number,
+            Body=buffer.getvalue()
+        )
+        result['parts'].append({'PartNumber': part_number, 'ETag': response['ETag']})
+        buffer.seek(0)
+        buffer.truncate()
+
+    args = {
+        'Bucket': source,
+        'MaxKeys': MAX_KEYS,
+        'Prefix': event.get('prefix', PREFIX),
+        'StartAfter': event.get('startAfter', START_AFTER)
+    }
+    token = result['token']
+    deferred = []
+    while context.get_remaining_time_in_millis() > MIN_REMAINING_TIME:
+        page, _ = list_next_page(source_s3, args, token, '', 'source', False, False, True, list_filter=list_filter)
+        token = page['token']
+        if len(page['keys']) > 0:
+            planned, page_deferred = plan_page(
+                source_s3, destination_s3, source, destination, page['keys'], compare_mode
+            )
+            buffer.write(to_csv(source, [entry['Key'] for entry in planned]))
+            result['plannedKeys'] += len(planned)
+            result['plannedBytes'] += sum(entry['Size'] for entry in planned)
+            deferred.extend(page_deferred)
+            if buffer.tell() >= MANIFEST_PART_SIZE:
+                upload_part()
+        if token == '':
+            break
+
+    if len(deferred) > 0:
+        scratch_s3.put_object(
+            Bucket=result['bucket'], Key=get_deferred_key(result, result['deferredParts']),
+            Body=to_csv(source, deferred)
+        )
+        result['deferredParts'] += 1
+        result['deferredKeys'] += len(deferred)
+    result['token'] = token
+    logger.info(
+        'Planned ' + str(result['plannedKeys']) + ' keys to copy with Batch Operations, deferred ' +
+        str(result['deferredKeys']) + ' keys' + (', continuing after: ' + token if token != '' else '')
+    )
+    publish_progress(event, function_region, attributes={'sourcePosition': token})
+
+    if token != '':
+        result['pendingBytes'] = buffer.tell()
+        if buffer.tell() > 0:
+            scratch_s3.put_object(Bucket=result['bucket'], Key=pending_key, Body=buffer.getvalue())
+        return
+
+    if result['plannedKeys'] < event['batchCopyThreshold']:
+        logger.info(
+            'Only ' + str(result['plannedKeys']) + ' keys to copy, fewer than the threshold of ' +
+            str(event['batchCopyThreshold']) + ', leaving them to the copy branch.'
+        )
+        scratch_s3.abort_multipart_upload(Bucket=result['bucket'], Key=manifest_key, UploadId=result['uploadId'])
+        result.update({'phase': 'done', 'batchOperations': False})
+        return
+
+    if buffer.tell() > 0:
+        upload_part()
+    manifest_etag = scratch_s3.complete_multipart_upload(
+        Bucket=result['bucket'], Key=manifest_key, UploadId=result['uploadId'],
+        MultipartUpload={'Parts': result['parts']}
+    )['ETag']
+    account_id = event.get('batchCopyAccountId', context.invoked_function_arn.split(':')[4])
+    result['jobId'] = create_job(event, result, source, destination, account_id, manifest_etag)
+    result['accountId'] = account_id
+    result['phase'] = 'running'
+    logger.info(
+        'Created Batch Operations job: ' + result['jobId'] + ' to copy ' + str(result['plannedKeys']) + ' keys.'
+    )
+
+
+def watch_job(event, result, scratch_s3, function_region):
+    s3control = boto3.client('s3control', region_name=event['destinationRegion'])
+    job = s3control.describe_job(AccountId=result['accountId'], JobId=result['jobId'])['Job']
+    summary = job.get('ProgressSummary', {})
+    succeeded = summary.get('NumberOfTasksSucceeded', 0)
+    failed = summary.get('NumberOfTasksFailed', 0)
+    logger.info(
+        'Batch Operations job: ' + result['jobId'] + ' is ' + job['Status'] + ', ' + str(succeeded) + ' keys copied, ' +
+        str(failed) + ' failed of ' + str(summary.get('TotalNumberOfTasks', result['plannedKeys']))
+    )
+    if job['Status'] not in FINISHED_JOB_STATUSES:
+        return
+
+    if job['Status'] != 'Complete':
+        logger.warning(
+            'Batch Operations job: ' + result['jobId'] + ' did not complete: ' +
+            json.dumps(job.get('FailureReasons', [])) + ', leaving the keys to the copy branch.'
+        )
+        result.update({'phase': 'done', 'batchOperations': False})
+        return
+
+    result['totals'].update({'batchCopied': succeeded, 'batchFailed': failed})
+    result['failureReports'] = get_failure_reports(scratch_s3, result, result['jobId']) if failed > 0 else []
+    result.update({'phase': 'retrying', 'retryPosition': {'file': 0, 'line': 0}})
+    # Failed keys count when copy_keys looks at them again.
+    publish_progress(event, function_region, {'sourceKeys': succeeded, 'copied': succeeded})
+
+
+def next_retry_keys(result, scratch_s3):
+    # Sets 'retryKeys' to the next chunk of keys for copy_keys and 'retryEnd' to the position after it, or the phase
+    # to 'done' after the last one.
+    position = dict(result['retryPosition'])
+    while True:
+        retry_file = get_retry_file(result, position['file'])
+        if retry_file is None:
+            result['phase'] = 'done'
+            result['batchOperations'] = True
+            return
+        keys = read_csv_keys(scratch_s3, result['bucket'], retry_file)[position['line']:]
+        chunk = []
+        length = 0
+        for key in keys[:RETRY_KEYS]:
+            length += len(json.dumps(key)) + 2  # With the ', ' separator.
+            if length > MAX_RETRY_KEYS_LENGTH and len(chunk) > 0:
+                break
+            chunk.append(key)
+        if len(chunk) > 0:
+            result['retryPosition'] = position
+            result['retryKeys'] = {'keys': chunk}
+            if len(chunk) < len(keys):
+                result['retryEnd'] = {'file': position['file'], 'line': position['line'] + len(chunk)}
+            else:
+                result['retryEnd'] = {'file': position['file'] + 1, 'line': 0}
+            return
+        position = {'file': position['file'] + 1, 'line': 0}
+
+
+@profiled
+def handler(event, context):
+    assert(isinstance(event, dict))
+
+    if 'scratchBucket' not in event:
+        raise ValueError('Batch Operations copies need a scratchBucket for their manifest.')
+    if 'batchCopyRoleArn' not in event:
+        raise ValueError('Batch Operations copies need a batchCopyRoleArn to copy with.')
+    unsupported_options = [o for o in UNSUPPORTED_OPTIONS if event.get(o, False)]
+    if is_bucket_list(event['destination']) or event.get('copyMode', 'server') != 'server':
+        unsupported_options.append('destination lists and copy modes other than server')
+    if len(unsupported_options) > 0:
+        raise ValueError('Batch Operations copies do not support: ' + ', '.join(unsupported_options))
+
+    function_region = context.invoked_function_arn.split(':')[3]
+    scratch_s3 = boto3.client('s3', region_name=function_region)
+
+    result = dict(event.get('batchCopyResult', {}))
+    if len(result) == 0:
+        batch_copy_id = uuid4().hex
+        result = {
+            'phase': 'planning',
+            'id': batch_copy_id,
+            'bucket': event['scratchBucket'],
+            'prefix': event.get('scratchPrefix', SCRATCH_PREFIX) + 'batch-copies/' + batch_copy_id + '/',
+            'token': '',
+            'parts': [],
+            'pendingBytes': 0,
+            'plannedKeys': 0,
+            'plannedBytes': 0,
+            'deferredKeys': 0,
+            'deferredParts': 0,
+            'totals': {}
+        }
+    result['totals'] = dict(result['totals'])
+
+    if result['phase'] == 'planning':
+        plan(event, context, result, scratch_s3, function_region)
+    if result['phase'] == 'running':  # Right after planning, too: A job may be done quickly.
+        watch_job(event, result, scratch_s3, function_region)
+    retried = result['phase'] == 'retrying' and 'retryKeys' in result and 'batchCopyRetryResult' in event
+    if retried:
+        merge_results(result['totals'], event['batchCopyRetryResult'])
+        result['retryPosition'] = result.pop('retryEnd')
+        del result['retryKeys']
+
+    # Hand off after a round of work only, so each execution gets somewhere.
+    elapsed_seconds = get_elapsed_seconds(event)
+    result['handOff'] = (
+        result['phase'] in ['planning', 'running'] or retried
+    ) and is_over_budget(elapsed_seconds, event.get('executionTimeBudget', EXECUTION_TIME_BUDGET))
+    if result['handOff']:
+        logger.info('Handing off Batch Operations copy after ' + str(int(elapsed_seconds)) + ' seconds.')
+        return result
+
+    if result['phase'] == 'retrying' and 'retryKeys' not in result:
+        next_retry_keys(result, scratch_s3)
+        if 'retryKeys' in result:
+            logger.info('Retrying ' + str(len(result['retryKeys']['keys'])) + ' keys with copy_keys.')
+
+    if result['phase'] == 'done':
+        # Keep what continuations carry over small.
+        for name in ['parts', 'uploadId', 'pendingBytes', 'token', 'failureReports', 'retryPosition']:
+            result.pop(name, None)
+        if result['batchOperations']:
+            result['progress'] = {
+                'listBucket': 'source',
+                'done': True,
+                'handOff': False,
+                'token': '',
+                'versionIdMarker': '',
+                'elapsedSeconds': int(elapsed_seconds or 0),
+                'totals': result['totals']
+            }
+            publish_progress(event, function_region, attributes={'sourcePosition': '', 'sourceDone': True})
+            logger.info('Batch Operations copy done: ' + json.dumps(result['totals'], sort_keys=True))
+    return result
@@ -0,0 +1,150 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# YAML front matter with parameters for deployment as a Lambda function.
+#
+# ---
+# Description: "List the source bucket into a Bloom filter of its keys, so orphans can be found without HEAD requests."
+# MemorySize: 1024
+# Timeout: 300
+# Policies:
+#     - AmazonS3FullAccess
+#     - Version: '2012-10-17'  # Roles to assume for the source or destination, see shared/clients.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action: 'sts:AssumeRole'
+#               Resource: '*'
+# ---
+#
+# Input event: The execution input (see list_bucket for the listing options), plus:
+# {
+#     'keyFilter': true,
+#     'scratchBucket': 'scratch-bucket',  # Required, the filter is stored here.
+#     'scratchPrefix': 's3-sync/',  # Optional.
+#     'keyFilterFalsePositiveRate': 0.01,  # Optional.
+#     'keyFilterCapacity': 1000000,  # Optional, expected number of keys. The filter grows beyond that if needed.
+#     'keyFilterResult': { ... }  # The output of the previous invocation, when continuing.
+# }
+#
+# Lists as much of the source bucket as fits into one invocation and adds the keys to a scalable Bloom filter (see
+# shared/bloom_filter.py) in the scratch bucket. The state machine invokes this function again until the token is
+# empty, then delete_orphaned_keys uses the filter to delete destination keys that are definitely not in the source
+# bucket without a HEAD request first.
+#
+# Output: A dict with the 'bucket' and 'key' of the filter, the 'token' (and 'versionIdMarker') to continue listing
+# from, 'listedAt' (a timestamp before the listing started, destination keys modified later may be missing from the
+# filter), the 'keyCount', and the configured and estimated false positive rates.
+#
+
+# Imports
+
+import logging
+import boto3
+import time
+from uuid import uuid4
+from shared.bloom_filter import ScalableBloomFilter, CAPACITY, FALSE_POSITIVE_RATE
+from shared.clients import create_s3_client
+from shared.listing import create_list_filter, list_next_page
+from shared.profiling import profiled
+
+
+# Constants
+
+DEBUG = False
+PREFIX = ''
+START_AFTER = ''
+VERSIONED = False
+SCRATCH_PREFIX = 's3-sync/'
+MAX_KEYS = 1000
+MIN_REMAINING_TIME = 30000  # ms, stop listing and save the filter when less time than this is left.
+CLOCK_SKEW_MARGIN = 300  # seconds, between this function and Amazon S3.
+
+
+# Globals
+
+logger = logging.getLogger()
+if DEBUG:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+
+# Functions
+
+@profiled
+def handler(event, context):
+    assert(isinstance(event, dict))
+
+    source = event['source']
+    if 'scratchBucket' not in event:
+        raise ValueError('The key filter needs a scratchBucket to be stored in.')
+
+    function_region = context.invoked_function_arn.split(':')[3]
+    scratch_s3 = boto3.client('s3', region_name=function_region)
+
+    previous_result = event.get('keyFilterResult', {})
+    token = previous_result.get('token', '')
+    version_id_marker = previous_result.get('versionIdMarker', '')
+    versioned = event.get('versioned', VERSIONED)
+    false_positive_rate = event.get('keyFilterFalsePositiveRate', FALSE_POSITIVE_RATE)
+
+    if token == '':
+        result = {
+            'bucket': event['scratchBucket'],
+            'key': event.get('scratchPrefix', SCRATCH_PREFIX) + 'key-filters/' + uuid4().hex + '.bloom',
+            'listedAt': int(time.time()) - CLOCK_SKEW_MARGIN
+        }
+        key_filter = ScalableBloomFilter(event.get('keyFilterCapacity', CAPACITY), false_positive_rate)
+    else:
+        result = dict((k, previous_result[k]) for k in ['bucket', 'key', 'listedAt'])
+        response = scratch_s3.get_object(Bucket=result['bucket'], Key=result['key'])
+        key_filter = ScalableBloomFilter.from_bytes(response['Body'].read())
+
+    args = {
+        'Bucket': source,
+        'MaxKeys': MAX_KEYS,
+        'Prefix': event.get('prefix', PREFIX)
+    }
+    if versioned:
+        args['KeyMarker'] = event.get('startAfter', START_AFTER)
+    else:
+        args['StartAfter'] = event.get('startAfter', START_AFTER)
+
+    s3 = create_s3_client(event, 'source', function_region)
+    list_filter = create_list_filter(event)  # Keys the destination listing excludes don't need to be in the filter.
+    while context.get_remaining_time_in_millis() > MIN_REMAINING_TIME:
+        page, _ = list_next_page(
+            s3, args, token, version_id_marker, 'source', versioned, False, True, list_filter=list_filter
+        )
+        for key in page['keys']:
+            key_filter.add(key)
+        token = page['token']
+        version_id_marker = page.get('versionIdMarker', '')
+        if token == '':
+            break
+
+    data = key_filter.to_bytes()
+    logger.info(
+        'Added ' + str(len(key_filter)) + ' keys from bucket: ' + source + ' to key filter: s3://' + result['bucket'] +
+        '/' + result['key'] + ' (' + str(len(data)) + ' bytes).'
+    )
+    scratch_s3.put_object(Bucket=result['bucket'], Key=result['key'], Body=data)
+
+    result.update({
+        'token': token,
+        'versionIdMarker': version_id_marker,
+        'keyCount': len(key_filter),
+        'falsePositiveRate': false_positive_rate,
+        'estimatedFalsePositiveRate': round(key_filter.estimated_false_positive_rate(), 6)
+    })
+    return result
@@ -0,0 +1,164 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# YAML front matter with parameters for deployment as a Lambda function.
+#
+# ---
+# Description: "List the destination bucket into an index of orphans by content, so renamed keys can be copied there."
+# MemorySize: 1024
+# Timeout: 300
+# Policies:
+#     - AmazonS3FullAccess
+#     - Version: '2012-10-17'  # Roles to assume for the source or destination, see shared/clients.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action: 'sts:AssumeRole'
+#               Resource: '*'
+# ---
+#
+# Input event: The execution input (see list_bucket for the listing options) with a complete 'keyFilterResult' (see
+# build_key_filter), plus:
+# {
+#     'renameDetection': true,
+#     'scratchBucket': 'scratch-bucket',  # Required, the index is stored here.
+#     'scratchPrefix': 's3-sync/',  # Optional.
+#     'renameIndexCapacity': 100000,  # Optional, maximum number of orphans in the index.
+#     'renameIndexResult': { ... }  # The output of the previous invocation, when continuing.
+# }
+#
+# Lists as much of the destination bucket as fits into one invocation and adds the keys that are definitely not in the
+# source key filter to an index of orphans by ETag and size (see shared/rename_index.py) in the scratch bucket. The
+# state machine invokes this function again until the token is empty. Then copy_keys copies keys missing from the
+# destination from orphans with the same content, delete_orphaned_keys leaves indexed orphans alone, and they are
+# deleted after both branches are done.
+#
+# Keys modified after the key filter was built may be in the source bucket, they are left to delete_orphaned_keys.
+# So are empty objects, which aren't worth copying from an orphan.
+#
+# Output: A dict with the 'bucket' and 'key' of the index, the 'token' to continue listing from and the 'orphanCount'.
+#
+
+# Imports
+
+import logging
+import boto3
+from uuid import uuid4
+from shared.bloom_filter import ScalableBloomFilter
+from shared.clients import create_s3_client
+from shared.listing import create_list_filter, is_bucket_list, list_key_range, list_next_page
+from shared.profiling import profiled
+from shared.rename_index import CAPACITY, RenameIndex
+
+
+# Constants
+
+DEBUG = False
+PREFIX = ''
+START_AFTER = ''
+SCRATCH_PREFIX = 's3-sync/'
+MAX_KEYS = 1000
+EXTRA_LIST_PAGES = 2  # For keys between those of a page, e.g. excluded by a list filter.
+MIN_REMAINING_TIME = 30000  # ms, stop listing and save the index when less time than this is left.
+
+
+# Globals
+
+logger = logging.getLogger()
+if DEBUG:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+
+# Functions
+
+@profiled
+def handler(event, context):
+    assert(isinstance(event, dict))
+
+    destination = event['destination']
+    if 'scratchBucket' not in event:
+        raise ValueError('The rename index needs a scratchBucket to be stored in.')
+    key_filter_result = event.get('keyFilterResult', {})
+    if key_filter_result.get('key', None) is None or key_filter_result.get('token', '') != '':
+        raise ValueError('Rename detection needs a complete source key filter, set keyFilter, too.')
+    if is_bucket_list(destination) or event.get('versioned', False):
+        raise ValueError('Rename detection works with a single, unversioned destination bucket only.')
+
+    function_region = context.invoked_function_arn.split(':')[3]
+    scratch_s3 = boto3.client('s3', region_name=function_region)
+
+    response = scratch_s3.get_object(Bucket=key_filter_result['bucket'], Key=key_filter_result['key'])
+    key_filter = ScalableBloomFilter.from_bytes(response['Body'].read())
+
+    previous_result = event.get('renameIndexResult', {})
+    token = previous_result.get('token', '')
+    capacity = event.get('renameIndexCapacity', CAPACITY)
+
+    if token == '':
+        result = {
+            'bucket': event['scratchBucket'],
+            'key': event.get('scratchPrefix', SCRATCH_PREFIX) + 'rename-indexes/' + uuid4().hex + '.json'
+        }
+        rename_index = RenameIndex()
+    else:
+        result = dict((k, previous_result[k]) for k in ['bucket', 'key'])
+        response = scratch_s3.get_object(Bucket=result['bucket'], Key=result['key'])
+        rename_index = RenameIndex.from_bytes(response['Body'].read())
+
+    args = {
+        'Bucket': destination,
+        'MaxKeys': MAX_KEYS,
+        'Prefix': event.get('prefix', PREFIX),
+        'StartAfter': event.get('startAfter', START_AFTER)
+    }
+
+    s3 = create_s3_client(event, 'destination', function_region)
+    list_filter = create_list_filter(event)
+    while context.get_remaining_time_in_millis() > MIN_REMAINING_TIME and len(rename_index) < capacity:
+        page, _ = list_next_page(
+            s3, args, token, '', 'destination', False, False, True, key_filter_result['listedAt'], list_filter
+        )
+        token = page['token']
+
+        recent_keys = set(page.get('recentKeys', []))
+        orphans = [k for k in page['keys'] if k not in recent_keys and k not in key_filter]
+        if len(orphans) > 0:
+            # Listing pages have keys only, list their range again for ETags and sizes.
+            entries, listed_until = list_key_range(
+                s3, destination, orphans[0], orphans[-1], len(page['keys']) // MAX_KEYS + EXTRA_LIST_PAGES
+            )
+            for key in orphans:
+                if key <= listed_until and key in entries and entries[key]['Size'] > 0:
+                    rename_index.add(key, entries[key]['ETag'], entries[key]['Size'])
+
+        if token == '':
+            break
+
+    if len(rename_index) >= capacity:
+        logger.warning(
+            'The rename index is full with ' + str(len(rename_index)) + ' orphans, more orphans are deleted as usual.'
+        )
+        token = ''
+
+    logger.info(
+        'Indexed ' + str(len(rename_index)) + ' orphans from bucket: ' + destination + ' in: s3://' +
+        result['bucket'] + '/' + result['key']
+    )
+    scratch_s3.put_object(Bucket=result['bucket'], Key=result['key'], Body=rename_index.to_bytes())
+
+    result.update({
+        'token': token,
+        'orphanCount': len(rename_index)
+    })
+    return result
@@ -0,0 +1,116 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# YAML front matter with parameters for deployment as a Lambda function.
+#
+# ---
+# Description: "Record the list cursor and running totals of a branch, decide whether to hand off to a continuation."
+# MemorySize: 128
+# Timeout: 15
+# Policies:
+#     - Version: '2012-10-17'  # Progress records, see shared/progress.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action:
+#                   - 'dynamodb:GetItem'
+#                   - 'dynamodb:PutItem'
+#                   - 'dynamodb:UpdateItem'
+#               Resource: '*'
+# ---
+#
+# Input event: The state of a copy or delete branch after a round of listing and processing keys, with the start
+# time of the execution in 'execution' and optionally:
+# {
+#     'executionTimeBudget': 1200,  # Seconds, hand off to a continuation execution after this. Default: 480 with a
+#                                   # 'largeObjectThreshold', so one more round with copy_large_keys still fits.
+#     'checkpoint': { ... }  # The checkpoint of the previous execution, see prepare_continuation.
+# }
+#
+# With a 'progressTable', the list cursor of the branch and whether it is done are also set in the progress record of
+# the sync, see shared/progress.py.
+#
+# Output: The progress of the branch:
+# {
+#     'listBucket': 'source',
+#     'done': false,  # True after the last page of keys.
+#     'handOff': true,  # True if the branch should stop here and leave the rest to a continuation execution.
+#     'token': '...',  # List cursor to continue from.
+#     'versionIdMarker': '',
+#     'elapsedSeconds': 1234,
+#     'totals': { ... }  # Results of all rounds so far, including those of previous executions.
+# }
+#
+
+# Imports
+
+import logging
+from shared.progress import get_elapsed_seconds, is_over_budget, publish_progress
+from shared.results import RESULT_ATTRIBUTES, merge_results
+
+
+# Constants
+
+DEBUG = False
+EXECUTION_TIME_BUDGET = 1200  # seconds, leaves 10 minutes of the 30 minute state machine timeout for one more round.
+LARGE_OBJECT_EXECUTION_TIME_BUDGET = 480  # seconds, with 'largeObjectThreshold' a round can take up to 22 minutes.
+LARGE_RESULT_ATTRIBUTE = 'largeCopyResult'  # Where copy_large_keys puts its result.
+
+
+# Globals
+
+logger = logging.getLogger()
+if DEBUG:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+
+# Functions
+
+def handler(event, context):
+    assert(isinstance(event, dict))
+
+    bucket_to_list = event['listBucket']
+    cursor = event['plan'] if 'plan' in event else event['listResult']  # The fan-out variant lists ahead in plans.
+    previous_progress = event.get('progress', event.get('checkpoint', {}).get(bucket_to_list, {}))
+    totals = merge_results(dict(previous_progress.get('totals', {})), event.get(RESULT_ATTRIBUTES[bucket_to_list], {}))
+    if 'largeKeys' in cursor and LARGE_RESULT_ATTRIBUTE in event:  # Only fresh when this round had large keys.
+        merge_results(totals, event[LARGE_RESULT_ATTRIBUTE])
+
+    elapsed_seconds = get_elapsed_seconds(event)
+    done = cursor.get('token', '') == ''
+    default_budget = EXECUTION_TIME_BUDGET
+    if 'largeObjectThreshold' in event:
+        default_budget = LARGE_OBJECT_EXECUTION_TIME_BUDGET
+    hand_off = not done and is_over_budget(elapsed_seconds, event.get('executionTimeBudget', default_budget))
+
+    if hand_off:
+        logger.info(
+            'Handing off ' + bucket_to_list + ' branch after ' + str(int(elapsed_seconds)) + ' seconds at: ' +
+            cursor['token']
+        )
+
+    publish_progress(event, context.invoked_function_arn.split(':')[3], attributes={
+        bucket_to_list + 'Position': cursor.get('token', ''),
+        bucket_to_list + 'Done': done
+    })
+
+    return {
+        'listBucket': bucket_to_list,
+        'done': done,
+        'handOff': hand_off,
+        'token': cursor.get('token', ''),
+        'versionIdMarker': cursor.get('versionIdMarker', ''),
+        'elapsedSeconds': int(elapsed_seconds or 0),
+        'totals': totals
+    }
@@ -18,32 +18,181 @@
 # Timeout: 300
 # Policies:
 #     - AmazonS3FullAccess
+#     - Version: '2012-10-17'  # Roles to assume for the source or destination, see shared/clients.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action: 'sts:AssumeRole'
+#               Resource: '*'
+#     - Version: '2012-10-17'  # Rate budgets and progress records, see shared/rate_budget.py and shared/progress.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action:
+#                   - 'dynamodb:GetItem'
+#                   - 'dynamodb:PutItem'
+#                   - 'dynamodb:UpdateItem'
+#               Resource: '*'
+# Variants:  # Functions of their own from the same package, see populate_lambda_functions_dict in fabfile.py.
+#     copy_large_keys:
+#         Description: "Copy the keys of objects above the largeObjectThreshold from source to destination."
+#         Handler: copy_keys.large_keys_handler
+#         MemorySize: 1024
+#         Timeout: 900
 # ---
 #
 # Input event: A dict like:
 # {
 #     'source': 'source-bucket',
 #     'sourceRegion': 'eu-west-1',
-#     'destination': 'destination-bucket',
+#     'destination': 'destination-bucket',  # Or a list of destination buckets in the same region.
 #     'destinationRegion': 'eu-west-1',
-#     'keys': [ ... ]
+#     'keys': [ ... ],
+#     'compareMode': 'multipart',  # Optional, one of: 'etag', 'multipart', 'checksum'.
+#     'checksumAlgorithm': 'CRC32C',  # Optional, checksum to add to copied objects. Default: The source's.
+#     'archiveMode': 'skip',  # Optional, one of: 'skip', 'restore'.
+#     'storageClass': 'STANDARD_IA',  # Optional, storage class for copied objects. Default: STANDARD.
+#     'copyMode': 'server',  # Optional, one of: 'server', 'stream'.
+#     'streamPartSize': 8388608,  # Optional, bytes per part in 'stream' copy mode.
+#     'streamConcurrency': 4,  # Optional, parts of one object transferred at the same time in 'stream' copy mode.
+#     'streamMemoryLimit': 50331648,  # Optional, bytes of part buffers all threads share in 'stream' copy mode.
+#     'conditionalCopy': false  # Optional, copy keys the listings show to have changed right away, see below.
 # }
 #
+# Source and destination can have their own role and endpoint, see shared/clients.py.
+#
+# With a list of destination buckets, each source key is looked up once and then compared to and copied into every
+# destination. The destinations share their role and endpoint.
+#
+# Compare modes:
+#     'etag': Copy whenever the raw ETags of source and destination differ.
+#     'multipart': Like 'etag', but aware of multipart ETags ("<digest>-<number of parts>"). Multipart source objects
+#         are copied with the same part layout so their destination ETag matches. If ETags can't be compared because
+#         the part layouts differ, fall back to comparing size and additional checksums (CRC64NVME, CRC32C, etc.).
+#     'checksum': Compare additional checksums (CRC64NVME, CRC32C, etc.) instead of ETags, which are not MD5 digests
+#         for SSE-KMS or SSE-C encrypted objects. Copies get a checksum of the configured algorithm, or of the source's
+#         so later runs can compare them. Objects without a common checksum are compared like in 'multipart' mode.
+#         Checksums are cached per Lambda container, keyed by bucket, key and ETag, so warm invocations don't need to
+#         fetch them again.
+#
+# In all modes but 'etag', encrypted objects whose ETags aren't MD5 digests are compared by checksum. If the source
+# has none, copying wouldn't make them comparable either: They're counted as 'incomparable' and logged, not copied.
+#
+# Copy modes:
+#     'server': Amazon S3 copies objects (CopyObject, UploadPartCopy) with the destination's credentials, which need
+#         read access to the source bucket.
+#     'stream': Objects are downloaded with ranged GETs through the source client and uploaded through the destination
+#         client, for buckets in different accounts, regions or behind different endpoints. Parts are streamed into
+#         a fixed set of reusable buffers (see BufferPool), so memory stays bounded no matter how large objects are.
+#         Each part is uploaded with its MD5 digest (and a CRC32 checksum if a checksum algorithm is set) which the
+#         destination verifies, and the combined digest is checked against the source ETag before the upload is
+#         completed. Multipart source objects keep their part layout if their parts fit into the buffers.
+#
+# Conditional copies: With 'conditionalCopy' set, the range of keys given is listed again in both buckets, with their
+# ETags and sizes. Keys the listings show to be missing from the destination or changed (see listing_shows_change)
+# are copied with a single CopyObject request instead of a HEAD request to each bucket first. The copy only happens if
+# the source still has the listed ETag, and, where botocore supports conditional writes for CopyObject, the destination
+# still has its listed ETag (or still doesn't exist). Keys that changed since they were listed are looked at again
+# like all other keys. Only for 'server' copy mode and a single destination.
+#
+# Rename detection: With a complete 'renameIndexResult' (see build_rename_index), keys that need to be copied are
+# copied from an orphan with the same ETag and size inside the destination bucket, if there is one, instead of from
+# the source. The metadata and tags still come from the source. The bytes not transferred from the source are
+# reported as 'renamedBytes'.
+#
+# Archive modes, for objects that can't be copied before they're restored (GLACIER, DEEP_ARCHIVE and the archive tiers
+# of INTELLIGENT_TIERING):
+#     'skip': Don't touch archived source objects, just report them.
+#     'restore': Request a restore for archived source objects that need to be copied. Restored objects are copied by
+#         the next sync run that comes across them.
+#
+# Requests are scheduled across prefix partitions, and within the request rate and bandwidth budgets of the bucket pair
+# if there are any, see shared/request_scheduler.py and shared/rate_budget.py for the options.
+#
+# With a 'progressTable', the keys looked at, their outcomes, and the bytes looked at ('scannedBytes', also in the
+# output then) and copied ('copiedBytes') are added to the progress record of the sync, see shared/progress.py.
+#
+# Instead of 'source', 'destination' and 'listResult', the event can have a pack of 'jobs' (see plan_jobs), each with
+# a 'source', 'destination' and optional 'prefix'. Their source buckets are small enough to be listed completely here.
+# The jobs share clients and the request scheduler, their results are reported per job in 'jobs', and added up.
+#
+# Large-object lane: With 'largeKeys' in the listing result (see 'largeObjectThreshold' in list_bucket), handler
+# copies the other keys only, and large_keys_handler, the handler of copy_large_keys, copies the large keys only. It
+# has more memory, so its 'stream' copy mode defaults to LARGE_STREAM_MEMORY_LIMIT and LARGE_STREAM_CONCURRENCY.
+#
+# Output: A dict with the number of keys per outcome and the request rates achieved per partition. With several
+# destinations, 'destinations' has the number of keys per outcome for each destination bucket. Archived keys that were
+# not copied are counted and logged, not listed, the output must stay small next to the listing result in the state.
+#
 
 # Imports
 
 import logging
 import boto3
+import os
+import struct
+import zlib
 from threading import Thread
 from botocore.exceptions import ClientError
 from Queue import Queue, Empty
+from threading import Condition, Lock
 import json
+from base64 import b64encode
+from hashlib import md5
+from urllib import urlencode
+from shared.clients import ClientPool, get_s3_client_args
+from shared.listing import (
+    MAX_COPY_OBJECT_SIZE, format_bucket, get_etag_part_count, list_key_range, list_small_bucket, listing_shows_change
+)
+from shared.profiling import profiled
+from shared.progress import get_sync_start_time, publish_progress
+from shared.rate_budget import create_rate_budget
+from shared.rename_index import load_rename_index
+from shared.results import merge_counts
+from shared.request_scheduler import create_scheduler
 
 
 # Constants
 
 DEBUG = False
-THREAD_PARALLELISM = 10  # Empirical value for now. Should find good way to measure/auto-scale this.
+THREAD_PARALLELISM = int(os.environ.get('THREAD_PARALLELISM', '10'))  # Set by deployments, see fab tune.
+COMPARE_MODE = 'multipart'
+COMPARE_MODES = ['etag', 'multipart', 'checksum']
+CHECKSUM_CACHE_SIZE = 100000  # Entries. The cache is cleared when it's full.
+ARCHIVE_MODE = 'skip'
+ARCHIVE_MODES = ['skip', 'restore']
+ARCHIVED_STORAGE_CLASSES = ['GLACIER', 'DEEP_ARCHIVE']
+RESTORE_DAYS = 1  # How long restored copies are kept. We only need them for one copy.
+RESTORE_TIER = 'Bulk'  # Cheapest restore tier.
+MAX_REPORTED_KEYS = 100  # Archived keys logged per invocation at most, keeps the log lines short.
+CHECKSUM_ALGORITHMS = ['ChecksumCRC64NVME', 'ChecksumCRC32C', 'ChecksumSHA256', 'ChecksumSHA1', 'ChecksumCRC32']
+COPY_MODE = 'server'
+COPY_MODES = ['server', 'stream']
+STREAM_CHECKSUM_ALGORITHM = 'CRC32'  # The only checksum we can compute with the standard library.
+STREAM_PART_SIZE = 8 * 1024 * 1024  # bytes, the minimum part size of Amazon S3 is 5 MB.
+STREAM_CONCURRENCY = 4
+STREAM_MEMORY_LIMIT = 48 * 1024 * 1024  # bytes, leaves room for the interpreter and boto3 within 128 MB.
+LARGE_STREAM_MEMORY_LIMIT = 512 * 1024 * 1024  # bytes, within the 1024 MB of copy_large_keys.
+LARGE_STREAM_CONCURRENCY = 16
+STREAM_READ_SIZE = 1024 * 1024  # bytes per read from a GET response, copied into the part buffer right away.
+MAX_PART_COUNT = 10000
+UNVERIFIABLE_ENCRYPTION = ['aws:kms', 'aws:kms:dsse']  # ETags of these objects are not MD5 digests, nor with SSE-C.
+JOB_ATTRIBUTES = ['source', 'destination', 'prefix']  # Identify the bucket pair of a job in its result.
+CONDITIONAL_COPY = False
+PROGRESS_COUNTS = ['copied', 'current', 'archived', 'scannedBytes', 'copiedBytes']  # Added to progress records.
+MAX_LIST_KEYS = 1000
+EXTRA_LIST_PAGES = 2  # Per bucket, for keys between those we got, e.g. excluded by a list filter.
+RENAME_ERROR_CODES = [  # The orphan is gone or changed, copy from the source instead.
+    'NoSuchKey',
+    '404',
+    'PreconditionFailed',
+    'InvalidObjectState'
+]
+CHANGED_ERROR_CODES = [  # The key changed since it was listed, or needs a closer look.
+    'PreconditionFailed',
+    'ConditionalRequestConflict',
+    'InvalidObjectState'
+]
 METADATA_KEYS = [
     'CacheControl',
     'ContentDisposition',
@@ -63,6 +212,10 @@ if DEBUG:
 else:
     logger.setLevel(logging.INFO)
 
+# Survives between invocations of the same Lambda container: {(bucket, key, etag): {checksum name: value}}.
+checksum_cache = {}
+checksum_cache_lock = Lock()
+
 
 # Utility functions
 
@@ -75,43 +228,790 @@ def collect_metadata(response):
     return metadata_json
 
 
+def is_archived(response):
+    # Restored copies of archived objects can be copied, a Restore header like 'ongoing-request="false", ...' tells.
+    if 'ongoing-request="false"' in response.get('Restore', ''):
+        return False
+    return response.get('StorageClass', 'STANDARD') in ARCHIVED_STORAGE_CLASSES or 'ArchiveStatus' in response
+
+
+def get_cached_checksums(bucket, key, etag):
+    with checksum_cache_lock:
+        return checksum_cache.get((bucket, key, etag), None)
+
+
+def cache_checksums(bucket, key, etag, checksums):
+    with checksum_cache_lock:
+        if len(checksum_cache) >= CHECKSUM_CACHE_SIZE:
+            checksum_cache.clear()
+        checksum_cache[(bucket, key, etag)] = checksums
+
+
+def extract_checksums(response):
+    return dict((k, v) for k, v in response.items() if k in CHECKSUM_ALGORITHMS)
+
+
+def split_parts(size, part_size):
+    # Equally sized parts with a smaller last one, like most upload tools do.
+    part_size = max(part_size, (size + MAX_PART_COUNT - 1) // MAX_PART_COUNT)
+    part_sizes = [part_size] * (size // part_size)
+    if size % part_size > 0:
+        part_sizes.append(size % part_size)
+    return part_sizes
+
+
+def has_md5_etag(response):
+    return (
+        'SSECustomerAlgorithm' not in response and
+        response.get('ServerSideEncryption', None) not in UNVERIFIABLE_ENCRYPTION
+    )
+
+
+def encode_crc32(crc):
+    return b64encode(struct.pack('>I', crc & 0xffffffff))
+
+
+def supports_conditional_copy(s3):
+    # Conditional writes for CopyObject (IfMatch, IfNoneMatch) need a recent botocore.
+    try:
+        members = s3.meta.service_model.operation_model('CopyObject').input_shape.members
+    except AttributeError:
+        return False
+    return 'IfMatch' in members and 'IfNoneMatch' in members
+
+
+def select_lane_keys(event, lane):
+    # Returns the event with the keys of the 'small' or 'large' object lane in its listing result.
+    list_result = event['listResult']
+    if 'largeKeys' not in list_result:
+        return event if lane == 'small' else dict(event, listResult=dict(list_result, keys=[]))
+    if lane == 'large':
+        keys = list_result['largeKeys']
+    else:
+        large_keys = set(list_result['largeKeys'])
+        keys = [k for k in list_result['keys'] if k not in large_keys]
+    return dict(event, listResult=dict(list_result, keys=keys))
+
+
+def create_list_client(client_args, client_pool=None):
+    if client_pool is not None:
+        return client_pool.get(client_args)
+    return boto3.client('s3', **client_args)
+
+
+def find_listed_changes(source_s3, destination_s3, source, destination, keys, archived_keys, compare_mode):
+    # Returns {key: (source list entry, destination list entry or None)} for the keys to copy without a closer look.
+    if len(keys) == 0:
+        return {}
+    first_key = min(keys)
+    last_key = max(keys)
+    max_pages = len(keys) // MAX_LIST_KEYS + EXTRA_LIST_PAGES
+    source_entries, source_listed_until = list_key_range(source_s3, source, first_key, last_key, max_pages)
+    destination_entries, destination_listed_until = list_key_range(
+        destination_s3, destination, first_key, last_key, max_pages
+    )
+    listed_until = min(source_listed_until, destination_listed_until)
+
+    changes = {}
+    for key in keys:
+        if key > listed_until or key in archived_keys or key not in source_entries:
+            continue
+        destination_entry = destination_entries.get(key, None)
+        if listing_shows_change(source_entries[key], destination_entry, compare_mode):
+            changes[key] = (source_entries[key], destination_entry)
+    return changes
+
+
 # Classes
 
+class BufferPool(object):
+    # Hands out reusable part buffers, blocking while their total size would exceed memory_limit. Buffers of the size
+    # asked for are reused, free buffers of other sizes are dropped to make room.
+    def __init__(self, memory_limit=STREAM_MEMORY_LIMIT):
+        self.memory_limit = memory_limit
+        self.allocated = 0
+        self.free_buffers = []
+        self.condition = Condition()
+
+    def acquire(self, size):
+        if size > self.memory_limit:
+            raise ValueError('A part of ' + str(size) + ' bytes exceeds the memory limit of ' + str(self.memory_limit))
+        with self.condition:
+            while True:
+                for i, buffer in enumerate(self.free_buffers):
+                    if len(buffer) == size:
+                        return self.free_buffers.pop(i)
+                while self.allocated + size > self.memory_limit and len(self.free_buffers) > 0:
+                    self.allocated -= len(self.free_buffers.pop(0))
+                if self.allocated + size <= self.memory_limit:
+                    self.allocated += size
+                    return bytearray(size)
+                self.condition.wait()
+
+    def release(self, buffer):
+        with self.condition:
+            self.free_buffers.append(buffer)
+            self.condition.notify_all()
+
+
 class KeySynchronizer(Thread):
-    def __init__(self, job_queue=None, source=None, destination=None, region=None):
+    def __init__(
+        self, job_queue=None, source=None, destination=None, region=None, compare_mode=None, archive_mode=None,
+        archived_keys=None, storage_class=None, checksum_algorithm=None, scheduler=None, source_client_args=None,
+        destination_client_args=None, copy_mode=None, buffer_pool=None, stream_part_size=None, stream_concurrency=None,
+        client_pool=None, listed_changes=None, destination_conditions=False, rename_index=None, count_bytes=False
+    ):
         super(KeySynchronizer, self).__init__()
         self.job_queue = job_queue
         self.source = source
-        self.destination = destination
-        self.s3 = boto3.client('s3', region_name=region)
+        self.destinations = destination if isinstance(destination, list) else [destination]
+        self.destination = self.destinations[0]  # The destination of the key being synced.
+        self.compare_mode = compare_mode or COMPARE_MODE
+        self.archive_mode = archive_mode or ARCHIVE_MODE
+        self.archived_keys = archived_keys or set()
+        self.storage_class = storage_class
+        self.checksum_algorithm = checksum_algorithm
+        self.copy_mode = copy_mode or COPY_MODE
+        self.buffer_pool = buffer_pool
+        self.stream_part_size = stream_part_size or STREAM_PART_SIZE
+        self.stream_concurrency = stream_concurrency or STREAM_CONCURRENCY
+        self.listed_changes = listed_changes  # None unless copying conditionally.
+        self.destination_conditions = destination_conditions
+        self.rename_index = rename_index  # None unless detecting renames.
+        self.count_bytes = count_bytes  # For progress records.
+        self.destination_stats = dict((d, self.create_stats()) for d in self.destinations)
+        self.stats = self.destination_stats[self.destination]
+        self.unsynced_archived_keys = []
+        self.scheduler = scheduler
+        source_client_args = source_client_args or {'region_name': region}
+        destination_client_args = destination_client_args or {'region_name': region}
+        if client_pool is not None:
+            self.source_s3 = client_pool.get(source_client_args)
+            self.destination_s3 = client_pool.get(destination_client_args)
+        else:
+            self.source_s3 = boto3.client('s3', **source_client_args)
+            self.destination_s3 = boto3.client('s3', **destination_client_args)
+        if scheduler is not None:
+            self.source_s3 = scheduler.wrap(self.source_s3)
+            self.destination_s3 = scheduler.wrap(self.destination_s3)
+
+    def create_stats(self):
+        stats = {
+            'copied': 0,
+            'current': 0,
+            'archived': 0,
+            'incomparable': 0,
+            'restoreRequested': 0,
+            'restoreInProgress': 0
+        }
+        if self.copy_mode == 'stream':
+            stats['streamedBytes'] = 0
+        if self.listed_changes is not None:
+            stats['conditionallyCopied'] = 0
+            stats['changedSinceListed'] = 0
+        if self.rename_index is not None:
+            stats['renamed'] = 0
+            stats['renamedBytes'] = 0  # Not transferred from the source.
+        if self.count_bytes:
+            stats['scannedBytes'] = 0
+            stats['copiedBytes'] = 0
+        return stats
+
+    def client_for(self, bucket):
+        return self.source_s3 if bucket == self.source else self.destination_s3
+
+    def acquire_bandwidth(self, size):
+        # Waits for the bandwidth budget of the bucket pair, if any, before copying size bytes.
+        if self.scheduler is not None:
+            self.scheduler.acquire_bytes(size)
 
     def copy_redirect(self, key, target):
         logger.info(
             'Copying redirect: ' + key + ' from bucket: ' + self.source +
             ' to destination bucket: ' + self.destination
         )
-        self.s3.put_object(
-            Bucket=self.destination,
-            Key=key,
-            WebsiteRedirectLocation=target
-        )
+        args = {
+            'Bucket': self.destination,
+            'Key': key,
+            'WebsiteRedirectLocation': target
+        }
+        if self.storage_class is not None:
+            args['StorageClass'] = self.storage_class
+        self.destination_s3.put_object(**args)
+        self.stats['copied'] += 1
+
+    def copy_object(self, key, source_response=None, part_sizes=None):
+        if self.copy_mode == 'stream':
+            if source_response is None:
+                source_response = self.source_s3.head_object(Bucket=self.source, Key=key)
+            if part_sizes is None:
+                part_sizes = self.get_part_sizes(self.source, key, source_response)
+            self.stream_object(key, source_response, part_sizes)
+            self.stats['copied'] += 1
+            return
+
+        if self.compare_mode != 'etag' and source_response is not None:
+            if part_sizes is None:
+                part_sizes = self.get_part_sizes(self.source, key, source_response)
+            if part_sizes is not None:
+                self.copy_object_multipart(key, source_response, part_sizes)
+                self.stats['copied'] += 1
+                return
 
-    def copy_object(self, key):
         logger.info(
             'Copying key: ' + key + ' from bucket: ' + self.source +
             ' to destination bucket: ' + self.destination
         )
-        self.s3.copy_object(
-            CopySource={
+        if source_response is not None:
+            self.acquire_bandwidth(source_response.get('ContentLength', 0))
+        response = self.destination_s3.copy_object(**self.get_copy_args(key))
+        self.stats['copied'] += 1
+        self.cache_copy_checksums(key, response)
+
+    def get_copy_args(self, key):
+        args = {
+            'CopySource': {
                 'Bucket': self.source,
                 'Key': key
             },
-            Bucket=self.destination,
+            'Bucket': self.destination,
+            'Key': key,
+            'MetadataDirective': 'COPY',
+            'TaggingDirective': 'COPY'
+        }
+        if self.storage_class is not None:
+            args['StorageClass'] = self.storage_class
+        if self.checksum_algorithm is not None:
+            args['ChecksumAlgorithm'] = self.checksum_algorithm
+        return args
+
+    def cache_copy_checksums(self, key, response):
+        # Remember the new checksum, so the next comparison in this container doesn't need to fetch it.
+        result = response.get('CopyObjectResult', {})
+        checksums = extract_checksums(result)
+        if len(checksums) > 0 and 'ETag' in result:
+            cache_checksums(self.destination, key, result['ETag'], checksums)
+
+    def copy_listed_change(self, key):
+        # Returns False if the key changed since it was listed, so it needs another look.
+        source_entry, destination_entry = self.listed_changes[key]
+        args = self.get_copy_args(key)
+        args['CopySourceIfMatch'] = source_entry['ETag']
+        if self.destination_conditions:
+            if destination_entry is None:
+                args['IfNoneMatch'] = '*'
+            else:
+                args['IfMatch'] = destination_entry['ETag']
+
+        logger.info(
+            'Copying changed key: ' + key + ' from bucket: ' + self.source + ' to destination bucket: ' +
+            self.destination + ' without looking at it first.'
+        )
+        self.acquire_bandwidth(source_entry['Size'])
+        try:
+            response = self.destination_s3.copy_object(**args)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CHANGED_ERROR_CODES:
+                raise e
+            logger.info('Key: ' + key + ' changed since it was listed, looking at it again.')
+            self.stats['changedSinceListed'] += 1
+            return False
+
+        self.stats['copied'] += 1
+        self.stats['conditionallyCopied'] += 1
+        if self.count_bytes:
+            self.stats['scannedBytes'] += source_entry['Size']
+            self.stats['copiedBytes'] += source_entry['Size']
+        self.cache_copy_checksums(key, response)
+        return True
+
+    def copy_object_multipart(self, key, source_response, part_sizes, copy_source=None):
+        # copy_source: Where to copy the parts from, if not from the source key.
+        copy_source = copy_source or {
+            'Bucket': self.source,
+            'Key': key
+        }
+        logger.info(
+            'Copying key: ' + copy_source['Key'] + ' from bucket: ' + copy_source['Bucket'] + ' to: ' + key +
+            ' in destination bucket: ' + self.destination + ' as multipart object with ' + str(len(part_sizes)) +
+            ' parts.'
+        )
+
+        upload_id = self.destination_s3.create_multipart_upload(
+            **self.get_upload_args(key, source_response, self.get_checksum_algorithm(key, source_response))
+        )['UploadId']
+        try:
+            parts = []
+            offset = 0
+            for part_number, part_size in enumerate(part_sizes, 1):
+                self.acquire_bandwidth(part_size)
+                response = self.destination_s3.upload_part_copy(
+                    CopySource=copy_source,
+                    CopySourceRange='bytes=' + str(offset) + '-' + str(offset + part_size - 1),
+                    CopySourceIfMatch=source_response['ETag'],  # Fail if the source changes while we copy.
+                    Bucket=self.destination,
+                    Key=key,
+                    PartNumber=part_number,
+                    UploadId=upload_id
+                )
+                part = extract_checksums(response['CopyPartResult'])
+                part['ETag'] = response['CopyPartResult']['ETag']
+                part['PartNumber'] = part_number
+                parts.append(part)
+                offset += part_size
+
+            self.destination_s3.complete_multipart_upload(
+                Bucket=self.destination,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self.destination_s3.abort_multipart_upload(Bucket=self.destination, Key=key, UploadId=upload_id)
+            raise
+
+    def get_upload_args(self, key, source_response, checksum_algorithm):
+        # Uploads can't copy metadata and tags from the source, so we carry them over explicitly.
+        args = {
+            'Bucket': self.destination,
+            'Key': key
+        }
+        if self.storage_class is not None:
+            args['StorageClass'] = self.storage_class
+        if checksum_algorithm is not None:
+            args['ChecksumAlgorithm'] = checksum_algorithm
+        for metadata_key in METADATA_KEYS:
+            if metadata_key in source_response:
+                args[metadata_key] = source_response[metadata_key]
+        tag_set = self.source_s3.get_object_tagging(Bucket=self.source, Key=key).get('TagSet', [])
+        if len(tag_set) > 0:
+            args['Tagging'] = urlencode([(t['Key'].encode('utf-8'), t['Value'].encode('utf-8')) for t in tag_set])
+        return args
+
+    def read_range(self, key, etag, offset, buffer):
+        # Fill the buffer from the source object, starting at offset. Returns the MD5 digest and CRC32 of the range.
+        size = len(buffer)
+        digest = md5()
+        crc = 0
+        if size == 0:
+            return digest.digest(), crc
+
+        response = self.source_s3.get_object(
+            Bucket=self.source,
             Key=key,
-            MetadataDirective='COPY',
-            TaggingDirective='COPY'
+            Range='bytes=' + str(offset) + '-' + str(offset + size - 1),
+            IfMatch=etag  # Fail if the source changes while we copy.
+        )
+        body = response['Body']
+        position = 0
+        while position < size:
+            chunk = body.read(min(STREAM_READ_SIZE, size - position))
+            if len(chunk) == 0:
+                raise IOError('Key: ' + key + ' ended after ' + str(offset + position) + ' bytes, expected more.')
+            buffer[position:position + len(chunk)] = chunk
+            digest.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            position += len(chunk)
+        return digest.digest(), crc
+
+    def stream_part(self, key, source_response, upload_id, part_number, offset, size, checksum_algorithm):
+        self.acquire_bandwidth(size)  # Before taking a buffer, so waiting doesn't hold on to memory.
+        buffer = self.buffer_pool.acquire(size)
+        try:
+            digest, crc = self.read_range(key, source_response['ETag'], offset, buffer)
+            args = {
+                'Bucket': self.destination,
+                'Key': key,
+                'UploadId': upload_id,
+                'PartNumber': part_number,
+                'Body': buffer,
+                'ContentMD5': b64encode(digest)  # The destination rejects the part if it got corrupted on the way.
+            }
+            if checksum_algorithm is not None:
+                args['Checksum' + checksum_algorithm] = encode_crc32(crc)
+            response = self.destination_s3.upload_part(**args)
+        finally:
+            self.buffer_pool.release(buffer)
+
+        part = {
+            'ETag': response['ETag'],
+            'PartNumber': part_number
+        }
+        if checksum_algorithm is not None:
+            part['Checksum' + checksum_algorithm] = args['Checksum' + checksum_algorithm]
+        return part, digest
+
+    def stream_parts(self, key, source_response, upload_id, part_sizes, checksum_algorithm):
+        # Transfer parts in up to stream_concurrency threads. Returns a list of (part, MD5 digest) tuples.
+        results = [None] * len(part_sizes)
+        errors = []
+        part_queue = Queue()
+        offset = 0
+        for i, part_size in enumerate(part_sizes):
+            part_queue.put((i, offset, part_size))
+            offset += part_size
+
+        def transfer_parts():
+            while len(errors) == 0:
+                try:
+                    i, part_offset, part_size = part_queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[i] = self.stream_part(
+                        key, source_response, upload_id, i + 1, part_offset, part_size, checksum_algorithm
+                    )
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [Thread(target=transfer_parts) for _ in range(min(self.stream_concurrency, len(part_sizes)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+    def stream_object(self, key, source_response, part_sizes):
+        size = source_response.get('ContentLength', 0)
+        etag = source_response['ETag']
+        checksum_algorithm = None
+        if self.checksum_algorithm is not None or self.compare_mode == 'checksum':
+            checksum_algorithm = STREAM_CHECKSUM_ALGORITHM
+        verify_etag = has_md5_etag(source_response)
+        if part_sizes is not None and max(part_sizes) > self.buffer_pool.memory_limit:
+            logger.info('Parts of key: ' + key + ' are too large for the stream buffers, using a different layout.')
+            part_sizes = None
+            verify_etag = False
+        args = self.get_upload_args(key, source_response, checksum_algorithm)
+
+        if part_sizes is None and size <= self.stream_part_size:
+            logger.info(
+                'Streaming key: ' + key + ' from bucket: ' + self.source + ' to destination bucket: ' +
+                self.destination
+            )
+            buffer = self.buffer_pool.acquire(size)
+            try:
+                digest, crc = self.read_range(key, etag, 0, buffer)
+                if verify_etag and '"' + digest.encode('hex') + '"' != etag:
+                    raise IOError('Key: ' + key + ' from bucket: ' + self.source + ' does not match its ETag.')
+                args['Body'] = buffer
+                args['ContentMD5'] = b64encode(digest)
+                if checksum_algorithm is not None:
+                    args['Checksum' + checksum_algorithm] = encode_crc32(crc)
+                self.destination_s3.put_object(**args)
+            finally:
+                self.buffer_pool.release(buffer)
+            self.stats['streamedBytes'] += size
+            return
+
+        if part_sizes is None:
+            part_sizes = split_parts(size, self.stream_part_size)
+            verify_etag = False  # Only the ETag of the same part layout can be verified.
+        logger.info(
+            'Streaming key: ' + key + ' from bucket: ' + self.source + ' to destination bucket: ' + self.destination +
+            ' as multipart object with ' + str(len(part_sizes)) + ' parts.'
         )
 
+        upload_id = self.destination_s3.create_multipart_upload(**args)['UploadId']
+        try:
+            results = self.stream_parts(key, source_response, upload_id, part_sizes, checksum_algorithm)
+            if verify_etag:
+                combined_digest = md5(''.join(digest for _, digest in results)).hexdigest()
+                if '"' + combined_digest + '-' + str(len(part_sizes)) + '"' != etag:
+                    raise IOError('Key: ' + key + ' from bucket: ' + self.source + ' does not match its ETag.')
+            self.destination_s3.complete_multipart_upload(
+                Bucket=self.destination,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': [part for part, _ in results]}
+            )
+        except Exception:
+            self.destination_s3.abort_multipart_upload(Bucket=self.destination, Key=key, UploadId=upload_id)
+            raise
+        self.stats['streamedBytes'] += size
+
+    def get_part_sizes(self, bucket, key, response):
+        # Reconstruct the part layout of a multipart object. Returns None for non-multipart objects.
+        part_count = get_etag_part_count(response.get('ETag', None))
+        size = response.get('ContentLength', 0)
+        if part_count == 0 or size == 0:
+            return None
+
+        s3 = self.client_for(bucket)
+        first_part_size = s3.head_object(
+            Bucket=bucket, Key=key, PartNumber=1, IfMatch=response['ETag']
+        )['ContentLength']
+        if part_count == 1:
+            return [first_part_size]
+
+        # Most tools upload equally sized parts with a smaller last part. Check the last part to confirm.
+        part_sizes = [first_part_size] * (part_count - 1)
+        part_sizes.append(size - first_part_size * (part_count - 1))
+        last_part_size = s3.head_object(
+            Bucket=bucket, Key=key, PartNumber=part_count, IfMatch=response['ETag']
+        )['ContentLength']
+        if last_part_size != part_sizes[-1]:
+            logger.info('Key: ' + key + ' in bucket: ' + bucket + ' has irregular part sizes, fetching all of them.')
+            part_sizes = [first_part_size]
+            for part_number in range(2, part_count + 1):
+                part_sizes.append(s3.head_object(
+                    Bucket=bucket, Key=key, PartNumber=part_number, IfMatch=response['ETag']
+                )['ContentLength'])
+
+        return part_sizes
+
+    def get_checksums(self, bucket, key, etag=None):
+        if etag is not None:
+            checksums = get_cached_checksums(bucket, key, etag)
+            if checksums is not None:
+                return checksums
+
+        response = self.client_for(bucket).get_object_attributes(Bucket=bucket, Key=key, ObjectAttributes=['Checksum'])
+        checksums = extract_checksums(response.get('Checksum', {}))
+        if etag is not None:
+            cache_checksums(bucket, key, etag, checksums)
+        return checksums
+
+    def get_checksum_algorithm(self, key, source_response):
+        # The configured algorithm, or in 'checksum' compare mode the source's. CopyObject keeps the source's algorithm
+        # on its own, multipart uploads need to be told.
+        if self.checksum_algorithm is not None or self.compare_mode != 'checksum':
+            return self.checksum_algorithm
+        source_checksums = self.get_checksums(self.source, key, source_response.get('ETag', None))
+        for algorithm in CHECKSUM_ALGORITHMS:
+            if algorithm in source_checksums:
+                return algorithm[len('Checksum'):]
+        return None
+
+    def checksums_differ(self, key, source_etag, destination_etag):
+        # Returns True or False if source and destination have a comparable checksum, None otherwise.
+        source_checksums = self.get_checksums(self.source, key, source_etag)
+        if len(source_checksums) == 0:
+            return None  # No need to ask for the destination's checksums.
+        destination_checksums = self.get_checksums(self.destination, key, destination_etag)
+
+        for algorithm in CHECKSUM_ALGORITHMS:
+            if algorithm in source_checksums and algorithm in destination_checksums:
+                source_checksum = source_checksums[algorithm]
+                destination_checksum = destination_checksums[algorithm]
+                # Checksums of multipart objects look like '<checksum of part checksums>-<number of parts>'. They
+                # can't be compared to full object checksums.
+                if ('-' in source_checksum) != ('-' in destination_checksum):
+                    continue
+                logger.info('Comparing key: ' + key + ' using: ' + algorithm)
+                return source_checksum != destination_checksum
+
+        return None
+
+    def encrypted_contents_differ(self, key, source_etag, destination_etag):
+        # ETags that aren't MD5 digests differ between copies of the same content. Returns True or False by checksum,
+        # None if we can't tell.
+        differ = self.checksums_differ(key, source_etag, destination_etag)
+        if differ is not None:
+            return differ
+        if len(self.get_checksums(self.source, key, source_etag)) > 0:
+            return True  # The copy gets the source's checksum, so the next run can compare them.
+        return None
+
+    def contents_differ(self, key, source_response, destination_response):
+        # Returns a tuple: (True if the content differs, None if we can't tell, source part sizes if we already know
+        # them).
+        source_etag = source_response.get('ETag', None)
+        destination_etag = destination_response.get('ETag', None)
+        if source_etag == destination_etag:
+            return False, None
+        if self.compare_mode == 'etag':
+            return True, None
+        if source_response.get('ContentLength', None) != destination_response.get('ContentLength', None):
+            return True, None
+
+        if self.compare_mode == 'checksum':
+            differ = self.checksums_differ(key, source_etag, destination_etag)
+            if differ is not None:
+                return differ, None
+
+        if not (has_md5_etag(source_response) and has_md5_etag(destination_response)):
+            return self.encrypted_contents_differ(key, source_etag, destination_etag), None
+
+        source_part_count = get_etag_part_count(source_etag)
+        destination_part_count = get_etag_part_count(destination_etag)
+        if source_part_count == 0 and destination_part_count == 0:
+            return True, None  # Two plain MD5 digests: The content differs.
+
+        # At least one side is multipart. ETags are only comparable if both sides use the same part layout.
+        source_part_sizes = self.get_part_sizes(self.source, key, source_response)
+        destination_part_sizes = self.get_part_sizes(self.destination, key, destination_response)
+        if source_part_sizes == destination_part_sizes:
+            return True, source_part_sizes
+
+        # Part layouts differ. Try full object checksums, if both sides have a common one.
+        if self.compare_mode != 'checksum':  # Otherwise, we tried that already.
+            differ = self.checksums_differ(key, source_etag, destination_etag)
+            if differ is not None:
+                return differ, source_part_sizes
+
+        # Not comparable. Copying once with the source part layout makes the ETags comparable for future runs.
+        logger.info('Key: ' + key + ' has incomparable ETags, copying it with the source part layout.')
+        return True, source_part_sizes
+
+    def skip_archived(self, key):
+        logger.info('Key: ' + key + ' from bucket: ' + self.source + ' is archived, skipping it.')
+        self.stats['archived'] += 1
+        if len(self.unsynced_archived_keys) < MAX_REPORTED_KEYS:
+            self.unsynced_archived_keys.append(key)
+
+    def restore_object(self, key, source_response):
+        if 'ongoing-request="true"' in source_response.get('Restore', ''):
+            logger.info('Key: ' + key + ' from bucket: ' + self.source + ' is still being restored.')
+            self.stats['restoreInProgress'] += 1
+            return
+
+        logger.info('Requesting restore for key: ' + key + ' from bucket: ' + self.source)
+        if 'ArchiveStatus' in source_response:  # INTELLIGENT_TIERING restores don't take any parameters.
+            restore_request = {}
+        else:
+            restore_request = {
+                'Days': RESTORE_DAYS,
+                'GlacierJobParameters': {
+                    'Tier': RESTORE_TIER
+                }
+            }
+        try:
+            self.source_s3.restore_object(Bucket=self.source, Key=key, RestoreRequest=restore_request)
+            self.stats['restoreRequested'] += 1
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'RestoreAlreadyInProgress':
+                self.stats['restoreInProgress'] += 1
+            else:
+                raise e
+
+    def copy_renamed(self, key, source_response, part_sizes=None):
+        # Returns True if the key was copied from an orphan with the same content inside the destination bucket.
+        size = source_response.get('ContentLength', 0)
+        orphan = self.rename_index.find(source_response['ETag'], size)
+        if orphan is None or orphan == key:
+            return False
+
+        try:
+            if get_etag_part_count(source_response['ETag']) > 0:  # Keep the part layout, and with it the ETag.
+                if part_sizes is None:
+                    part_sizes = self.get_part_sizes(self.source, key, source_response)
+                self.copy_object_multipart(
+                    key, source_response, part_sizes, copy_source={'Bucket': self.destination, 'Key': orphan}
+                )
+            elif size <= MAX_COPY_OBJECT_SIZE:
+                logger.info(
+                    'Copying key: ' + key + ' from orphan: ' + orphan + ' with the same content in destination ' +
+                    'bucket: ' + self.destination
+                )
+                args = self.get_upload_args(key, source_response, self.checksum_algorithm)
+                args.update({
+                    'CopySource': {
+                        'Bucket': self.destination,
+                        'Key': orphan
+                    },
+                    'CopySourceIfMatch': source_response['ETag'],
+                    'MetadataDirective': 'REPLACE',  # The orphan's metadata and tags may differ from the source.
+                    'TaggingDirective': 'REPLACE'
+                })
+                self.acquire_bandwidth(size)
+                self.cache_copy_checksums(key, self.destination_s3.copy_object(**args))
+            else:
+                return False
+        except ClientError as e:
+            if e.response['Error']['Code'] not in RENAME_ERROR_CODES:
+                raise e
+            logger.info('Orphan: ' + orphan + ' is gone or changed, copying key: ' + key + ' from the source.')
+            return False
+
+        self.stats['copied'] += 1
+        self.stats['renamed'] += 1
+        self.stats['renamedBytes'] += size
+        return True
+
+    def copy_or_restore(self, key, source_response, part_sizes=None):
+        if not is_archived(source_response):
+            if self.rename_index is not None and self.copy_renamed(key, source_response, part_sizes):
+                return
+            self.copy_object(key, source_response, part_sizes)
+        elif self.archive_mode == 'restore':
+            self.restore_object(key, source_response)
+        else:
+            self.skip_archived(key)
+
+    def sync_key(self, key):
+        if self.listed_changes is not None and key in self.listed_changes and self.copy_listed_change(key):
+            return
+
+        # The source is asked only once, no matter how many destinations there are.
+        source_response = None
+        for destination in self.destinations:
+            self.destination = destination
+            self.stats = self.destination_stats[destination]
+            copied = self.stats['copied']
+            source_response = self.sync_key_to_destination(key, source_response)
+            if self.count_bytes and source_response is not None:
+                size = source_response.get('ContentLength', 0)
+                self.stats['scannedBytes'] += size
+                if self.stats['copied'] > copied:
+                    self.stats['copiedBytes'] += size
+
+    def sync_key_to_destination(self, key, source_response=None):
+        # Returns the source HEAD response, if there was one, for the next destination.
+        if self.archive_mode == 'skip' and key in self.archived_keys:  # No need to ask S3 what we already know.
+            self.skip_archived(key)
+            return source_response
+
+        if source_response is None:
+            source_response = self.source_s3.head_object(Bucket=self.source, Key=key)
+        try:
+            destination_response = self.destination_s3.head_object(Bucket=self.destination, Key=key)
+        except ClientError as e:
+            if int(e.response['Error']['Code']) == 404:  # 404 = we need to copy this.
+                if 'WebsiteRedirectLocation' in source_response:
+                    self.copy_redirect(key, source_response['WebsiteRedirectLocation'])
+                else:
+                    self.copy_or_restore(key, source_response)
+                return source_response
+            else:  # All other return codes are unexpected.
+                raise e
+
+        if 'WebsiteRedirectLocation' in source_response:
+            if (
+                source_response['WebsiteRedirectLocation'] !=
+                destination_response.get('WebsiteRedirectLocation', None)
+            ):
+                self.copy_redirect(key, source_response['WebsiteRedirectLocation'])
+            else:
+                self.stats['current'] += 1
+            return source_response
+
+        differ, part_sizes = self.contents_differ(key, source_response, destination_response)
+        if differ is None:
+            logger.warning(
+                'Key: ' + key + ' from bucket: ' + self.source + ' has neither an MD5 ETag nor a checksum to compare ' +
+                'to destination bucket: ' + self.destination + ', skipping it.'
+            )
+            self.stats['incomparable'] += 1
+            return source_response
+        if differ:
+            self.copy_or_restore(key, source_response, part_sizes)
+            return source_response
+
+        source_metadata = collect_metadata(source_response)
+        destination_metadata = collect_metadata(destination_response)
+        if source_metadata == destination_metadata:
+            logger.info(
+                'Key: ' + key + ' from bucket: ' + self.source +
+                ' is already current in destination bucket: ' + self.destination
+            )
+            self.stats['current'] += 1
+        else:
+            self.copy_or_restore(key, source_response)
+        return source_response
+
     def run(self):
         while not self.job_queue.empty():
             try:
@@ -119,50 +1019,48 @@ class KeySynchronizer(Thread):
             except Empty:
                 return
 
-            source_response = self.s3.head_object(Bucket=self.source, Key=key)
             try:
-                destination_response = self.s3.head_object(Bucket=self.destination, Key=key)
+                self.sync_key(key)
             except ClientError as e:
-                if int(e.response['Error']['Code']) == 404:  # 404 = we need to copy this.
-                    if 'WebsiteRedirectLocation' in source_response:
-                        self.copy_redirect(key, source_response['WebsiteRedirectLocation'])
-                    else:
-                        self.copy_object(key)
-                    continue
-                else:  # All other return codes are unexpected.
+                # Objects in archive tiers we couldn't see coming must not fail the whole batch.
+                if e.response['Error']['Code'] == 'InvalidObjectState':
+                    self.skip_archived(key)
+                else:
                     raise e
 
-            if 'WebsiteRedirectLocation' in source_response:
-                if (
-                    source_response['WebsiteRedirectLocation'] !=
-                    destination_response.get('WebsiteRedirectLocation', None)
-                ):
-                    self.copy_redirect(key, source_response['WebsiteRedirectLocation'])
-                continue
-
-            source_etag = source_response.get('ETag', None)
-            destination_etag = destination_response.get('ETag', None)
-            if source_etag != destination_etag:
-                self.copy_object(key)
-                continue
-
-            source_metadata = collect_metadata(source_response)
-            destination_metadata = collect_metadata(destination_response)
-            if source_metadata == destination_metadata:
-                logger.info(
-                    'Key: ' + key + ' from bucket: ' + self.source +
-                    ' is already current in destination bucket: ' + self.destination
-                )
-                continue
-            else:
-                self.copy_object(key)
-
 
 # Functions
 
-def sync_keys(source=None, destination=None, region=None, keys=None):
-    job_queue = Queue()
+def sync_keys(
+    source=None, destination=None, region=None, keys=None, compare_mode=None, archive_mode=None, archived_keys=None,
+    storage_class=None, checksum_algorithm=None, scheduler=None, source_client_args=None, destination_client_args=None,
+    copy_mode=None, stream_part_size=None, stream_concurrency=None, stream_memory_limit=None, client_pool=None,
+    conditional_copy=None, rename_index=None, count_bytes=False
+):
+    if scheduler is None:
+        job_queue = Queue()
+    else:
+        job_queue = scheduler.create_queue()
     worker_threads = []
+    archived_keys = set(archived_keys or [])
+    buffer_pool = BufferPool(stream_memory_limit or STREAM_MEMORY_LIMIT)  # Shared by all threads.
+
+    listed_changes = None
+    destination_conditions = False
+    if conditional_copy:
+        if (copy_mode or COPY_MODE) != 'server' or isinstance(destination, list):
+            logger.warning('Conditional copies need server copy mode and a single destination, copying as usual.')
+        else:
+            source_s3 = create_list_client(source_client_args or {'region_name': region}, client_pool)
+            destination_s3 = create_list_client(destination_client_args or {'region_name': region}, client_pool)
+            listed_changes = find_listed_changes(
+                source_s3, destination_s3, source, destination, keys, archived_keys, compare_mode or COMPARE_MODE
+            )
+            destination_conditions = supports_conditional_copy(destination_s3)
+            logger.info(
+                'The listings show ' + str(len(listed_changes)) + ' of ' + str(len(keys)) +
+                ' keys to be changed or missing in bucket: ' + destination
+            )
 
     for i in range(THREAD_PARALLELISM):
         worker_threads.append(KeySynchronizer(
@@ -170,6 +1068,23 @@ def sync_keys(source=None, destination=None, region=None, keys=None):
             source=source,
             destination=destination,
             region=region,
+            compare_mode=compare_mode,
+            archive_mode=archive_mode,
+            archived_keys=archived_keys,
+            storage_class=storage_class,
+            checksum_algorithm=checksum_algorithm,
+            scheduler=scheduler,
+            source_client_args=source_client_args,
+            destination_client_args=destination_client_args,
+            copy_mode=copy_mode,
+            buffer_pool=buffer_pool,
+            stream_part_size=stream_part_size,
+            stream_concurrency=stream_concurrency,
+            client_pool=client_pool,
+            listed_changes=listed_changes,
+            destination_conditions=destination_conditions,
+            rename_index=rename_index,
+            count_bytes=count_bytes
         ))
 
     for key in keys:
@@ -178,7 +1093,7 @@ def sync_keys(source=None, destination=None, region=None, keys=None):
 
     logger.info(
         'Starting ' + str(THREAD_PARALLELISM) + ' key synchronization processes for buckets: ' + source +
-        ' and ' + destination + '.'
+        ' and ' + format_bucket(destination) + '.'
     )
     for t in worker_threads:
         t.start()
@@ -186,19 +1101,130 @@ def sync_keys(source=None, destination=None, region=None, keys=None):
     for t in worker_threads:
         t.join()
 
+    result = {}
+    destinations = {}
+    unsynced_archived_keys = []
+    for t in worker_threads:
+        for bucket, stats in t.destination_stats.items():
+            bucket_result = destinations.setdefault(bucket, {})
+            for stat, value in stats.items():
+                result[stat] = result.get(stat, 0) + value
+                bucket_result[stat] = bucket_result.get(stat, 0) + value
+        unsynced_archived_keys += t.unsynced_archived_keys
+    if len(unsynced_archived_keys) > 0:
+        logger.warning(
+            'Skipped ' + str(result['archived']) + ' archived keys, starting with: ' +
+            ', '.join(sorted(set(unsynced_archived_keys))[:MAX_REPORTED_KEYS])
+        )
+    if len(destinations) > 1:
+        result['destinations'] = destinations
+    if scheduler is not None:
+        result['requestRates'] = scheduler.report()
+
+    return result
 
-def handler(event, context):
-    assert(isinstance(event, dict))
 
+def sync_event_keys(event, function_region, scheduler, client_pool=None):
     source = event['source']
     destination = event['destination']
     keys = event['listResult']['keys']
 
-    function_region = context.invoked_function_arn.split(':')[3]
     region = event.get('sourceRegion', function_region)
+    compare_mode = event.get('compareMode', COMPARE_MODE)
+    assert(compare_mode in COMPARE_MODES)
+    archive_mode = event.get('archiveMode', ARCHIVE_MODE)
+    assert(archive_mode in ARCHIVE_MODES)
+    storage_class = event.get('storageClass', None)
+    checksum_algorithm = event.get('checksumAlgorithm', None)
+    archived_keys = event['listResult'].get('archivedKeys', [])
+    copy_mode = event.get('copyMode', COPY_MODE)
+    assert(copy_mode in COPY_MODES)
+    rename_index = None
+    if 'renameIndexResult' in event and not isinstance(destination, list):
+        rename_index = load_rename_index(event['renameIndexResult'], function_region)
+    count_bytes = 'progressTable' in event and get_sync_start_time(event) is not None
+
+    logger.info(
+        'Copying ' + str(len(keys)) + ' keys from bucket: ' + source + ' to bucket: ' + format_bucket(destination)
+    )
+
+    result = sync_keys(
+        source=source,
+        destination=destination,
+        keys=keys,
+        region=region,
+        compare_mode=compare_mode,
+        archive_mode=archive_mode,
+        archived_keys=archived_keys,
+        storage_class=storage_class,
+        checksum_algorithm=checksum_algorithm,
+        scheduler=scheduler,
+        source_client_args=get_s3_client_args(event, 'source', function_region),
+        destination_client_args=get_s3_client_args(event, 'destination', function_region),
+        copy_mode=copy_mode,
+        stream_part_size=event.get('streamPartSize', STREAM_PART_SIZE),
+        stream_concurrency=event.get('streamConcurrency', STREAM_CONCURRENCY),
+        stream_memory_limit=event.get('streamMemoryLimit', STREAM_MEMORY_LIMIT),
+        client_pool=client_pool,
+        conditional_copy=event.get('conditionalCopy', CONDITIONAL_COPY),
+        rename_index=rename_index,
+        count_bytes=count_bytes
+    )
+
+    return result
+
+
+def sync_jobs(event, function_region):
+    # A pack of small bucket pairs (see plan_jobs), one after the other with the same clients and request scheduler.
+    scheduler = create_scheduler(event)
+    client_pool = ClientPool()
+    options = dict((k, v) for k, v in event.items() if k != 'jobs')
+    result = {
+        'jobs': []
+    }
+
+    for job in event['jobs']:
+        job_event = dict(options, **job)
+        scheduler.set_budget(create_rate_budget(job_event))
+        job_event['listResult'] = list_small_bucket(
+            client_pool.get(get_s3_client_args(job_event, 'source', function_region)), job_event, 'source'
+        )
+        job_result = sync_event_keys(job_event, function_region, scheduler, client_pool)
+        job_result.pop('requestRates', None)
+        merge_counts(result, job_result)
+        job_result.update(dict((k, job[k]) for k in JOB_ATTRIBUTES if k in job))
+        result['jobs'].append(job_result)
+
+    result['requestRates'] = scheduler.report()
+    return result
 
-    logger.info('Copying ' + str(len(keys)) + ' keys from bucket: ' + source + ' to bucket: ' + destination)
 
-    sync_keys(source=source, destination=destination, keys=keys, region=region)
+def sync_lane(event, function_region, lane):
+    event = select_lane_keys(event, lane)
+    result = sync_event_keys(event, function_region, create_scheduler(event))
+    counts = dict((k, result[k]) for k in PROGRESS_COUNTS if k in result)
+    counts['sourceKeys'] = len(event['listResult']['keys'])
+    publish_progress(event, function_region, counts)
+    return result
 
-    return
+
+@profiled
+def handler(event, context):
+    assert(isinstance(event, dict))
+
+    function_region = context.invoked_function_arn.split(':')[3]
+    if 'jobs' in event:
+        return sync_jobs(event, function_region)
+    return sync_lane(event, function_region, 'small')
+
+
+@profiled
+def large_keys_handler(event, context):
+    assert(isinstance(event, dict))
+
+    function_region = context.invoked_function_arn.split(':')[3]
+    event = dict({
+        'streamMemoryLimit': LARGE_STREAM_MEMORY_LIMIT,
+        'streamConcurrency': LARGE_STREAM_CONCURRENCY
+    }, **event)
+    return sync_lane(event, function_region, 'large')
@@ -18,31 +18,92 @@
 # Timeout: 300
 # Policies:
 #     - AmazonS3FullAccess
+#     - Version: '2012-10-17'  # Roles to assume for the source or destination, see shared/clients.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action: 'sts:AssumeRole'
+#               Resource: '*'
+#     - Version: '2012-10-17'  # Rate budgets and progress records, see shared/rate_budget.py and shared/progress.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action:
+#                   - 'dynamodb:GetItem'
+#                   - 'dynamodb:PutItem'
+#                   - 'dynamodb:UpdateItem'
+#               Resource: '*'
 # ---
 #
 # Input event: A dict like:
 # {
 #     'source': 'source-bucket',
 #     'sourceRegion': 'eu-west-1',
-#     'destination': 'destination-bucket',
+#     'destination': 'destination-bucket',  # Or a list of destination buckets in the same region.
 #     'destinationRegion': 'eu-west-1',
 #     'keys': [ ... ]
 # }
 #
+# Source and destination can have their own role and endpoint, see shared/clients.py.
+#
+# With a list of destination buckets, the keys are those of all destinations (see shared/listing.py), so each key is
+# looked up once in the source bucket. Orphans are deleted from the destinations that have them.
+#
+# Instead of 'source', 'destination' and 'listResult', the event can have a pack of 'jobs' (see plan_jobs), each with
+# a 'source', 'destination' and optional 'prefix'. Both buckets are small enough to be listed completely here, so only
+# destination keys missing from the source listing are checked with a HEAD request before they are deleted.
+#
+# For versioned buckets (see list_bucket), orphaned keys get a delete marker by default, mirroring the delete marker
+# in the source. If 'mirrorDeleteMarkers' is false, all versions of orphaned keys are deleted instead. If
+# 'pruneNoncurrentVersions' is true, noncurrent destination versions are deleted, too.
+#
+# If the event has a complete 'keyFilterResult' (see build_key_filter), keys that are not in the Bloom filter of source
+# keys are deleted right away. Only keys that may be in the source bucket, and keys listed in 'recentKeys' because
+# they were modified after the filter was built, are confirmed with a HEAD request first.
+#
+# If the event has a complete 'renameIndexResult' (see build_rename_index), orphans in the index are left alone, so
+# copy_keys can copy renamed keys from them. After both branches are done, the state machine invokes this function with
+# a 'renameCleanupResult' ({'position': 0, 'done': false} at first) instead of a 'listResult' to delete them, a batch
+# at a time, after confirming with a HEAD request that the source bucket doesn't have them by now.
+#
+# Requests are scheduled across prefix partitions, and within the request rate budget of the bucket pair if there
+# is one, see shared/request_scheduler.py and shared/rate_budget.py for the options.
+#
+# With a 'progressTable', the keys looked at and the number of deleted keys are added to the progress record of the
+# sync, see shared/progress.py.
+#
+# Output: A dict with the number of deleted keys, the number of keys deleted without a HEAD request and of key filter
+# false positives, and the request rates achieved per partition. With several destinations, 'destinations' has the
+# number of deleted keys per destination bucket. With a rename index, 'deferred' has the number of orphans left to be
+# deleted after both branches are done.
+#
 
 # Imports
 
 import logging
 import boto3
-from threading import Thread
+import os
+from threading import Thread, Lock
 from botocore.exceptions import ClientError
 from Queue import Queue, Empty
+import json
+from shared.bloom_filter import ScalableBloomFilter
+from shared.clients import ClientPool, get_s3_client_args
+from shared.listing import format_bucket, list_small_bucket
+from shared.profiling import profiled
+from shared.progress import publish_progress
+from shared.rate_budget import create_rate_budget
+from shared.rename_index import load_rename_index
+from shared.request_scheduler import create_scheduler
 
 
 # Constants
 
 DEBUG = False
-THREAD_PARALLELISM = 10
+THREAD_PARALLELISM = int(os.environ.get('THREAD_PARALLELISM', '10'))  # Set by deployments, see fab tune.
+MAX_DELETE_BATCH_SIZE = 1000  # Maximum number of keys for s3.delete_objects().
+JOB_ATTRIBUTES = ['source', 'destination', 'prefix']  # Identify the bucket pair of a job in its result.
+RENAME_CLEANUP_BATCH_SIZE = 1000  # Indexed orphans deleted per invocation.
 
 
 # Globals
@@ -53,16 +114,88 @@ if DEBUG:
 else:
     logger.setLevel(logging.INFO)
 
+key_filter_cache = {}  # Filters don't change once they are complete. Holds the last one used by this container.
+key_filter_cache_lock = Lock()
+
+
+# Utility functions
+
+def delete_versions(s3, bucket, versions):
+    # Permanently delete a list of (key, version_id) tuples in batches.
+    for i in range(0, len(versions), MAX_DELETE_BATCH_SIZE):
+        batch = versions[i:i + MAX_DELETE_BATCH_SIZE]
+        response = s3.delete_objects(
+            Bucket=bucket,
+            Delete={
+                'Objects': [{'Key': k, 'VersionId': v} for k, v in batch],
+                'Quiet': True
+            }
+        )
+        errors = response.get('Errors', [])
+        if len(errors) > 0:
+            raise Exception(
+                'Failed to delete ' + str(len(errors)) + ' versions from bucket: ' + bucket + ', first error: ' +
+                json.dumps(errors[0])
+            )
+
+
+def load_key_filter(key_filter_result, region):
+    location = (key_filter_result['bucket'], key_filter_result['key'])
+    with key_filter_cache_lock:
+        if location not in key_filter_cache:
+            s3 = boto3.client('s3', region_name=region)
+            response = s3.get_object(Bucket=location[0], Key=location[1])
+            key_filter_cache.clear()
+            key_filter_cache[location] = ScalableBloomFilter.from_bytes(response['Body'].read())
+        return key_filter_cache[location]
+
 
 # Classes
 
 class ObsoleteKeyDeleter(Thread):
-    def __init__(self, job_queue=None, source=None, destination=None, region=None):
+    def __init__(
+        self, job_queue=None, source=None, destination=None, region=None, current_versions=None,
+        noncurrent_versions=None, deleted_keys=None, deleted_versions=None, scheduler=None, key_filter=None,
+        recent_keys=None, source_client_args=None, destination_client_args=None, partial_keys=None, client_pool=None
+    ):
         super(ObsoleteKeyDeleter, self).__init__()
         self.job_queue = job_queue
         self.source = source
-        self.destination = destination
-        self.s3 = boto3.client('s3', region_name=region)
+        self.destinations = destination if isinstance(destination, list) else [destination]
+        self.partial_keys = partial_keys or {}  # Keys only some of the destinations have: {key: [indexes]}.
+        self.current_versions = current_versions  # Only set if orphans should be deleted with all their versions.
+        self.noncurrent_versions = noncurrent_versions or {}
+        self.deleted_keys = deleted_keys if deleted_keys is not None else []
+        # (destination, key, version_id) tuples, deleted in batches once all threads are done.
+        self.deleted_versions = deleted_versions if deleted_versions is not None else []
+        self.key_filter = key_filter
+        self.recent_keys = recent_keys or set()
+        self.stats = {
+            'deletedWithoutHead': 0,
+            'keyFilterFalsePositives': 0
+        }
+        source_client_args = source_client_args or {'region_name': region}
+        destination_client_args = destination_client_args or {'region_name': region}
+        if client_pool is not None:
+            self.source_s3 = client_pool.get(source_client_args)
+            self.destination_s3 = client_pool.get(destination_client_args)
+        else:
+            self.source_s3 = boto3.client('s3', **source_client_args)
+            self.destination_s3 = boto3.client('s3', **destination_client_args)
+        if scheduler is not None:
+            self.source_s3 = scheduler.wrap(self.source_s3)
+            self.destination_s3 = scheduler.wrap(self.destination_s3)
+
+    def delete_object(self, key):
+        for i in self.partial_keys.get(key, range(len(self.destinations))):
+            destination = self.destinations[i]
+            if self.current_versions is None:
+                self.destination_s3.delete_object(Bucket=destination, Key=key)
+            else:
+                versions = [self.current_versions[key]] + self.noncurrent_versions.get(key, [])
+                logger.info('Queuing ' + str(len(versions)) + ' versions of orphaned key: ' + key + ' for deletion.')
+                self.deleted_versions.extend((destination, key, v) for v in versions)
+            self.deleted_keys.append((destination, key))
 
     def run(self):
         while not self.job_queue.empty():
@@ -71,22 +204,40 @@ class ObsoleteKeyDeleter(Thread):
             except Empty:
                 return
 
+            use_key_filter = self.key_filter is not None and key not in self.recent_keys
+            if use_key_filter and key not in self.key_filter:
+                logger.info('Key: ' + key + ' is not in the source key filter. Deleting orphaned key.')
+                self.delete_object(key)
+                self.stats['deletedWithoutHead'] += 1
+                continue
+
             try:
-                self.s3.head_object(Bucket=self.source, Key=key)
+                self.source_s3.head_object(Bucket=self.source, Key=key)
                 logger.info('Key: ' + key + ' is present in source bucket, nothing to do.')
             except ClientError as e:
                 if int(e.response['Error']['Code']) == 404:  # The key was not found.
                     logger.info('Key: ' + key + ' is not present in source bucket. Deleting orphaned key.')
-                    self.s3.delete_object(Bucket=self.destination, Key=key)
+                    self.delete_object(key)
+                    if use_key_filter:
+                        self.stats['keyFilterFalsePositives'] += 1
                 else:
                     raise e
 
 
 # Functions
 
-def delete_obsolete_keys(source=None, destination=None, region=None, keys=None):
-    job_queue = Queue()
+def delete_obsolete_keys(
+    source=None, destination=None, region=None, keys=None, current_versions=None, noncurrent_versions=None,
+    scheduler=None, key_filter=None, recent_keys=None, source_client_args=None, destination_client_args=None,
+    partial_keys=None, client_pool=None
+):
+    if scheduler is None:
+        job_queue = Queue()
+    else:
+        job_queue = scheduler.create_queue()
     worker_threads = []
+    deleted_keys = []
+    deleted_versions = []
 
     for i in range(THREAD_PARALLELISM):
         worker_threads.append(ObsoleteKeyDeleter(
@@ -94,32 +245,189 @@ def delete_obsolete_keys(source=None, destination=None, region=None, keys=None):
             source=source,
             destination=destination,
             region=region,
+            current_versions=current_versions,
+            noncurrent_versions=noncurrent_versions,
+            deleted_keys=deleted_keys,
+            deleted_versions=deleted_versions,
+            scheduler=scheduler,
+            key_filter=key_filter,
+            recent_keys=recent_keys,
+            source_client_args=source_client_args,
+            destination_client_args=destination_client_args,
+            partial_keys=partial_keys,
+            client_pool=client_pool
         ))
 
     for key in keys:
         logger.info('Queuing: ' + key + ' for orphan detection.')
         job_queue.put(key)
 
-    logger.info('Starting orphan detection for buckets: ' + source + ' and ' + destination + '.')
+    logger.info('Starting orphan detection for buckets: ' + source + ' and ' + format_bucket(destination) + '.')
     for t in worker_threads:
         t.start()
 
+    stats = {}
     for t in worker_threads:
         t.join()
+        for stat, value in t.stats.items():
+            stats[stat] = stats.get(stat, 0) + value
+
+    # Versions of orphans are deleted in batches per destination, so requests scale with the orphans, not the keys.
+    for bucket in sorted(set(d for d, _, _ in deleted_versions)):
+        versions = sorted((k, v) for d, k, v in deleted_versions if d == bucket)
+        logger.info('Deleting ' + str(len(versions)) + ' versions of orphaned keys in bucket: ' + bucket)
+        delete_versions(worker_threads[0].destination_s3, bucket, versions)
+
+    return deleted_keys, stats
+
+
+def delete_job_orphans(event, function_region):
+    # A pack of small bucket pairs (see plan_jobs), one after the other with the same clients and request scheduler.
+    scheduler = create_scheduler(event)
+    client_pool = ClientPool()
+    options = dict((k, v) for k, v in event.items() if k != 'jobs')
+    result = {
+        'deleted': 0,
+        'jobs': []
+    }
+
+    for job in event['jobs']:
+        job_event = dict(options, **job)
+        scheduler.set_budget(create_rate_budget(job_event))
+        listings = {}
+        for bucket_attribute in ['source', 'destination']:
+            s3 = client_pool.get(get_s3_client_args(job_event, bucket_attribute, function_region))
+            listings[bucket_attribute] = list_small_bucket(s3, job_event, bucket_attribute)
+        source_keys = set(listings['source']['keys'])
+        deleted_keys, _ = delete_obsolete_keys(
+            source=job['source'],
+            destination=job['destination'],
+            keys=[k for k in listings['destination']['keys'] if k not in source_keys],
+            region=job_event.get('sourceRegion', function_region),
+            scheduler=scheduler,
+            source_client_args=get_s3_client_args(job_event, 'source', function_region),
+            destination_client_args=get_s3_client_args(job_event, 'destination', function_region),
+            client_pool=client_pool
+        )
+        job_result = dict((k, job[k]) for k in JOB_ATTRIBUTES if k in job)
+        job_result['deleted'] = len(deleted_keys)
+        result['deleted'] += len(deleted_keys)
+        result['jobs'].append(job_result)
+
+    result['requestRates'] = scheduler.report()
+    return result
+
 
+def delete_renamed_orphans(event, function_region):
+    # Deletes the next batch of orphans from the rename index, after copy_keys had a chance to copy from them.
+    rename_index = load_rename_index(event['renameIndexResult'], function_region)
+    previous_result = event['renameCleanupResult']
+    position = previous_result.get('position', 0)
+    orphans = [key for key, _, _ in rename_index.orphans[position:position + RENAME_CLEANUP_BATCH_SIZE]]
 
+    # No key filter here: The index and the filter are as old as the sync, which can run for hours. A source key
+    # created since then may have been copied over an indexed orphan by now, and the listing branch never looked at
+    # indexed keys again. Only a HEAD request to the source tells.
+    logger.info('Deleting ' + str(len(orphans)) + ' indexed orphans from bucket: ' + event['destination'])
+    scheduler = create_scheduler(event)
+    deleted_keys, _ = delete_obsolete_keys(
+        source=event['source'],
+        destination=event['destination'],
+        keys=orphans,
+        region=event.get('sourceRegion', function_region),
+        scheduler=scheduler,
+        source_client_args=get_s3_client_args(event, 'source', function_region),
+        destination_client_args=get_s3_client_args(event, 'destination', function_region)
+    )
+
+    position += len(orphans)
+    publish_progress(event, function_region, {'deleted': len(deleted_keys)})
+    return {
+        'position': position,
+        'done': position >= len(rename_index),
+        'deleted': previous_result.get('deleted', 0) + len(deleted_keys),
+        'requestRates': scheduler.report()
+    }
+
+
+@profiled
 def handler(event, context):
     assert(isinstance(event, dict))
 
+    if 'jobs' in event:
+        return delete_job_orphans(event, context.invoked_function_arn.split(':')[3])
+    if 'renameCleanupResult' in event:
+        return delete_renamed_orphans(event, context.invoked_function_arn.split(':')[3])
+
     source = event['source']
     destination = event['destination']
     keys = event['listResult']['keys']
 
     function_region = context.invoked_function_arn.split(':')[3]
     region = event.get('sourceRegion', function_region)
+    destination_client_args = get_s3_client_args(event, 'destination', function_region)
+
+    logger.info(
+        'Synchronizing ' + str(len(keys)) + ' between bucket: ' + source + ' and: ' + format_bucket(destination)
+    )
+
+    current_versions = None
+    if event.get('versioned', False) and not event.get('mirrorDeleteMarkers', True):
+        current_versions = event['listResult'].get('currentVersions', {})
+    noncurrent_versions = event['listResult'].get('noncurrentVersions', {})
+
+    key_filter = None
+    key_filter_result = event.get('keyFilterResult', None)
+    if key_filter_result is not None and key_filter_result.get('token', '') == '':  # Incomplete filters can't be used.
+        key_filter = load_key_filter(key_filter_result, function_region)
+
+    rename_index = None
+    if 'renameIndexResult' in event and not isinstance(destination, list):
+        rename_index = load_rename_index(event['renameIndexResult'], function_region)
+    if rename_index is not None:
+        deferred_keys = [k for k in keys if k in rename_index]
+        if len(deferred_keys) > 0:
+            logger.info('Leaving ' + str(len(deferred_keys)) + ' indexed orphans for renamed keys to be copied from.')
+            keys = [k for k in keys if k not in rename_index]
 
-    logger.info('Synchronizing ' + str(len(keys)) + ' between bucket: ' + source + ' and: ' + destination)
+    scheduler = create_scheduler(event)
+    deleted_keys, stats = delete_obsolete_keys(
+        source=source,
+        destination=destination,
+        keys=keys,
+        region=region,
+        current_versions=current_versions,
+        noncurrent_versions=noncurrent_versions,
+        scheduler=scheduler,
+        key_filter=key_filter,
+        recent_keys=set(event['listResult'].get('recentKeys', [])),
+        source_client_args=get_s3_client_args(event, 'source', function_region),
+        destination_client_args=destination_client_args,
+        partial_keys=event['listResult'].get('partialKeys', {})
+    )
 
-    delete_obsolete_keys(source=source, destination=destination, keys=keys, region=region)
+    if event.get('versioned', False) and event.get('pruneNoncurrentVersions', False):
+        # Orphans deleted with all their versions above are already gone.
+        if current_versions is not None:
+            for _, key in deleted_keys:
+                noncurrent_versions.pop(key, None)
+        pruned_versions = [(k, v) for k in sorted(noncurrent_versions.keys()) for v in noncurrent_versions[k]]
+        logger.info('Pruning ' + str(len(pruned_versions)) + ' noncurrent versions in bucket: ' + destination)
+        delete_versions(scheduler.wrap(boto3.client('s3', **destination_client_args)), destination, pruned_versions)
 
-    return
+    result = {
+        'deleted': len(deleted_keys),
+        'requestRates': scheduler.report()
+    }
+    if isinstance(destination, list):
+        result['destinations'] = dict((d, {'deleted': 0}) for d in destination)
+        for bucket, _ in deleted_keys:
+            result['destinations'][bucket]['deleted'] += 1
+    if key_filter is not None:
+        result.update(stats)
+    if rename_index is not None:
+        result['deferred'] = len(deferred_keys)
+    publish_progress(
+        event, function_region, {'destinationKeys': len(event['listResult']['keys']), 'deleted': result['deleted']}
+    )
+    return result
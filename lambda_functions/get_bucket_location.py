@@ -20,13 +20,15 @@
 #     - AmazonS3ReadOnlyAccess
 # ---
 #
-# Input event: A string with the bucket name to query the region name for.
+# Input event: A string with the bucket name to query the region name for, or a list of bucket names that have to be
+# in the same region.
 #
 
 # Imports
 
 import logging
 import boto3
+from shared.clients import lookup_bucket_region
 
 
 # Constants
@@ -45,7 +47,21 @@ else:
 
 # Functions
 
+def get_region(s3, bucket):
+    logger.info('Looking up bucket location for bucket: ' + bucket)
+    return lookup_bucket_region(s3, bucket)
+
+
 def handler(event, context):
+    function_region = context.invoked_function_arn.split(':')[3]
+    s3 = boto3.client('s3', region_name=function_region)
+
+    if isinstance(event, list):  # Several destination buckets, see copy_keys.
+        regions = sorted(set(get_region(s3, b) for b in event))
+        if len(regions) > 1:
+            raise ValueError('Buckets: ' + ', '.join(event) + ' are in different regions: ' + ', '.join(regions))
+        return regions[0]
+
     if isinstance(event, (str, unicode)):
         bucket = event
     else:  # Find the first attribute in the dict that contains somehow the string 'bucket'.
@@ -58,16 +74,4 @@ def handler(event, context):
             bucket = event[event.keys()[0]]  # Give up and just go for the first key.
 
     assert(bucket is not None and isinstance(bucket, (str, unicode)) and bucket != '')
-    function_region = context.invoked_function_arn.split(':')[3]
-
-    logger.info('Looking up bucket location for bucket: ' + bucket)
-
-    s3 = boto3.client('s3', region_name=function_region)
-    response = s3.get_bucket_location(Bucket=bucket)
-    location_constraint = response.get('LocationConstraint', None)
-    if location_constraint is None:
-        return 'us-east-1'
-    elif location_constraint == 'EU':
-        return 'eu-west-1'
-    else:
-        return location_constraint
+    return get_region(s3, bucket)
@@ -18,27 +18,66 @@
 # Timeout: 60
 # Policies:
 #     - AmazonS3ReadOnlyAccess
+#     - Version: '2012-10-17'  # Roles to assume for the source or destination, see shared/clients.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action: 'sts:AssumeRole'
+#               Resource: '*'
+#     - Version: '2012-10-17'  # Profiles in the scratch bucket, see shared/profiling.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action: 's3:PutObject'
+#               Resource: '*'
 # ---
 #
 # Input event: A string with the source bucket name and optional region and token (for s3.list_objects_v2()).
 #
+# In the first round of a continuation execution, listing starts at the cursor in 'checkpoint' (see
+# prepare_continuation).
+#
+# If the event has a 'versioned' attribute set to true, the bucket is listed with s3.list_object_versions() instead
+# and only current versions are returned as keys. When listing the destination bucket with 'pruneNoncurrentVersions'
+# set or 'mirrorDeleteMarkers' unset, the version IDs needed by delete_orphaned_keys are returned, too.
+#
+# Keys stored in archive storage classes (see shared/listing.py) are also listed in 'archivedKeys', so
+# copy_keys can treat them separately. If the event has a 'keyFilterResult' (see build_key_filter), destination keys
+# modified after the source key filter was built are listed in 'recentKeys'.
+#
+# With a 'largeObjectThreshold' (bytes), source keys of larger objects are also listed in 'largeKeys'. copy_keys leaves
+# them to copy_large_keys, a variant of copy_keys with more memory, network bandwidth and time, so a few multi-GB
+# copies don't hold up the small keys of the page or run into the timeout of copy_keys. Not for versioned buckets.
+#
+# Optionally, only keys matching a list filter of include prefixes and exclude patterns are listed, see
+# shared/listing.py. A list of destination buckets is listed into one page of keys, see there.
+#
+# Pages that don't fit into the state size limit are cut at the last key that fits, and the next page starts after it.
+# The number of keys to ask for is chosen from the length per listed key of the previous pages in this container,
+# unless the event has 'maxKeys', so pages rarely need to be cut.
+#
 
 # Imports
 
 import logging
 import boto3
-import json
+from shared.clients import get_s3_client_args
+from shared.listing import create_list_filter, fit_page, format_bucket, get_list_position, list_next_page
+from shared.profiling import profiled
 
 
 # Constants
 
 DEBUG = False
-MAX_KEYS = 1024  # Should be a power of two since it may get divided by two a couple of times.
+MAX_KEYS = 1000  # The maximum for one S3 list request.
 MAX_DATA_SIZE = 32000  # Max. result size: https://docs.aws.amazon.com/step-functions/latest/dg/service-limits.html
 SAFETY_MARGIN = 10.0  # Percent
 MAX_RESULT_LENGTH = int(MAX_DATA_SIZE * (1.0 - (SAFETY_MARGIN / 100.0)))
 PREFIX = '' # Copy objects based on a provided prefix e.g. '/images/'
 START_AFTER = '' # List objects after a specific key e.g. '/images/1000'
+VERSIONED = False  # Use s3.list_object_versions() and sync current versions only.
+PRUNE_NONCURRENT_VERSIONS = False  # Return noncurrent destination versions so they can be deleted.
+MIRROR_DELETE_MARKERS = True  # If False, return current destination versions so orphans can be deleted for good.
 
 
 # Globals
@@ -49,9 +88,32 @@ if DEBUG:
 else:
     logger.setLevel(logging.INFO)
 
+# Survives between invocations of the same Lambda container: Average JSON length of the result per listed key (or
+# version), to choose MaxKeys so the next page fits.
+listed_key_length = None
+
+
+# Utility functions
+
+def choose_max_keys():
+    if listed_key_length is None:
+        return MAX_KEYS
+    return max(1, min(MAX_KEYS, int(MAX_RESULT_LENGTH / listed_key_length)))
+
+
+def learn_listed_key_length(result_length, count):
+    global listed_key_length
+    if count == 0:
+        return
+    if listed_key_length is None:
+        listed_key_length = float(result_length) / count
+    else:
+        listed_key_length = (listed_key_length + float(result_length) / count) / 2
+
 
 # Functions
 
+@profiled
 def handler(event, context):
     assert(isinstance(event, dict))
 
@@ -59,48 +121,54 @@ def handler(event, context):
     bucket = event[bucket_to_list]
 
     function_region = context.invoked_function_arn.split(':')[3]
-    region = event.get('sourceRegion', function_region)
+    client_args = get_s3_client_args(event, bucket_to_list, function_region)
+    region = client_args['region_name']
 
-    token = event.get('listResult', {}).get('token', '')
-    max_keys = event.get('maxKeys', MAX_KEYS)
+    token, version_id_marker = get_list_position(event, 'listResult')
+    max_keys = event.get('maxKeys', None) or choose_max_keys()
     prefix = event.get('prefix', PREFIX)
     start_after = event.get('startAfter', START_AFTER)
+    versioned = event.get('versioned', VERSIONED)
+    prune_noncurrent_versions = event.get('pruneNoncurrentVersions', PRUNE_NONCURRENT_VERSIONS)
+    mirror_delete_markers = event.get('mirrorDeleteMarkers', MIRROR_DELETE_MARKERS)
+    list_filter = create_list_filter(event)  # Applies to both branches alike, so they see the same keys.
+    large_object_threshold = event.get('largeObjectThreshold', None) if bucket_to_list == 'source' else None
+    modified_since = None
+    if bucket_to_list == 'destination' and 'keyFilterResult' in event:
+        modified_since = event['keyFilterResult']['listedAt']  # Newer keys may be missing from the key filter.
 
     args = {
         'Bucket': bucket,
         'MaxKeys': max_keys,
-        'Prefix': prefix,
-        'StartAfter': start_after
+        'Prefix': prefix
     }
-
-    result = {}
-    s3 = boto3.client('s3', region_name=region)
-
-    while True:
-        logger_string = 'Listing contents of bucket: ' + bucket + ' in: ' + region + ' ('
-        if token is not None and token != '':
-            logger_string += 'continuation token: ' + token + ', '
-            args['ContinuationToken'] = token
-        logger_string += 'may_keys: ' + str(max_keys) + ')'
-
-        response = s3.list_objects_v2(**args)
-
-        keys = [k['Key'] for k in response.get('Contents', [])]
-        logger.info('Got ' + str(len(keys)) + ' result keys.')
-
-        result['keys'] = keys
-        result['token'] = response.get('NextContinuationToken', '')
-        result_length = len(json.dumps(result))
-        if result_length <= MAX_RESULT_LENGTH:
-            return result
-        else:
-            # Try again with a smaller may_keys size.
-            logger.warning(
-                'Result size: ' + str(result_length) + ' is larger than maximum of: ' + str(MAX_RESULT_LENGTH) + '. '
-            )
-
-            max_keys = int(len(keys) / 2)  # ask for half the number of keys we got.
-            if max_keys == 0:
-                raise Exception('Something is wrong: Downsized max_keys all the way to 0 ...')
-            args['MaxKeys'] = max_keys
-            logger.info('Trying again with max_keys value: ' + str(max_keys))
+    if versioned:
+        args['KeyMarker'] = start_after
+    else:
+        args['StartAfter'] = start_after
+
+    s3 = boto3.client('s3', **client_args)
+
+    logger.info(
+        'Listing contents of bucket: ' + format_bucket(bucket) + ' in: ' + region + ' (' +
+        ('continuing after: ' + token + ', ' if token is not None and token != '' else '') +
+        'max_keys: ' + str(max_keys) + ')'
+    )
+
+    result, count = list_next_page(
+        s3, args, token, version_id_marker, bucket_to_list, versioned, prune_noncurrent_versions,
+        mirror_delete_markers, modified_since, list_filter, large_object_threshold
+    )
+    logger.info('Got ' + str(len(result['keys'])) + ' result keys.')
+    if 'largeKeys' in result:
+        logger.info(str(len(result['largeKeys'])) + ' of them for the large-object lane.')
+
+    result_length = fit_page(result, MAX_RESULT_LENGTH)
+    learn_listed_key_length(result_length, count)
+    if result_length > MAX_RESULT_LENGTH:
+        logger.info(
+            'Result length: ' + str(result_length) + ' is larger than maximum of: ' + str(MAX_RESULT_LENGTH) +
+            ', cut the page at: ' + result['token'] + ' with ' + str(len(result['keys'])) + ' keys.'
+        )
+
+    return result
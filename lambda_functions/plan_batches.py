@@ -0,0 +1,166 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# YAML front matter with parameters for deployment as a Lambda function.
+#
+# ---
+# Description: "Fan-out variant: List a bucket ahead and write batches of keys to the scratch bucket."
+# MemorySize: 256
+# Timeout: 300
+# Policies:
+#     - AmazonS3FullAccess
+#     - Version: '2012-10-17'  # Roles to assume for the source or destination, see shared/clients.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action: 'sts:AssumeRole'
+#               Resource: '*'
+# ---
+#
+# Input event: The same dict as for list_bucket, plus:
+# {
+#     'scratchBucket': 'scratch-bucket',  # Required, batches are written here.
+#     'scratchPrefix': 's3-sync/',  # Optional.
+#     'batchSize': 1000,  # Optional, keys per batch.
+#     'batchesPerPlan': 100,  # Optional, batches listed ahead before they are handed to the Map state.
+#     'maxConcurrency': 10  # Optional, number of batches processed at the same time.
+# }
+#
+# Lists up to 'batchesPerPlan' pages of the bucket named by 'listBucket' and writes them as a JSON array to the
+# scratch bucket. Each item is a complete input event for copy_keys or delete_orphaned_keys, with the page in
+# 'listResult', so a Distributed Map state can read them with an ItemReader and process them in parallel.
+#
+# Output: A dict with the 'bucket' and 'key' of the batch array, the 'batchCount', the 'maxConcurrency' for the Map
+# state and the 'token' (and 'versionIdMarker') to continue listing from. The token is empty after the last page.
+#
+
+# Imports
+
+import logging
+import boto3
+import json
+from uuid import uuid4
+from shared.clients import create_s3_client
+from shared.listing import create_list_filter, format_bucket, get_list_position, list_next_page
+
+
+# Constants
+
+DEBUG = False
+PREFIX = ''
+START_AFTER = ''
+VERSIONED = False
+PRUNE_NONCURRENT_VERSIONS = False
+MIRROR_DELETE_MARKERS = True
+SCRATCH_PREFIX = 's3-sync/'
+BATCH_SIZE = 1000  # Keys per batch, the maximum for one S3 list request.
+BATCHES_PER_PLAN = 100  # Keeps the Map state output, one result per batch, well below the 256 KB limit.
+MAX_CONCURRENCY = 10
+MIN_REMAINING_TIME = 30000  # ms, stop listing ahead when less time than this is left.
+PLAN_ATTRIBUTES = [  # Not copied into batches.
+    'listResult',
+    'plan',
+    'batchResults',
+    'copyResult',
+    'deleteResult',
+    'progress',
+    'checkpoint'
+]
+
+
+# Globals
+
+logger = logging.getLogger()
+if DEBUG:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+
+# Functions
+
+def handler(event, context):
+    assert(isinstance(event, dict))
+
+    bucket_to_list = event['listBucket']
+    bucket = event[bucket_to_list]
+    if 'scratchBucket' not in event:
+        raise ValueError('The fan-out state machine needs a scratchBucket to store batches in.')
+    scratch_bucket = event['scratchBucket']
+    scratch_key = (
+        event.get('scratchPrefix', SCRATCH_PREFIX) + 'batches/' + bucket_to_list + '/' + uuid4().hex + '.json'
+    )
+
+    function_region = context.invoked_function_arn.split(':')[3]
+
+    token, version_id_marker = get_list_position(event, 'plan')
+    batch_size = event.get('batchSize', BATCH_SIZE)
+    batches_per_plan = event.get('batchesPerPlan', BATCHES_PER_PLAN)
+    versioned = event.get('versioned', VERSIONED)
+    prune_noncurrent_versions = event.get('pruneNoncurrentVersions', PRUNE_NONCURRENT_VERSIONS)
+    mirror_delete_markers = event.get('mirrorDeleteMarkers', MIRROR_DELETE_MARKERS)
+    list_filter = create_list_filter(event)
+    modified_since = None
+    if bucket_to_list == 'destination' and 'keyFilterResult' in event:
+        modified_since = event['keyFilterResult']['listedAt']  # Newer keys may be missing from the key filter.
+
+    args = {
+        'Bucket': bucket,
+        'MaxKeys': batch_size,
+        'Prefix': event.get('prefix', PREFIX)
+    }
+    if versioned:
+        args['KeyMarker'] = event.get('startAfter', START_AFTER)
+    else:
+        args['StartAfter'] = event.get('startAfter', START_AFTER)
+
+    s3 = create_s3_client(event, bucket_to_list, function_region)
+    batch_template = dict((k, v) for k, v in event.items() if k not in PLAN_ATTRIBUTES)
+    batches = []
+    key_count = 0
+
+    while len(batches) < batches_per_plan and context.get_remaining_time_in_millis() > MIN_REMAINING_TIME:
+        result, _ = list_next_page(
+            s3, args, token, version_id_marker, bucket_to_list, versioned, prune_noncurrent_versions,
+            mirror_delete_markers, modified_since, list_filter
+        )
+        token = result['token']
+        version_id_marker = result.get('versionIdMarker', '')
+
+        if len(result['keys']) > 0 or 'noncurrentVersions' in result:
+            batch = dict(batch_template)
+            batch['listResult'] = dict(result, token='')  # Batches don't continue listing on their own.
+            batches.append(batch)
+            key_count += len(result['keys'])
+
+        if token == '':
+            break
+
+    logger.info(
+        'Planned ' + str(len(batches)) + ' batches with ' + str(key_count) + ' keys from bucket: ' +
+        format_bucket(bucket) + ', writing them to: s3://' + scratch_bucket + '/' + scratch_key
+    )
+    boto3.client('s3', region_name=function_region).put_object(
+        Bucket=scratch_bucket,
+        Key=scratch_key,
+        Body=json.dumps(batches),
+        ContentType='application/json'
+    )
+
+    return {
+        'bucket': scratch_bucket,
+        'key': scratch_key,
+        'batchCount': len(batches),
+        'maxConcurrency': event.get('maxConcurrency', MAX_CONCURRENCY),
+        'token': token,
+        'versionIdMarker': version_id_marker
+    }
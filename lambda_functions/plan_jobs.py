@@ -0,0 +1,219 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# YAML front matter with parameters for deployment as a Lambda function.
+#
+# ---
+# Description: "Batch mode: List many small bucket pairs and pack them into shared copy and delete invocations."
+# MemorySize: 256
+# Timeout: 300
+# Policies:
+#     - AmazonS3ReadOnlyAccess
+#     - Version: '2012-10-17'  # Roles to assume for the source or destination, see shared/clients.py.
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action: 'sts:AssumeRole'
+#               Resource: '*'
+# ---
+#
+# Input event: The execution input with a list of 'jobs' instead of a single 'source' and 'destination':
+# {
+#     'jobs': [
+#         {'source': 'source-bucket-1', 'destination': 'destination-bucket-1', 'prefix': 'images/'},
+#         {'source': 'source-bucket-2', 'destination': 'destination-bucket-2'},
+#         ...
+#     ],
+#     'smallJobKeys': 100,  # Optional, pairs with more keys than this in either bucket run in their own execution.
+#     'packKeys': 1000,  # Optional, source and destination keys per pack of small pairs.
+#     'packConcurrency': 10  # Optional, number of packs processed at the same time.
+# }
+#
+# All other attributes of the execution input are options for every job, and each job can override them, e.g. with
+# its own 'sourceRegion' or 'destinationRoleArn'.
+#
+# Both buckets of each pair are listed with up to 'smallJobKeys' keys, in parallel threads sharing the S3 clients and
+# the bucket regions of this container. Pairs that fit are small: They are packed, in order, into lists of jobs for
+# copy_keys and delete_orphaned_keys to list and process in one invocation each. All other pairs, and small pairs
+# whose results wouldn't fit into the state size limit anymore, are large and run as executions of their own.
+#
+# Output:
+# {
+#     'packs': [{..., 'jobs': [{'source': ..., 'destination': ..., 'sourceRegion': ...}, ...]}, ...],
+#     'largeJobs': [{..., 'source': ..., 'destination': ...}, ...],  # Complete execution inputs.
+#     'jobCount': 123,
+#     'maxConcurrency': 10
+# }
+#
+
+# Imports
+
+import logging
+import json
+from Queue import Queue, Empty
+from threading import Thread
+from shared.clients import ClientPool, get_s3_client_args, lookup_bucket_region
+from shared.listing import is_bucket_list, list_small_bucket
+
+
+# Constants
+
+DEBUG = False
+THREAD_PARALLELISM = 10
+SMALL_JOB_KEYS = 100  # Keys per bucket, small pairs are listed with a single request per bucket.
+PACK_KEYS = 1000  # Keys per pack, about what copy_keys gets from list_bucket for a single pair.
+PACK_CONCURRENCY = 10
+MAX_DATA_SIZE = 32000  # Max. state size: https://docs.aws.amazon.com/step-functions/latest/dg/service-limits.html
+SAFETY_MARGIN = 10.0  # Percent
+MAX_PLAN_LENGTH = int(MAX_DATA_SIZE * (1.0 - (SAFETY_MARGIN / 100.0)))
+JOB_RESULT_LENGTH = 400  # Estimated length of the copy and delete results of a small job, which replace its pack.
+PACK_RESULT_LENGTH = 2000  # Estimated length of the totals and request rates of a pack.
+PLAN_ATTRIBUTES = [  # Not copied into packs or large jobs.
+    'jobs',
+    'execution',
+    'packs',
+    'largeJobs'
+]
+
+
+# Globals
+
+logger = logging.getLogger()
+if DEBUG:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+
+# Utility functions
+
+def plan_job(job_event, function_region, client_pool, small_job_keys):
+    # Returns the bucket regions and number of keys of a small job, or None if it is large.
+    if job_event.get('versioned', False) or job_event.get('keyFilter', False):
+        return None
+    if job_event.get('renameDetection', False):
+        return None
+    if is_bucket_list(job_event['destination']):
+        return None
+
+    for bucket_attribute in ['source', 'destination']:
+        if bucket_attribute + 'Region' not in job_event:
+            s3 = client_pool.get(get_s3_client_args(job_event, bucket_attribute, function_region))
+            job_event[bucket_attribute + 'Region'] = lookup_bucket_region(s3, job_event[bucket_attribute])
+    if (
+        job_event['sourceRegion'] != job_event['destinationRegion'] and
+        job_event.get('copyMode', 'server') != 'stream'
+    ):
+        return None  # Its own execution fails with the usual error, see validate_input.
+
+    key_count = 0
+    for bucket_attribute in ['source', 'destination']:
+        s3 = client_pool.get(get_s3_client_args(job_event, bucket_attribute, function_region))
+        listing = list_small_bucket(s3, job_event, bucket_attribute, max_keys=small_job_keys, max_pages=1)
+        if listing is None:
+            return None
+        key_count += len(listing['keys'])
+
+    return {
+        'sourceRegion': job_event['sourceRegion'],
+        'destinationRegion': job_event['destinationRegion'],
+        'keyCount': key_count
+    }
+
+
+def plan_jobs(jobs, options, function_region, small_job_keys):
+    # Returns a list with the plan of each job (None for large jobs), in the same order.
+    client_pool = ClientPool()
+    plans = [None] * len(jobs)
+    queue = Queue()
+    for i in range(len(jobs)):
+        queue.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                plans[i] = plan_job(dict(options, **jobs[i]), function_region, client_pool, small_job_keys)
+            except Exception as e:
+                logger.warning(
+                    'Could not list job: ' + json.dumps(jobs[i]) + ', running it on its own. Error: ' + str(e)
+                )
+
+    threads = [Thread(target=worker) for _ in range(min(THREAD_PARALLELISM, len(jobs)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return plans
+
+
+# Functions
+
+def handler(event, context):
+    assert(isinstance(event, dict))
+
+    jobs = event['jobs']
+    for job in jobs:
+        if 'source' not in job or 'destination' not in job:
+            raise ValueError('Each job needs a source and a destination: ' + json.dumps(job))
+
+    function_region = context.invoked_function_arn.split(':')[3]
+    small_job_keys = event.get('smallJobKeys', SMALL_JOB_KEYS)
+    pack_keys = event.get('packKeys', PACK_KEYS)
+    options = dict((k, v) for k, v in event.items() if k not in PLAN_ATTRIBUTES)
+
+    plans = plan_jobs(jobs, options, function_region, small_job_keys)
+
+    packs = []
+    large_jobs = []
+    pack_jobs = []
+    pack_key_count = 0
+    options_length = len(json.dumps(options))  # Repeated in every pack and large job.
+    plan_length = 0
+    for job, plan in zip(jobs, plans):
+        if plan is not None:
+            key_count = plan.pop('keyCount')
+            small_job = dict(job, **plan)
+            job_length = len(json.dumps(small_job)) + JOB_RESULT_LENGTH
+            new_pack = len(pack_jobs) == 0 or pack_key_count + key_count > pack_keys
+            if new_pack:
+                job_length += options_length + PACK_RESULT_LENGTH
+            if plan_length + job_length <= MAX_PLAN_LENGTH:
+                if new_pack and len(pack_jobs) > 0:
+                    packs.append(dict(options, jobs=pack_jobs))
+                    pack_jobs = []
+                    pack_key_count = 0
+                pack_jobs.append(small_job)
+                pack_key_count += key_count
+                plan_length += job_length
+                continue
+        large_jobs.append(dict(options, **job))
+        plan_length += options_length + len(json.dumps(job))
+
+    if len(pack_jobs) > 0:
+        packs.append(dict(options, jobs=pack_jobs))
+
+    logger.info(
+        'Packed ' + str(len(jobs) - len(large_jobs)) + ' small jobs into ' + str(len(packs)) + ' packs, ' +
+        str(len(large_jobs)) + ' large jobs run on their own.'
+    )
+
+    return {
+        'packs': packs,
+        'largeJobs': large_jobs,
+        'jobCount': len(jobs),
+        'maxConcurrency': event.get('packConcurrency', PACK_CONCURRENCY)
+    }
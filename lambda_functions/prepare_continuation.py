@@ -0,0 +1,114 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# YAML front matter with parameters for deployment as a Lambda function.
+#
+# ---
+# Description: "Turn the progress of both branches into a checkpoint and the input of a continuation execution."
+# MemorySize: 128
+# Timeout: 15
+# Policies:
+# ---
+#
+# Input event: The execution state with the outputs of the copy and delete branches (see checkpoint_progress) in
+# 'branchResults', and optionally 'maxContinuations' (default: MAX_CONTINUATIONS).
+#
+# The input of the continuation keeps the start time of the first execution in 'syncStartTime', so the progress
+# record of the sync (see shared/progress.py) carries on.
+#
+# Output:
+# {
+#     'needed': true,  # False if both branches are done.
+#     'totals': {'source': { ... }, 'destination': { ... }},  # Results of this and all previous executions.
+#     'input': {  # Only if needed: The execution input with a checkpoint of both branches.
+#         ...,
+#         'checkpoint': {
+#             'continuations': 1,
+#             'source': {'done': false, 'token': '...', 'versionIdMarker': '', 'totals': { ... }},
+#             'destination': {'done': true, 'totals': { ... }}
+#         }
+#     }
+# }
+#
+
+# Imports
+
+import logging
+from shared.progress import get_sync_start_time
+
+
+# Constants
+
+DEBUG = False
+MAX_CONTINUATIONS = 100  # Executions after the first one, as a safeguard against endless chains.
+STATE_ATTRIBUTES = [  # Added to the execution input by the state machine, not carried over to continuations.
+    # Bucket regions are carried over, continuations don't need to look them up again.
+    'regionsAreSame',
+    'execution',
+    'listBucket',
+    'listResult',
+    'plan',
+    'batchResults',
+    'copyResult',
+    'largeCopyResult',
+    'deleteResult',
+    'batchCopyRetryResult',
+    'progress',
+    'branchResults',
+    'continuation',
+    'checkpoint'
+]
+
+
+# Globals
+
+logger = logging.getLogger()
+if DEBUG:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+
+# Functions
+
+def handler(event, _):
+    assert(isinstance(event, dict))
+
+    branches = {}
+    for progress in event['branchResults']:
+        branches[progress['listBucket']] = dict(
+            (k, progress[k]) for k in ['listBucket', 'done', 'token', 'versionIdMarker', 'totals'] if k in progress
+        )
+
+    result = {
+        'needed': not all(b['done'] for b in branches.values()),
+        'totals': dict((name, b['totals']) for name, b in branches.items())
+    }
+    if not result['needed']:
+        return result
+
+    continuations = event.get('checkpoint', {}).get('continuations', 0) + 1
+    if continuations > event.get('maxContinuations', MAX_CONTINUATIONS):
+        raise Exception('Giving up after ' + str(continuations - 1) + ' continuation executions.')
+
+    continuation_input = dict((k, v) for k, v in event.items() if k not in STATE_ATTRIBUTES)
+    continuation_input['checkpoint'] = dict(branches, continuations=continuations)
+    if get_sync_start_time(event) is not None:
+        continuation_input['syncStartTime'] = get_sync_start_time(event)
+    result['input'] = continuation_input
+
+    logger.info(
+        'Starting continuation execution number ' + str(continuations) + ', continuing from: ' +
+        ', '.join(name + ' at: ' + b['token'] for name, b in sorted(branches.items()) if not b['done'])
+    )
+
+    return result
@@ -0,0 +1,238 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# YAML front matter with parameters for deployment as a Lambda function.
+#
+# ---
+# Description: "Estimate the total size, throughput and time left of running syncs from their progress records."
+# MemorySize: 128
+# Timeout: 60
+# Policies:
+#     - Version: '2012-10-17'
+#       Statement:
+#           -
+#               Effect: Allow
+#               Action:
+#                   - 'dynamodb:GetItem'
+#                   - 'dynamodb:Scan'
+#                   - 'cloudwatch:GetMetricStatistics'
+#                   - 'cloudwatch:ListMetrics'
+#               Resource: '*'
+# ---
+#
+# Not part of the state machine, invoke it (or run `fab progress`) to see how far along syncs with a 'progressTable'
+# are, see shared/progress.py.
+#
+# Input event:
+# {
+#     'progressTable': 'sync-progress',
+#     'progressName': 'images',  # Optional, only this record. Default: All records in the table.
+#     'progressRegion': 'us-east-1'  # Optional, region of the table, defaults to the region of the function.
+# }
+#
+# The total number of keys in each bucket is estimated, in this order, from:
+#     'listing': The number of keys looked at, once the branch listing the bucket is done.
+#     'bucketMetrics': The daily Amazon S3 storage metrics in Amazon CloudWatch (NumberOfObjects, BucketSizeBytes),
+#         if the sync covers the whole bucket.
+#     'keyPosition': The keys looked at so far, divided by the share of the prefix the listing went through, judging by
+#         its position. Assumes keys spread evenly over the printable ASCII characters, a rough estimate.
+# The total size of the source bucket is estimated the same way, from the bytes looked at. The time left of each branch
+# is its keys left divided by its average throughput so far.
+#
+# Output: A dict with a list of 'syncs', the ones with the most time left first, each like:
+# {
+#     'progress': 'source-bucket/destination-bucket', 'source': ..., 'destination': ..., 'prefix': ...,
+#     'elapsedSeconds': 3600, 'secondsSinceUpdate': 5,
+#     'copied': 1000, 'current': 50000, 'archived': 0, 'deleted': 10, 'copiedBytes': 10000000,
+#     'copiedBytesPerSecond': 2777.8,
+#     'branches': {
+#         'source': {
+#             'done': false, 'keys': 51000, 'keysPerSecond': 14.2, 'estimatedKeys': 200000, 'estimateBasis': 'listing',
+#             'fractionDone': 0.255, 'etaSeconds': 10479, 'scannedBytes': 510000000, 'estimatedBytes': 2000000000
+#         },
+#         'destination': { ... }
+#     },
+#     'etaSeconds': 10479  # Of the slower branch, None if unknown.
+# }
+#
+
+# Imports
+
+import logging
+import boto3
+import time
+from datetime import datetime, timedelta
+from shared.progress import HASH_KEY, from_item
+
+
+# Constants
+
+DEBUG = False
+FIRST_KEY_CHARACTER = 0x20  # Printable ASCII, for key position estimates.
+KEY_CHARACTER_RANGE = 0x7f - 0x20
+KEY_POSITION_DEPTH = 8  # Characters of a key that count for its position.
+METRICS_DAYS = 3  # Storage metrics are daily, look back this far for the latest one.
+BRANCH_COUNTS = {'source': 'sourceKeys', 'destination': 'destinationKeys'}
+RESULT_COUNTS = ['copied', 'current', 'archived', 'deleted', 'copiedBytes']
+
+
+# Globals
+
+logger = logging.getLogger()
+if DEBUG:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+
+# Utility functions
+
+def get_key_fraction(key, prefix):
+    # Where the key sorts between the prefix and its end, from 0 to 1.
+    fraction = 0.0
+    scale = 1.0
+    for c in key[len(prefix):][:KEY_POSITION_DEPTH]:
+        scale /= KEY_CHARACTER_RANGE
+        fraction += scale * min(max(ord(c) - FIRST_KEY_CHARACTER, 0), KEY_CHARACTER_RANGE - 1)
+    return fraction
+
+
+def get_latest_metric(cloudwatch, metric_name, dimensions):
+    now = datetime.utcnow()
+    datapoints = cloudwatch.get_metric_statistics(
+        Namespace='AWS/S3',
+        MetricName=metric_name,
+        Dimensions=dimensions,
+        StartTime=now - timedelta(days=METRICS_DAYS),
+        EndTime=now,
+        Period=86400,
+        Statistics=['Average']
+    ).get('Datapoints', [])
+    if len(datapoints) == 0:
+        return None
+    return max(datapoints, key=lambda d: d['Timestamp'])['Average']
+
+
+def get_bucket_metrics(bucket, region):
+    # Returns the (number of objects, size in bytes) tuple of the bucket's latest storage metrics, or None.
+    cloudwatch = boto3.client('cloudwatch', region_name=region)
+    objects = get_latest_metric(cloudwatch, 'NumberOfObjects', [
+        {'Name': 'BucketName', 'Value': bucket},
+        {'Name': 'StorageType', 'Value': 'AllStorageTypes'}
+    ])
+    if objects is None:
+        return None
+    size = 0
+    metrics = cloudwatch.list_metrics(
+        Namespace='AWS/S3', MetricName='BucketSizeBytes', Dimensions=[{'Name': 'BucketName', 'Value': bucket}]
+    ).get('Metrics', [])
+    for metric in metrics:  # One per storage class.
+        size += get_latest_metric(cloudwatch, 'BucketSizeBytes', metric['Dimensions']) or 0
+    return int(objects), int(size)
+
+
+def estimate_branch(record, bucket_to_list, elapsed_seconds, bucket_metrics):
+    keys = record.get(BRANCH_COUNTS[bucket_to_list], 0)
+    done = record.get(bucket_to_list + 'Done', False)
+    scanned_bytes = record.get('scannedBytes', None) if bucket_to_list == 'source' else None
+    branch = {
+        'done': done,
+        'keys': keys,
+        'keysPerSecond': round(keys / elapsed_seconds, 1),
+        'estimatedKeys': None,
+        'estimateBasis': None,
+        'etaSeconds': 0 if done else None
+    }
+    if scanned_bytes is not None:
+        branch['scannedBytes'] = scanned_bytes
+
+    fraction = get_key_fraction(record.get(bucket_to_list + 'Position', ''), record.get('prefix', ''))
+    if done:
+        branch.update({'estimatedKeys': keys, 'estimateBasis': 'listing'})
+        if scanned_bytes is not None:
+            branch['estimatedBytes'] = scanned_bytes
+    elif bucket_metrics is not None:
+        branch.update({'estimatedKeys': max(keys, bucket_metrics[0]), 'estimateBasis': 'bucketMetrics'})
+        branch['estimatedBytes'] = bucket_metrics[1]
+    elif fraction > 0 and keys > 0:
+        branch.update({'estimatedKeys': int(keys / fraction), 'estimateBasis': 'keyPosition'})
+        if scanned_bytes is not None:
+            branch['estimatedBytes'] = int(scanned_bytes / fraction)
+
+    if branch['estimatedKeys'] is not None and branch['estimatedKeys'] > 0:
+        branch['fractionDone'] = round(float(keys) / branch['estimatedKeys'], 3)
+        if not done and keys > 0:
+            branch['etaSeconds'] = int((branch['estimatedKeys'] - keys) / (keys / elapsed_seconds))
+    return branch
+
+
+def estimate_progress(record, now):
+    elapsed_seconds = max(1.0, record['updatedAt'] - record['startedAt'])
+    result = dict((k, record[k]) for k in [HASH_KEY, 'source', 'destination', 'prefix'] if k in record)
+    result.update({
+        'elapsedSeconds': int(elapsed_seconds),
+        'secondsSinceUpdate': int(now - record['updatedAt']),
+        'branches': {}
+    })
+    for name in RESULT_COUNTS:
+        result[name] = record.get(name, 0)
+    result['copiedBytesPerSecond'] = round(result['copiedBytes'] / elapsed_seconds, 1)
+
+    for bucket_to_list in ['source', 'destination']:
+        bucket_metrics = None
+        if (
+            not record.get(bucket_to_list + 'Done', False) and record.get('prefix', '') == '' and
+            not record.get('narrowed', False) and bucket_to_list in record
+        ):
+            try:
+                bucket_metrics = get_bucket_metrics(
+                    record[bucket_to_list], record.get(bucket_to_list + 'Region', record.get('sourceRegion'))
+                )
+            except Exception as e:
+                logger.warning('Could not get storage metrics of bucket: ' + record[bucket_to_list] + ': ' + str(e))
+        result['branches'][bucket_to_list] = estimate_branch(record, bucket_to_list, elapsed_seconds, bucket_metrics)
+
+    etas = [b['etaSeconds'] for b in result['branches'].values()]
+    result['etaSeconds'] = None if None in etas else max(etas)
+    return result
+
+
+# Functions
+
+def handler(event, context):
+    assert(isinstance(event, dict))
+
+    function_region = context.invoked_function_arn.split(':')[3]
+    dynamodb = boto3.client('dynamodb', region_name=event.get('progressRegion', function_region))
+    table = event['progressTable']
+
+    if 'progressName' in event:
+        item = dynamodb.get_item(
+            TableName=table, Key={HASH_KEY: {'S': event['progressName']}}, ConsistentRead=True
+        ).get('Item', None)
+        records = [] if item is None else [from_item(item)]
+    else:
+        records = []
+        args = {'TableName': table}
+        while True:
+            response = dynamodb.scan(**args)
+            records.extend(from_item(item) for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    now = time.time()
+    syncs = [estimate_progress(record, now) for record in records]
+    # Most time left first, then those without an estimate.
+    syncs.sort(key=lambda s: (s['etaSeconds'] is None, -(s['etaSeconds'] or 0)))
+    logger.info('Estimated the progress of ' + str(len(syncs)) + ' syncs in table: ' + table)
+    return {'syncs': syncs}
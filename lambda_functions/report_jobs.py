@@ -0,0 +1,98 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# YAML front matter with parameters for deployment as a Lambda function.
+#
+# ---
+# Description: "Batch mode: Report the results of all bucket pairs of an execution."
+# MemorySize: 128
+# Timeout: 15
+# Policies:
+# ---
+#
+# Input event: The output of plan_jobs, with the results of the packs ({'copyResult': ..., 'deleteResult': ...} each)
+# in place of the 'packs', and the 'largeJobs' with their 'startedExecution'.
+#
+# Output:
+# {
+#     'jobs': [  # Small jobs, in the order of the execution input.
+#         {'source': ..., 'destination': ..., 'prefix': ..., 'copyResult': { ... }, 'deleteResult': { ... }},
+#         ...
+#     ],
+#     'largeJobs': [  # Their results come with the executions they run in.
+#         {'source': ..., 'destination': ..., 'prefix': ..., 'executionArn': 'arn:aws:states:...'},
+#         ...
+#     ],
+#     'totals': {'copyResult': { ... }, 'deleteResult': { ... }}  # Of all small jobs, see shared/results.py.
+# }
+#
+
+# Imports
+
+import logging
+from shared.results import merge_results
+
+
+# Constants
+
+DEBUG = False
+JOB_ATTRIBUTES = ['source', 'destination', 'prefix']
+
+
+# Globals
+
+logger = logging.getLogger()
+if DEBUG:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+
+# Functions
+
+def handler(event, _):
+    assert(isinstance(event, dict))
+
+    jobs = []
+    totals = {
+        'copyResult': {'batches': 0},
+        'deleteResult': {'batches': 0}
+    }
+    for pack_result in event.get('packs', []):
+        copy_jobs = pack_result['copyResult'].pop('jobs')
+        delete_jobs = pack_result['deleteResult'].pop('jobs')
+        for copy_job, delete_job in zip(copy_jobs, delete_jobs):
+            job = dict((k, copy_job.pop(k)) for k in JOB_ATTRIBUTES if k in copy_job)
+            job['copyResult'] = copy_job
+            job['deleteResult'] = dict((k, v) for k, v in delete_job.items() if k not in JOB_ATTRIBUTES)
+            jobs.append(job)
+        for name in totals:
+            merge_results(totals[name], pack_result[name])
+
+    large_jobs = []
+    for job in event.get('largeJobs', []):
+        large_job = dict((k, job[k]) for k in JOB_ATTRIBUTES if k in job)
+        large_job['executionArn'] = job['startedExecution']['ExecutionArn']
+        large_jobs.append(large_job)
+
+    logger.info(
+        'Synced ' + str(len(jobs)) + ' small jobs in ' + str(len(event.get('packs', []))) + ' packs: ' +
+        str(totals['copyResult'].get('copied', 0)) + ' keys copied, ' +
+        str(totals['deleteResult'].get('deleted', 0)) + ' keys deleted. Started ' + str(len(large_jobs)) +
+        ' executions for large jobs.'
+    )
+
+    return {
+        'jobs': jobs,
+        'largeJobs': large_jobs,
+        'totals': totals
+    }
@@ -0,0 +1,133 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# A scalable Bloom filter of bucket keys, see build_key_filter and delete_orphaned_keys.
+#
+# A Bloom filter answers "may this key be present?" with no false negatives: Keys it doesn't contain are definitely
+# absent. The number of keys doesn't have to be known in advance: When a filter is full, another one with twice the
+# capacity and half the false positive rate is added, so the false positive rate of all filters together stays below
+# the configured one (Almeida et al., "Scalable Bloom Filters").
+#
+# Serialized form: One line of JSON with the parameters of each filter, followed by their bits.
+#
+
+# Imports
+
+import json
+import math
+import struct
+from hashlib import md5
+
+
+# Constants
+
+CAPACITY = 1000000  # Keys in the first filter.
+FALSE_POSITIVE_RATE = 0.01
+GROWTH_FACTOR = 2  # Capacity of each additional filter, relative to the previous one.
+TIGHTENING_RATIO = 0.5  # False positive rate of each additional filter, relative to the previous one.
+
+
+# Classes
+
+class BloomFilter(object):
+    def __init__(self, capacity, false_positive_rate, bits=None, count=0):
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        size = int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        self.size = (size + 7) // 8 * 8
+        self.hash_count = max(1, int(round(float(self.size) / capacity * math.log(2))))
+        self.bits = bits if bits is not None else bytearray(self.size // 8)
+        self.count = count
+
+    def indexes(self, key):
+        # Double hashing: Two 64 bit halves of one MD5 digest are combined into hash_count indexes.
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', md5(key).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for i in self.indexes(key):
+            self.bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for i in self.indexes(key):
+            if not self.bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+    def estimated_false_positive_rate(self):
+        return (1.0 - math.exp(-float(self.hash_count) * self.count / self.size)) ** self.hash_count
+
+
+class ScalableBloomFilter(object):
+    def __init__(self, capacity=CAPACITY, false_positive_rate=FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.filters = []
+
+    def add(self, key):
+        if len(self.filters) == 0 or self.filters[-1].is_full():
+            # The rates of all filters add up to no more than false_positive_rate.
+            self.filters.append(BloomFilter(
+                self.capacity * GROWTH_FACTOR ** len(self.filters),
+                self.false_positive_rate * (1 - TIGHTENING_RATIO) * TIGHTENING_RATIO ** len(self.filters)
+            ))
+        self.filters[-1].add(key)
+
+    def __contains__(self, key):
+        for f in self.filters:
+            if key in f:
+                return True
+        return False
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+
+    def estimated_false_positive_rate(self):
+        result = 1.0
+        for f in self.filters:
+            result *= 1.0 - f.estimated_false_positive_rate()
+        return 1.0 - result
+
+    def to_bytes(self):
+        header = {
+            'capacity': self.capacity,
+            'falsePositiveRate': self.false_positive_rate,
+            'filters': [
+                {
+                    'capacity': f.capacity,
+                    'falsePositiveRate': f.false_positive_rate,
+                    'count': f.count
+                } for f in self.filters
+            ]
+        }
+        return json.dumps(header) + '\n' + ''.join(str(f.bits) for f in self.filters)
+
+    @classmethod
+    def from_bytes(cls, data):
+        header_length = data.index('\n')
+        header = json.loads(data[:header_length])
+        result = cls(header['capacity'], header['falsePositiveRate'])
+
+        offset = header_length + 1
+        for h in header['filters']:
+            f = BloomFilter(h['capacity'], h['falsePositiveRate'], count=h['count'])
+            f.bits = bytearray(data[offset:offset + f.size // 8])
+            offset += f.size // 8
+            result.filters.append(f)
+
+        return result
@@ -0,0 +1,126 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# Separate S3 client settings for the source and destination bucket, for pairs in different accounts or behind
+# different (S3 compatible) endpoints. The input event can have, for 'source' and 'destination' alike:
+# {
+#     'sourceRegion': 'eu-west-1',  # Set by the state machine, see get_bucket_location.
+#     'sourceRoleArn': 'arn:aws:iam::123456789012:role/sync-source',  # Optional, role to assume for this bucket.
+#     'sourceEndpointUrl': 'https://storage.example.com'  # Optional, for S3 compatible storage.
+# }
+#
+# Returns keyword arguments for boto3.client('s3', ...) rather than clients, because creating boto3 clients isn't
+# thread safe: Worker threads create their own from the same arguments, or share them through a ClientPool.
+#
+# Bucket regions are looked up once per Lambda container.
+#
+
+# Imports
+
+import boto3
+import time
+from botocore.config import Config
+from calendar import timegm
+from threading import Lock
+
+
+# Constants
+
+ROLE_SESSION_NAME = 'sync-buckets-state-machine'
+CREDENTIALS_REFRESH_MARGIN = 300  # seconds, assume the role again when its credentials expire sooner than this.
+POOL_MAX_CONNECTIONS = 50  # Per client, enough for all worker threads sharing it.
+
+
+# Globals
+
+# Survives between invocations of the same Lambda container: {role ARN: credentials from sts.assume_role()}.
+role_credentials = {}
+role_credentials_lock = Lock()
+
+# Survives between invocations of the same Lambda container: {bucket: region name}.
+bucket_regions = {}
+bucket_regions_lock = Lock()
+
+
+# Classes
+
+class ClientPool(object):
+    # Shares S3 clients between the threads of one invocation, one per set of client arguments. Creating clients takes
+    # a while and isn't thread safe, using them is.
+    def __init__(self, max_connections=POOL_MAX_CONNECTIONS):
+        self.config = Config(max_pool_connections=max_connections)
+        self.clients = {}
+        self.lock = Lock()
+
+    def get(self, client_args):
+        name = tuple(sorted(client_args.items()))
+        with self.lock:
+            if name not in self.clients:
+                self.clients[name] = boto3.client('s3', config=self.config, **client_args)
+            return self.clients[name]
+
+
+# Functions
+
+def get_role_credentials(role_arn):
+    with role_credentials_lock:
+        credentials = role_credentials.get(role_arn, None)
+        if (
+            credentials is None or
+            timegm(credentials['Expiration'].utctimetuple()) - time.time() < CREDENTIALS_REFRESH_MARGIN
+        ):
+            credentials = boto3.client('sts').assume_role(
+                RoleArn=role_arn,
+                RoleSessionName=ROLE_SESSION_NAME
+            )['Credentials']
+            role_credentials[role_arn] = credentials
+        return credentials
+
+
+def get_s3_client_args(event, bucket_attribute, default_region):
+    # bucket_attribute is 'source' or 'destination'. The destination region defaults to the source region, like
+    # before the state machine looked up both.
+    if bucket_attribute == 'destination':
+        default_region = event.get('sourceRegion', default_region)
+    args = {
+        'region_name': event.get(bucket_attribute + 'Region', default_region)
+    }
+    if bucket_attribute + 'EndpointUrl' in event:
+        args['endpoint_url'] = event[bucket_attribute + 'EndpointUrl']
+    if bucket_attribute + 'RoleArn' in event:
+        credentials = get_role_credentials(event[bucket_attribute + 'RoleArn'])
+        args['aws_access_key_id'] = credentials['AccessKeyId']
+        args['aws_secret_access_key'] = credentials['SecretAccessKey']
+        args['aws_session_token'] = credentials['SessionToken']
+    return args
+
+
+def lookup_bucket_region(s3, bucket):
+    with bucket_regions_lock:
+        if bucket in bucket_regions:
+            return bucket_regions[bucket]
+
+    location_constraint = s3.get_bucket_location(Bucket=bucket).get('LocationConstraint', None)
+    if location_constraint is None:
+        region = 'us-east-1'
+    elif location_constraint == 'EU':
+        region = 'eu-west-1'
+    else:
+        region = location_constraint
+
+    with bucket_regions_lock:
+        bucket_regions[bucket] = region
+    return region
+
+
+def create_s3_client(event, bucket_attribute, default_region):
+    return boto3.client('s3', **get_s3_client_args(event, bucket_attribute, default_region))
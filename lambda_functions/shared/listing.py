@@ -0,0 +1,589 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# Bucket listing helpers shared by list_bucket, plan_batches and the batch mode of plan_jobs.
+#
+# Keys stored in archive storage classes (see ARCHIVED_STORAGE_CLASSES) are also listed in 'archivedKeys', so
+# copy_keys can treat them separately. Given a 'modified_since' timestamp, keys modified since then are also listed in
+# 'recentKeys', so delete_orphaned_keys can tell which keys may be newer than its source key filter. Given a
+# 'large_object_threshold', keys of objects larger than that many bytes are also listed in 'largeKeys', so copy_keys
+# can leave them to the large-object lane (see 'largeObjectThreshold' in list_bucket).
+#
+# Listings can be narrowed down with a list filter (see ListFilter), given by these input event attributes:
+# {
+#     'prefixes': ['images/', 'videos/'],  # Optional, instead of 'prefix'. Listed in parallel, merged in key order.
+#     'exclude': ['tmp/*', '*.log'],  # Optional, shell style patterns of keys to leave alone.
+#     'excludeRegex': ['^backup-[0-9]+/'],  # Optional, regular expressions of keys to leave alone.
+#     'listParallelism': 8  # Optional, number of prefixes listed at the same time.
+# }
+# Excluded keys never make it into the state data. Patterns like 'tmp/*' exclude a whole prefix, which isn't listed
+# any further once the listing gets there. With a list filter, the 'token' of a listing result is the last key listed
+# (or the end of a prefix) instead of an S3 continuation token, so all prefixes can continue from the same position.
+#
+# A list of destination buckets is listed the same way and merged into one page of keys, so each key is only looked
+# up once in the source bucket. Keys missing from some of the destinations are listed in 'partialKeys' with the
+# indexes of the destinations that have them.
+#
+# copy_keys lists the range of keys it got from both buckets again, with their ETags, for its conditional copies.
+# batch_copy does the same to plan the copies of a Batch Operations job. Both go by listing_shows_change.
+#
+# The 'token' of a listing result is always a key to continue after (with a 'versionIdMarker' for versioned buckets),
+# like S3's StartAfter, not an S3 continuation token. So list_bucket can cut a page that doesn't fit into the state
+# size limit at any key (see fit_page) and continue from there, instead of listing a smaller page again.
+#
+
+# Imports
+
+import fnmatch
+import json
+import logging
+import os
+import re
+from calendar import timegm
+from threading import Thread
+
+
+# Constants
+
+ARCHIVED_STORAGE_CLASSES = ['GLACIER', 'DEEP_ARCHIVE']  # Objects in these classes need to be restored before copying.
+LIST_PARALLELISM = 8
+MAX_KEY_CHARACTER = u'\U0010ffff'  # Sorts after all other characters, so prefix + MAX_KEY_CHARACTER ends a prefix.
+GLOB_CHARACTERS = '*?['
+MAX_KEYS = 1000  # Per page, the maximum for one S3 list request.
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024  # bytes, larger objects need a multipart copy.
+LIST_ATTRIBUTES = ['keys', 'archivedKeys', 'recentKeys', 'largeKeys']  # Attributes of a listing result with key lists.
+MAP_ATTRIBUTES = ['currentVersions', 'noncurrentVersions', 'partialKeys']  # And with dicts by key.
+
+
+# Globals
+
+logger = logging.getLogger()
+
+
+# Classes
+
+class ListFilter(object):
+    # Include prefixes and exclude patterns, see the top of this file.
+    def __init__(self, prefixes=None, exclude=None, exclude_regex=None, parallelism=LIST_PARALLELISM):
+        exclude = exclude or []
+        self.patterns = [re.compile(fnmatch.translate(p)) for p in exclude]
+        self.regexes = [re.compile(r) for r in exclude_regex or []]
+        # 'tmp/*' excludes everything starting with 'tmp/', so that part of the bucket can be skipped.
+        self.excluded_prefixes = sorted(set(
+            p[:-1] for p in exclude if p.endswith('*') and not any(c in p[:-1] for c in GLOB_CHARACTERS)
+        ))
+        self.parallelism = parallelism
+
+        # Prefixes within other or excluded prefixes are dropped, so the remaining ones are disjoint.
+        self.prefixes = []
+        for prefix in sorted(set(prefixes or [''])):
+            if any(prefix.startswith(p) for p in self.prefixes) or self.get_excluded_prefix(prefix) is not None:
+                continue
+            self.prefixes.append(prefix)
+
+    def get_excluded_prefix(self, key):
+        for prefix in self.excluded_prefixes:
+            if key.startswith(prefix):
+                return prefix
+        return None
+
+    def is_excluded(self, key):
+        return (
+            self.get_excluded_prefix(key) is not None or
+            any(p.match(key) for p in self.patterns) or
+            any(r.search(key) for r in self.regexes)
+        )
+
+    def skip_excluded(self, position):
+        # Move a list position within an excluded prefix to its end.
+        prefix = self.get_excluded_prefix(position)
+        return position if prefix is None else prefix + MAX_KEY_CHARACTER
+
+    def get_pending_prefixes(self, position):
+        # Prefixes with keys after the given list position.
+        return [p for p in self.prefixes if position < p + MAX_KEY_CHARACTER]
+
+    def filter_result(self, result):
+        for attribute in ['keys', 'archivedKeys', 'recentKeys', 'largeKeys']:
+            if attribute in result:
+                result[attribute] = [k for k in result[attribute] if not self.is_excluded(k)]
+        for attribute in ['currentVersions', 'noncurrentVersions']:
+            if attribute in result:
+                result[attribute] = dict((k, v) for k, v in result[attribute].items() if not self.is_excluded(k))
+        for attribute in ['archivedKeys', 'recentKeys', 'largeKeys']:
+            if attribute in result and len(result[attribute]) == 0:
+                del result[attribute]  # Save some space in the common case.
+        return result
+
+    def list_page(
+        self, s3, args, token, version_id_marker, bucket_to_list, versioned, prune_noncurrent_versions,
+        mirror_delete_markers, modified_since=None, large_object_threshold=None
+    ):
+        # List the pending prefixes in waves, merging their pages in key order until the page is full. The first
+        # wave is the next prefix alone: A large prefix fills page after page by itself, and prefixes listed next to it
+        # would only be listed again for the next page. Later waves list up to 'parallelism' prefixes in parallel.
+        marker_name = 'KeyMarker' if versioned else 'StartAfter'
+        max_keys = args['MaxKeys']
+        position = self.skip_excluded(max(token or '', args.get(marker_name, '')))
+        if position != token:
+            version_id_marker = ''
+        pending = self.get_pending_prefixes(position)
+
+        def list_prefixes(prefixes):
+            results = [None] * len(prefixes)
+            errors = []
+
+            def list_prefix(i):
+                prefix_args = dict(args, Prefix=prefixes[i])
+                prefix_args.pop('ContinuationToken', None)
+                prefix_args.pop('VersionIdMarker', None)
+                if position != '':
+                    prefix_args[marker_name] = position
+                if versioned and version_id_marker != '' and position.startswith(prefixes[i]):
+                    prefix_args['VersionIdMarker'] = version_id_marker
+                try:
+                    results[i] = list_page(
+                        s3, prefix_args, bucket_to_list, versioned, prune_noncurrent_versions, mirror_delete_markers,
+                        modified_since, large_object_threshold
+                    )
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [Thread(target=list_prefix, args=(i,)) for i in range(len(prefixes))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            if len(errors) > 0:
+                raise errors[0]
+            return results
+
+        page = {
+            'keys': []
+        }
+        count = 0
+        next_token = ''
+        next_version_id_marker = ''
+        wave_size = 1
+        full = False
+        while not full and len(pending) > 0:
+            prefixes = pending[:wave_size]
+            pending = pending[wave_size:]
+            wave_size = self.parallelism
+            for i, (result, result_count) in enumerate(list_prefixes(prefixes)):
+                truncated = result['token'] != ''
+                if not versioned and len(page['keys']) + len(result['keys']) > max_keys:
+                    kept_keys = result['keys'][:max_keys - len(page['keys'])]
+                    kept = set(kept_keys)
+                    result['keys'] = kept_keys
+                    for attribute in ['archivedKeys', 'recentKeys', 'largeKeys']:
+                        if attribute in result:
+                            result[attribute] = [k for k in result[attribute] if k in kept]
+                    result_count = len(kept_keys)
+                    truncated = True
+                count += result_count
+
+                page['keys'] += result['keys']
+                for attribute in ['archivedKeys', 'recentKeys', 'largeKeys']:
+                    if attribute in result:
+                        page.setdefault(attribute, []).extend(result[attribute])
+                for attribute in ['currentVersions', 'noncurrentVersions']:
+                    if attribute in result:
+                        page.setdefault(attribute, {}).update(result[attribute])
+
+                if truncated:
+                    if versioned:
+                        next_token = result['token']
+                        next_version_id_marker = result.get('versionIdMarker', '')
+                    else:
+                        next_token = page['keys'][-1]
+                    full = True
+                    break
+                next_token = prefixes[i] + MAX_KEY_CHARACTER  # This prefix is done.
+                if len(page['keys']) >= max_keys:
+                    full = True
+                    break
+
+        if next_token != '':
+            skipped_token = self.skip_excluded(next_token)
+            if skipped_token != next_token:
+                next_token = skipped_token
+                next_version_id_marker = ''
+            if len(self.get_pending_prefixes(next_token)) == 0:
+                next_token = ''
+                next_version_id_marker = ''
+
+        page['token'] = next_token
+        if versioned:
+            page['versionIdMarker'] = next_version_id_marker
+        return self.filter_result(page), count
+
+
+# Functions
+
+def is_bucket_list(bucket):
+    return isinstance(bucket, list)
+
+
+def format_bucket(bucket):
+    # For log messages.
+    return ', '.join(bucket) if is_bucket_list(bucket) else bucket
+
+
+def create_list_filter(event):
+    # Returns None if the event doesn't ask for a list filter, so listing works with continuation tokens as before.
+    # Several destinations need one, so they can continue from the same key.
+    if (
+        not any(a in event for a in ['prefixes', 'exclude', 'excludeRegex']) and
+        not is_bucket_list(event.get('destination', ''))
+    ):
+        return None
+    return ListFilter(
+        prefixes=event.get('prefixes', [event.get('prefix', '')]),
+        exclude=event.get('exclude', []),
+        exclude_regex=event.get('excludeRegex', []),
+        parallelism=event.get('listParallelism', LIST_PARALLELISM)
+    )
+
+
+def add_archived_keys(result, contents):
+    archived_keys = [k['Key'] for k in contents if k.get('StorageClass', 'STANDARD') in ARCHIVED_STORAGE_CLASSES]
+    if len(archived_keys) > 0:  # Save some space in the common case.
+        result['archivedKeys'] = archived_keys
+
+
+def add_recent_keys(result, contents, modified_since):
+    if modified_since is None:
+        return
+    recent_keys = [k['Key'] for k in contents if timegm(k['LastModified'].utctimetuple()) >= modified_since]
+    if len(recent_keys) > 0:
+        result['recentKeys'] = recent_keys
+
+
+def add_large_keys(result, contents, large_object_threshold):
+    if large_object_threshold is None:
+        return
+    large_keys = [k['Key'] for k in contents if k.get('Size', 0) > large_object_threshold]
+    if len(large_keys) > 0:
+        result['largeKeys'] = large_keys
+
+
+def list_objects(s3, args, modified_since=None, large_object_threshold=None):
+    response = s3.list_objects_v2(**args)
+
+    contents = response.get('Contents', [])
+    keys = [k['Key'] for k in contents]
+    result = {
+        'keys': keys,
+        'token': keys[-1] if response.get('IsTruncated', False) and len(keys) > 0 else ''
+    }
+    add_archived_keys(result, contents)
+    add_recent_keys(result, contents, modified_since)
+    add_large_keys(result, contents, large_object_threshold)
+    return result, len(keys)
+
+
+def list_object_versions(
+    s3, args, include_current_versions=False, include_noncurrent_versions=False, modified_since=None
+):
+    response = s3.list_object_versions(**args)
+
+    # Versions and delete markers come in separate lists, but both are sorted by key, newest first.
+    entries = sorted(
+        response.get('Versions', []) + response.get('DeleteMarkers', []),
+        key=lambda e: (e['Key'], not e['IsLatest'])
+    )
+    next_key_marker = response.get('NextKeyMarker', '')
+    next_version_id_marker = response.get('NextVersionIdMarker', '')
+
+    # Don't split the versions of a key across pages, so its current version is always seen together with the
+    # noncurrent ones. Cut the page before the last key instead, unless it is the only key on this page.
+    if response.get('IsTruncated', False) and len(entries) > 0:
+        last_key = entries[-1]['Key']
+        remaining = [e for e in entries if e['Key'] != last_key]
+        if len(remaining) > 0:
+            entries = remaining
+            next_key_marker = remaining[-1]['Key']
+            next_version_id_marker = ''
+    else:
+        next_key_marker = ''
+        next_version_id_marker = ''
+
+    keys = []
+    current_entries = []
+    current_versions = {}
+    noncurrent_versions = {}
+    for e in entries:
+        if e['IsLatest']:
+            if 'ETag' in e:  # Only versions have ETags, delete markers don't.
+                keys.append(e['Key'])
+                current_entries.append(e)
+                current_versions[e['Key']] = e['VersionId']
+        else:
+            noncurrent_versions.setdefault(e['Key'], []).append(e['VersionId'])
+
+    result = {
+        'keys': keys,
+        'token': next_key_marker,
+        'versionIdMarker': next_version_id_marker
+    }
+    add_archived_keys(result, current_entries)
+    add_recent_keys(result, current_entries, modified_since)
+    if include_current_versions:
+        result['currentVersions'] = current_versions
+    if include_noncurrent_versions:
+        result['noncurrentVersions'] = noncurrent_versions
+
+    logger.info('Got ' + str(len(entries)) + ' versions and delete markers.')
+    return result, len(entries)
+
+
+def get_list_position(event, result_attribute):
+    # Returns the (token, version_id_marker) tuple to continue listing from: The end of the previous page in
+    # result_attribute, or the checkpoint of the previous execution (see prepare_continuation) in the first round.
+    if result_attribute in event:
+        position = event[result_attribute]
+    else:
+        position = event.get('checkpoint', {}).get(event['listBucket'], {})
+    return position.get('token', ''), position.get('versionIdMarker', '')
+
+
+def set_list_position(args, versioned, token, version_id_marker=''):
+    # Continue listing where the previous page ended.
+    if token is None or token == '':
+        return
+    if versioned:
+        args['KeyMarker'] = token
+        if version_id_marker != '':
+            args['VersionIdMarker'] = version_id_marker
+        else:
+            args.pop('VersionIdMarker', None)
+    else:
+        args['StartAfter'] = token
+
+
+def list_page(
+    s3, args, bucket_to_list, versioned, prune_noncurrent_versions, mirror_delete_markers, modified_since=None,
+    large_object_threshold=None
+):
+    # Returns a (result, count) tuple for one page of the source or destination bucket. Versioned listings have no
+    # 'largeKeys', their copies aren't split into lanes.
+    if versioned:
+        return list_object_versions(
+            s3,
+            args,
+            include_current_versions=(bucket_to_list == 'destination' and not mirror_delete_markers),
+            include_noncurrent_versions=(bucket_to_list == 'destination' and (
+                prune_noncurrent_versions or not mirror_delete_markers
+            )),
+            modified_since=modified_since
+        )
+    else:
+        return list_objects(
+            s3, args, modified_since=modified_since, large_object_threshold=large_object_threshold
+        )
+
+
+def list_next_page(
+    s3, args, token, version_id_marker, bucket_to_list, versioned, prune_noncurrent_versions, mirror_delete_markers,
+    modified_since=None, list_filter=None, large_object_threshold=None
+):
+    # Returns a (result, count) tuple for the page after the given list position.
+    if is_bucket_list(args['Bucket']):
+        return list_buckets_page(
+            s3, args, token, bucket_to_list, versioned, modified_since, list_filter or ListFilter([args['Prefix']])
+        )
+    if list_filter is not None:
+        return list_filter.list_page(
+            s3, args, token, version_id_marker, bucket_to_list, versioned, prune_noncurrent_versions,
+            mirror_delete_markers, modified_since, large_object_threshold
+        )
+    set_list_position(args, versioned, token, version_id_marker)
+    return list_page(
+        s3, args, bucket_to_list, versioned, prune_noncurrent_versions, mirror_delete_markers, modified_since,
+        large_object_threshold
+    )
+
+
+def fit_page(page, max_length):
+    # Returns the length of the page encoded as JSON. If that's more than max_length, the page is cut after the last key
+    # that fits, and its token is set to continue from there. Lengths are added up per key instead of encoding the page
+    # again for every key, they may be a few characters more than the actual length.
+    costs = {}
+    for attribute in LIST_ATTRIBUTES:
+        for key in page.get(attribute, []):
+            costs[key] = costs.get(key, 0) + len(json.dumps(key)) + 2  # With the ', ' separator.
+    for attribute in MAP_ATTRIBUTES:
+        for key, value in page.get(attribute, {}).items():
+            costs[key] = costs.get(key, 0) + len(json.dumps(key)) + len(json.dumps(value)) + 4  # With ': ' and ', '.
+    empty_page = dict(page, token='')
+    for attribute in LIST_ATTRIBUTES + MAP_ATTRIBUTES:
+        if attribute in page:
+            empty_page[attribute] = [] if attribute in LIST_ATTRIBUTES else {}
+    base_length = len(json.dumps(empty_page))
+
+    length = base_length + len(json.dumps(page['token'])) - 2 + sum(costs.values())
+    if length <= max_length:
+        return length
+
+    last_key = None
+    cut_length = base_length - 2
+    for key in sorted(costs):
+        if cut_length + costs[key] + len(json.dumps(key)) > max_length:
+            break
+        cut_length += costs[key]
+        last_key = key
+    if last_key is None:
+        raise ValueError('Not even one key fits into: ' + str(max_length) + ' characters.')
+
+    for attribute in LIST_ATTRIBUTES:
+        if attribute in page:
+            page[attribute] = [k for k in page[attribute] if k <= last_key]
+    for attribute in MAP_ATTRIBUTES:
+        if attribute in page:
+            page[attribute] = dict((k, v) for k, v in page[attribute].items() if k <= last_key)
+    page['token'] = last_key
+    if 'versionIdMarker' in page:
+        page['versionIdMarker'] = ''  # Pages have all versions of their keys, continue with the next key.
+    return length
+
+
+def list_small_bucket(s3, event, bucket_to_list, max_keys=MAX_KEYS, max_pages=None):
+    # Lists all current keys of a bucket with the prefix, start key and list filter of the event, for the small bucket
+    # pairs of batch mode. Returns None if there are more than max_pages pages of max_keys keys.
+    args = {
+        'Bucket': event[bucket_to_list],
+        'MaxKeys': max_keys,
+        'Prefix': event.get('prefix', ''),
+        'StartAfter': event.get('startAfter', '')
+    }
+    list_filter = create_list_filter(event)
+    result = {
+        'keys': [],
+        'archivedKeys': []
+    }
+    token = ''
+    pages = 0
+    while True:
+        page, _ = list_next_page(s3, args, token, '', bucket_to_list, False, False, True, list_filter=list_filter)
+        result['keys'].extend(page['keys'])
+        result['archivedKeys'].extend(page.get('archivedKeys', []))
+        token = page['token']
+        pages += 1
+        if token == '':
+            return result
+        if max_pages is not None and pages >= max_pages:
+            return None
+
+
+def list_buckets_page(s3, args, token, bucket_to_list, versioned, modified_since, list_filter):
+    # Merge the pages of several buckets in key order. The merged page ends where the first of them ended, because the
+    # others may have keys before the end of their page that aren't listed yet.
+    if versioned:
+        raise ValueError('Versioned buckets can only be synchronized to one destination bucket.')
+    buckets = args['Bucket']
+    results = [None] * len(buckets)
+    errors = []
+
+    def list_bucket(i):
+        try:
+            results[i], _ = list_filter.list_page(
+                s3, dict(args, Bucket=buckets[i]), token, '', bucket_to_list, False, False, True, modified_since
+            )
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=list_bucket, args=(i,)) for i in range(len(buckets))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+    positions = [r['token'] for r in results if r['token'] != '']
+    end = min(positions) if len(positions) > 0 else None
+    key_sets = [set(k for k in r['keys'] if end is None or k <= end) for r in results]
+    page = {
+        'keys': sorted(set.union(*key_sets)),
+        'token': end or ''
+    }
+
+    partial_keys = {}
+    for key in page['keys']:
+        indexes = [i for i, keys in enumerate(key_sets) if key in keys]
+        if len(indexes) < len(buckets):
+            partial_keys[key] = indexes
+    if len(partial_keys) > 0:
+        page['partialKeys'] = partial_keys
+    for attribute in ['archivedKeys', 'recentKeys', 'largeKeys']:
+        keys = set(k for r in results for k in r.get(attribute, []) if end is None or k <= end)
+        if len(keys) > 0:
+            page[attribute] = sorted(keys)
+
+    return page, len(page['keys'])
+
+
+def get_etag_part_count(etag):
+    # Multipart ETags look like: '"<digest of part digests>-<number of parts>"'. Returns 0 for non-multipart ETags.
+    if etag is None:
+        return 0
+    digest, _, part_count = etag.strip('"').rpartition('-')
+    if digest == '' or not part_count.isdigit():
+        return 0
+    return int(part_count)
+
+
+def listing_shows_change(source_entry, destination_entry, compare_mode):
+    # Only for changes a single CopyObject request takes care of: No redirects (empty objects), no part layouts to
+    # keep, no objects too large for a single copy, and no ETags that need a closer look at checksums or metadata.
+    if source_entry['Size'] == 0 or source_entry['Size'] > MAX_COPY_OBJECT_SIZE:
+        return False
+    if source_entry.get('StorageClass', 'STANDARD') in ARCHIVED_STORAGE_CLASSES:
+        return False
+    if compare_mode != 'etag' and get_etag_part_count(source_entry['ETag']) > 0:
+        return False
+    if destination_entry is None:
+        return True
+    if source_entry['ETag'] == destination_entry['ETag']:
+        return False  # Metadata may still differ.
+    if compare_mode == 'etag' or source_entry['Size'] != destination_entry['Size']:
+        return True
+    return compare_mode == 'multipart' and get_etag_part_count(destination_entry['ETag']) == 0
+
+
+def list_key_range(s3, bucket, first_key, last_key, max_pages):
+    # Returns a ({key: list entry}, listed until) tuple for the keys from first_key to last_key, with their ETag, Size
+    # and StorageClass. Stops after max_pages pages: Keys after 'listed until' may exist but are not listed then.
+    # Listing starts after first_key without its last character, which sorts right before it.
+    args = {
+        'Bucket': bucket,
+        'Prefix': os.path.commonprefix([first_key, last_key]),
+        'MaxKeys': MAX_KEYS,
+        'StartAfter': first_key[:-1]
+    }
+    entries = {}
+    listed_until = ''
+    for _ in range(max_pages):
+        response = s3.list_objects_v2(**args)
+        contents = response.get('Contents', [])
+        for entry in contents:
+            if entry['Key'] > last_key:
+                return entries, last_key
+            if entry['Key'] >= first_key:
+                entries[entry['Key']] = entry
+        if not response.get('IsTruncated', False):
+            return entries, last_key
+        args['ContinuationToken'] = response['NextContinuationToken']
+        if len(contents) > 0:
+            listed_until = contents[-1]['Key']
+    return entries, listed_until
@@ -0,0 +1,223 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# Opt-in profiling of Lambda function handlers, for finding out where the time of a slow invocation goes. Handlers
+# decorated with @profiled run as usual, unless the input event has:
+# {
+#     'profile': true,
+#     'profileMemory': true,  # Optional, also report the top allocation sites.
+#     'profileTop': 40,  # Optional, number of functions and allocation sites in the report.
+#     'scratchBucket': 'scratch-bucket',  # Required, the profiles are stored here.
+#     'scratchPrefix': 's3-sync/'  # Optional.
+# }
+#
+# The handler runs under cProfile, including the worker threads it starts. Two artifacts are stored in the scratch
+# bucket under: <scratchPrefix>profiles/<execution name>/<function name>[-<listBucket>]/<timestamp>-<request ID>
+# - '.txt': A report with the wall time, the length of the result and the top functions by cumulative and own time,
+#   and with 'profileMemory' the top allocation sites (tracemalloc), or the object types that grew the most on Python
+#   versions without tracemalloc, and the peak memory use.
+# - '.prof': The raw stats for pstats or a profile viewer, e.g. pstats.Stats('copy_keys.prof').
+#
+# The execution name comes from the 'execution' the state machine adds to the input, see RecordExecutionStart.
+#
+# Without 'profile', the overhead is one dictionary lookup per invocation.
+#
+
+# Imports
+
+import boto3
+import cProfile
+import gc
+import json
+import logging
+import marshal
+import pstats
+import resource
+import sys
+import threading
+import time
+from StringIO import StringIO
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+# Constants
+
+SCRATCH_PREFIX = 's3-sync/'
+PROFILE_TOP = 40
+UNKNOWN_EXECUTION = 'unknown-execution'  # Batch mode plans jobs before the execution is recorded.
+
+
+# Globals
+
+logger = logging.getLogger()
+
+# Profiled invocations running in this process. Lambda runs one at a time, the local state machine runs parallel
+# branches in the same process: New threads are profiled for the latest one.
+active_thread_profiles = []
+active_thread_profiles_lock = threading.Lock()
+
+
+# Classes
+
+class ThreadProfiles(object):
+    # Profiles the calling thread, and each thread started while it is enabled with a cProfile.Profile of its own.
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def profile_thread(self):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def enable(self):
+        with active_thread_profiles_lock:
+            active_thread_profiles.append(self)
+            threading.setprofile(profile_new_thread)
+        self.profile_thread()
+
+    def disable(self):
+        self.profiles[0].disable()
+        with active_thread_profiles_lock:
+            active_thread_profiles.remove(self)
+            if len(active_thread_profiles) == 0:
+                threading.setprofile(None)
+
+    def create_stats(self):
+        with self.lock:
+            stats = pstats.Stats(self.profiles[0])
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+        return stats
+
+
+class MemoryProfile(object):
+    # Top allocation sites with tracemalloc, object counts by type otherwise.
+    def __init__(self):
+        self.type_counts = None
+
+    def start(self):
+        if tracemalloc is not None:
+            tracemalloc.start()
+        else:
+            self.type_counts = count_object_types()
+
+    def stop(self, top):
+        lines = ['Peak memory use: ' + str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024) + ' MB']
+        if tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            lines.append('Peak traced memory: ' + str(tracemalloc.get_traced_memory()[1] // 1024) + ' KB')
+            tracemalloc.stop()
+            lines.append('Top allocation sites:')
+            lines.extend(str(s) for s in snapshot.statistics('lineno')[:top])
+        else:
+            type_counts = count_object_types()
+            growth = sorted(
+                ((count - self.type_counts.get(name, 0), name) for name, count in type_counts.items()), reverse=True
+            )
+            lines.append('Object types that grew the most (tracemalloc needs Python 3):')
+            lines.extend(name + ': +' + str(count) for count, name in growth[:top] if count > 0)
+        return '\n'.join(lines)
+
+
+# Utility functions
+
+def profile_new_thread(*_):
+    # Installed with threading.setprofile(), called once at the start of each new thread. Enabling a profiler replaces
+    # this function for the thread.
+    with active_thread_profiles_lock:
+        thread_profiles = active_thread_profiles[-1] if len(active_thread_profiles) > 0 else None
+    if thread_profiles is not None:
+        thread_profiles.profile_thread()
+    else:
+        sys.setprofile(None)
+
+
+def count_object_types():
+    type_counts = {}
+    for o in gc.get_objects():
+        name = type(o).__name__
+        type_counts[name] = type_counts.get(name, 0) + 1
+    return type_counts
+
+
+def format_stats(stats, sort_key, top):
+    output = StringIO()
+    stats.stream = output
+    stats.sort_stats(sort_key).print_stats(top)
+    return output.getvalue()
+
+
+def get_profile_key(event, context):
+    name = context.function_name
+    if 'listBucket' in event:
+        name += '-' + event['listBucket']
+    return (
+        event.get('scratchPrefix', SCRATCH_PREFIX) + 'profiles/' +
+        event.get('execution', {}).get('name', UNKNOWN_EXECUTION) + '/' + name + '/' +
+        time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()) + '-' + context.aws_request_id
+    )
+
+
+def run_profiled(handler, event, context):
+    if 'scratchBucket' not in event:
+        raise ValueError('Profiles need a scratchBucket to be stored in.')
+    top = event.get('profileTop', PROFILE_TOP)
+    memory_profile = MemoryProfile() if event.get('profileMemory', False) else None
+    thread_profiles = ThreadProfiles()
+
+    if memory_profile is not None:
+        memory_profile.start()
+    start_time = time.time()
+    thread_profiles.enable()
+    result = None
+    try:
+        result = handler(event, context)
+        return result
+    finally:
+        thread_profiles.disable()
+        wall_time = time.time() - start_time
+
+        report = [
+            'Function: ' + context.function_name,
+            'Wall time: {0:.3f}s'.format(wall_time),
+            'Threads profiled: ' + str(len(thread_profiles.profiles)),
+            'Result length: ' + str(len(json.dumps(result, default=str)))
+        ]
+        stats = thread_profiles.create_stats()
+        report.append(format_stats(stats, 'cumulative', top))
+        report.append(format_stats(stats, 'tottime', top))
+        if memory_profile is not None:
+            report.append(memory_profile.stop(top))
+
+        key = get_profile_key(event, context)
+        try:
+            s3 = boto3.client('s3', region_name=context.invoked_function_arn.split(':')[3])
+            s3.put_object(Bucket=event['scratchBucket'], Key=key + '.txt', Body='\n'.join(report))
+            s3.put_object(Bucket=event['scratchBucket'], Key=key + '.prof', Body=marshal.dumps(stats.stats))
+            logger.info('Stored profile in: s3://' + event['scratchBucket'] + '/' + key + '.txt')
+        except Exception as e:
+            logger.warning('Could not store profile: ' + key + ', error: ' + str(e))
+
+
+# Functions
+
+def profiled(handler):
+    def profiled_handler(event, context):
+        if isinstance(event, dict) and event.get('profile', False):
+            return run_profiled(handler, event, context)
+        return handler(event, context)
+    return profiled_handler
@@ -0,0 +1,224 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# Live progress records of running syncs, one per bucket pair, for query_progress to estimate how far along they are.
+#
+# Event attributes:
+# {
+#     'progressTable': 'sync-progress',  # DynamoDB table with a string hash key named 'progress', enables records.
+#     'progressName': 'images',  # Optional, defaults to the bucket pair.
+#     'progressRegion': 'us-east-1'  # Optional, region of the table, defaults to the region of the function.
+# }
+#
+# copy_keys and delete_orphaned_keys add the keys they looked at and their outcomes to the record after each
+# invocation, with one atomic update, so concurrent invocations don't need to coordinate. checkpoint_progress sets the
+# listing position of its branch after each round, and whether the branch is done.
+#
+# A record belongs to the sync that started at its 'startedAt' time (see get_sync_start_time), continuation
+# executions included. The first update of a newer sync replaces it, updates of an older sync are dropped.
+#
+# Record attributes:
+# {
+#     'progress': 'source-bucket/destination-bucket',
+#     'startedAt': 1500000000, 'updatedAt': 1500001234.5,  # Seconds since the epoch.
+#     'source': '...', 'destination': '...', 'prefix': '...', 'sourceRegion': '...', 'destinationRegion': '...',
+#     'narrowed': false,  # True if a list filter leaves out parts of the prefix, see query_progress.
+#     'sourceKeys': 0, 'copied': 0, 'current': 0, 'archived': 0, 'scannedBytes': 0, 'copiedBytes': 0,
+#     'destinationKeys': 0, 'deleted': 0,
+#     'sourcePosition': '...', 'sourceDone': false, 'destinationPosition': '...', 'destinationDone': false
+# }
+#
+
+# Imports
+
+import boto3
+import logging
+import time
+from botocore.exceptions import ClientError
+from calendar import timegm
+
+
+# Constants
+
+HASH_KEY = 'progress'
+MAX_ATTEMPTS = 3  # Updates that find another sync's record, or none, start a record of their own and try again.
+PAIR_ATTRIBUTES = ['source', 'destination', 'prefix', 'sourceRegion', 'destinationRegion']
+LIST_FILTER_ATTRIBUTES = ['prefixes', 'exclude', 'excludeRegex']
+
+
+# Globals
+
+logger = logging.getLogger()
+
+
+# Utility functions
+
+def parse_timestamp(timestamp):
+    # Step Functions timestamps look like: '2017-01-01T12:00:00.123Z'
+    return timegm(time.strptime(timestamp.split('.')[0].rstrip('Z'), '%Y-%m-%dT%H:%M:%S'))
+
+
+def get_elapsed_seconds(event):
+    # Seconds since the execution started, as a float, or None outside of an execution (see RecordExecutionStart).
+    if 'execution' not in event:
+        return None
+    return time.time() - parse_timestamp(event['execution']['startTime'])
+
+
+def is_over_budget(elapsed_seconds, budget):
+    # The execution time budget is used up once it has elapsed, so a budget of 0 hands off after every round.
+    return elapsed_seconds is not None and elapsed_seconds >= budget
+
+
+def to_attribute_value(value):
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if isinstance(value, (int, long)):
+        return {'N': str(value)}
+    if isinstance(value, float):
+        return {'N': repr(value)}
+    return {'S': value}
+
+
+def from_attribute_value(value):
+    if 'BOOL' in value:
+        return value['BOOL']
+    if 'N' in value:
+        number = float(value['N'])
+        return int(number) if number.is_integer() else number
+    return value['S']
+
+
+def from_item(item):
+    return dict((name, from_attribute_value(value)) for name, value in item.items())
+
+
+# Classes
+
+class ProgressRecord(object):
+    def __init__(self, dynamodb, table, name, started_at, pair):
+        self.dynamodb = dynamodb
+        self.table = table
+        self.name = name
+        self.started_at = int(started_at)
+        self.pair = pair  # Attributes of a new record, see PAIR_ATTRIBUTES.
+
+    def start_record(self):
+        # Replaces the record of an older sync. Returns False if a newer sync has the record.
+        item = dict((name, to_attribute_value(value)) for name, value in self.pair.items())
+        item.update({
+            HASH_KEY: {'S': self.name},
+            'startedAt': {'N': str(self.started_at)},
+            'updatedAt': {'N': repr(time.time())}
+        })
+        try:
+            self.dynamodb.put_item(
+                TableName=self.table,
+                Item=item,
+                ConditionExpression='attribute_not_exists(#progress) OR #startedAt < :startedAt',
+                ExpressionAttributeNames={'#progress': HASH_KEY, '#startedAt': 'startedAt'},
+                ExpressionAttributeValues={':startedAt': {'N': str(self.started_at)}}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+        # Another invocation of this sync may have been first.
+        item = self.dynamodb.get_item(
+            TableName=self.table,
+            Key={HASH_KEY: {'S': self.name}},
+            ConsistentRead=True
+        ).get('Item', {})
+        return int(float(item.get('startedAt', {'N': '0'})['N'])) <= self.started_at
+
+    def publish(self, counts=None, attributes=None):
+        # Adds the counts and sets the attributes. Returns False if the record belongs to a newer sync.
+        names = {'#startedAt': 'startedAt', '#updatedAt': 'updatedAt'}
+        values = {':startedAt': {'N': str(self.started_at)}, ':updatedAt': {'N': repr(time.time())}}
+        set_clauses = ['#updatedAt = :updatedAt']
+        add_clauses = []
+        for i, (name, value) in enumerate(sorted((attributes or {}).items())):
+            names['#s' + str(i)] = name
+            values[':s' + str(i)] = to_attribute_value(value)
+            set_clauses.append('#s' + str(i) + ' = :s' + str(i))
+        for i, (name, value) in enumerate(sorted((counts or {}).items())):
+            names['#a' + str(i)] = name
+            values[':a' + str(i)] = to_attribute_value(value)
+            add_clauses.append('#a' + str(i) + ' :a' + str(i))
+        update_expression = 'SET ' + ', '.join(set_clauses)
+        if len(add_clauses) > 0:
+            update_expression += ' ADD ' + ', '.join(add_clauses)
+
+        for _ in range(MAX_ATTEMPTS):
+            try:
+                self.dynamodb.update_item(
+                    TableName=self.table,
+                    Key={HASH_KEY: {'S': self.name}},
+                    UpdateExpression=update_expression,
+                    ConditionExpression='#startedAt = :startedAt',
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues=values
+                )
+                return True
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise e
+            if not self.start_record():
+                return False
+        return False
+
+
+# Functions
+
+def get_progress_name(event):
+    destination = event['destination']
+    if isinstance(destination, list):
+        destination = ','.join(destination)
+    return event.get('progressName', event['source'] + '/' + destination)
+
+
+def get_sync_start_time(event):
+    # The start of the first execution of the sync: Continuations carry it in 'syncStartTime', see prepare_continuation.
+    # Returns None for invocations outside a sync, e.g. the packs of batch mode.
+    if 'syncStartTime' in event:
+        return event['syncStartTime']
+    if 'execution' in event:
+        return parse_timestamp(event['execution']['startTime'])
+    return None
+
+
+def create_progress_record(event, function_region):
+    # Returns None unless the event asks for progress records.
+    if 'progressTable' not in event:
+        return None
+    started_at = get_sync_start_time(event)
+    if started_at is None:
+        return None
+    pair = dict((k, event[k]) for k in PAIR_ATTRIBUTES if k in event and not isinstance(event[k], list))
+    pair['narrowed'] = any(a in event for a in LIST_FILTER_ATTRIBUTES)
+    return ProgressRecord(
+        boto3.client('dynamodb', region_name=event.get('progressRegion', function_region)),
+        event['progressTable'],
+        get_progress_name(event),
+        started_at,
+        pair
+    )
+
+
+def publish_progress(event, function_region, counts=None, attributes=None):
+    # Progress records are for watching a sync, failing to update one must not fail it.
+    try:
+        progress_record = create_progress_record(event, function_region)
+        if progress_record is not None and not progress_record.publish(counts, attributes):
+            logger.info('A newer sync of: ' + progress_record.name + ' has the progress record, not updating it.')
+    except Exception as e:
+        logger.warning('Could not update progress record: ' + str(e))
@@ -0,0 +1,169 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# Request rate and bandwidth budgets shared by all invocations syncing a bucket pair, for buckets that also serve
+# production traffic. The partition token buckets of shared/request_scheduler.py only know about the requests of their
+# own invocation; these budgets hold the copy and delete workers of all concurrent invocations to one total.
+#
+# Event attributes:
+# {
+#     'rateBudgetTable': 'sync-rate-budgets',  # DynamoDB table with a string hash key named 'budget', enables budgets.
+#     'requestRateBudget': 1000,  # Optional, requests per second to both buckets.
+#     'bandwidthBudget': 50000000,  # Optional, bytes per second copied.
+#     'rateBudgetName': 'images',  # Optional, defaults to the bucket pair. Pairs with the same name share budgets.
+#     'rateBudgetRegion': 'us-east-1'  # Optional, region of the table, defaults to the region of the function.
+# }
+#
+# Each budget is a token bucket in a DynamoDB item. Invocations lease LEASE_SECONDS worth of tokens at a time with a
+# conditional put, so there's one read and one write per lease, not per request. A lease may take more tokens than are
+# left, e.g. for a large part, leaving a debt the next leases wait for: The budget holds on average, not per request.
+# Leased tokens an invocation doesn't use are lost with it.
+#
+
+# Imports
+
+import boto3
+import random
+import time
+from botocore.exceptions import ClientError
+from threading import Lock
+
+
+# Constants
+
+HASH_KEY = 'budget'
+LEASE_SECONDS = 0.1  # Tokens leased at a time, in seconds worth of the budget.
+BURST_SECONDS = 1.0  # Budgets hold this many seconds worth of unused tokens.
+CONFLICT_DELAY = 0.01  # seconds, maximum random delay before leasing again after a concurrent lease.
+
+
+# Classes
+
+class SharedTokenBucket(object):
+    def __init__(self, dynamodb, table, name, rate, lease_seconds=LEASE_SECONDS):
+        self.dynamodb = dynamodb
+        self.table = table
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = self.rate * BURST_SECONDS
+        self.lease_size = self.rate * lease_seconds
+        self.tokens = 0.0  # Leased and not used yet.
+        self.lock = Lock()
+
+    def lease(self, tokens):
+        # Takes the tokens from the shared bucket. Returns 0, or the number of seconds to wait before trying again.
+        while True:
+            now = time.time()
+            item = self.dynamodb.get_item(
+                TableName=self.table,
+                Key={HASH_KEY: {'S': self.name}},
+                ConsistentRead=True
+            ).get('Item', None)
+            if item is None:
+                available = self.capacity
+                condition = 'attribute_not_exists(' + HASH_KEY + ')'
+                values = None
+                version = 0
+            else:
+                elapsed = max(0.0, now - float(item['updatedAt']['N']))
+                available = min(self.capacity, float(item['tokens']['N']) + elapsed * self.rate)
+                condition = 'version = :version'
+                values = {':version': item['version']}
+                version = int(item['version']['N'])
+            if available <= 0:
+                return -available / self.rate
+
+            args = {
+                'TableName': self.table,
+                'Item': {
+                    HASH_KEY: {'S': self.name},
+                    'tokens': {'N': repr(available - tokens)},
+                    'updatedAt': {'N': repr(now)},
+                    'version': {'N': str(version + 1)}
+                },
+                'ConditionExpression': condition
+            }
+            if values is not None:
+                args['ExpressionAttributeValues'] = values
+            try:
+                self.dynamodb.put_item(**args)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise e
+                time.sleep(random.random() * CONFLICT_DELAY)  # Another invocation leased at the same time.
+                continue
+            return 0
+
+    def acquire(self, tokens=1):
+        # Blocks until the tokens are available. Returns the number of seconds spent waiting for them, or for other
+        # threads of this invocation waiting for them: Only one thread at a time leases tokens or sleeps.
+        start_time = time.time()
+        with self.lock:
+            waited = time.time() - start_time
+            while self.tokens < tokens:
+                lease = max(tokens - self.tokens, self.lease_size)
+                wait_time = self.lease(lease)
+                if wait_time == 0:
+                    self.tokens += lease
+                else:
+                    time.sleep(wait_time)
+                    waited += wait_time
+            self.tokens -= tokens
+        return waited
+
+
+class RateBudget(object):
+    # The request rate and bandwidth budgets of a bucket pair.
+    def __init__(self, dynamodb, table, name, request_rate=None, bandwidth=None):
+        self.request_bucket = None
+        self.byte_bucket = None
+        if request_rate:
+            self.request_bucket = SharedTokenBucket(dynamodb, table, name + ':requests', request_rate)
+        if bandwidth:
+            self.byte_bucket = SharedTokenBucket(dynamodb, table, name + ':bytes', bandwidth)
+
+    def acquire_request(self):
+        if self.request_bucket is None:
+            return 0
+        return self.request_bucket.acquire()
+
+    def acquire_bytes(self, size):
+        if self.byte_bucket is None or size <= 0:
+            return 0
+        return self.byte_bucket.acquire(size)
+
+
+# Functions
+
+def get_budget_name(event):
+    destination = event['destination']
+    if isinstance(destination, list):
+        destination = ','.join(destination)
+    return event.get('rateBudgetName', event['source'] + '/' + destination)
+
+
+def create_rate_budget(event):
+    # Returns None unless the event sets a budget.
+    if 'rateBudgetTable' not in event:
+        return None
+    if not event.get('requestRateBudget', None) and not event.get('bandwidthBudget', None):
+        return None
+    client_args = {}
+    if 'rateBudgetRegion' in event:
+        client_args['region_name'] = event['rateBudgetRegion']
+    return RateBudget(
+        boto3.client('dynamodb', **client_args),
+        event['rateBudgetTable'],
+        get_budget_name(event),
+        request_rate=event.get('requestRateBudget', None),
+        bandwidth=event.get('bandwidthBudget', None)
+    )
@@ -0,0 +1,88 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# An index of orphaned destination objects by their content, see build_rename_index, copy_keys and
+# delete_orphaned_keys.
+#
+# When keys are renamed or moved in the source bucket, their new keys are missing from the destination and their old
+# keys are orphans there. Objects with the same ETag and size have the same content, so a key missing from the
+# destination can be copied from an orphan with the source's ETag and size, inside the destination bucket, instead of
+# from the source. Orphans in the index are only deleted after all keys have been copied.
+#
+# Serialized form: JSON with a list of [key, ETag, size] entries in key order.
+#
+
+# Imports
+
+import boto3
+import json
+from threading import Lock
+
+
+# Constants
+
+CAPACITY = 100000  # Orphans, keeps the index at a few MB. More orphans are deleted without being indexed.
+
+
+# Globals
+
+rename_index_cache = {}  # Indexes don't change once they are complete. Holds the last one used by this container.
+rename_index_cache_lock = Lock()
+
+
+# Classes
+
+class RenameIndex(object):
+    def __init__(self, orphans=None):
+        self.orphans = []
+        self.keys = set()
+        self.contents = {}
+        for key, etag, size in orphans or []:
+            self.add(key, etag, size)
+
+    def add(self, key, etag, size):
+        self.orphans.append([key, etag, size])
+        self.keys.add(key)
+        self.contents.setdefault((etag, size), key)
+
+    def find(self, etag, size):
+        # Returns the key of an orphan with this content, or None.
+        return self.contents.get((etag, size), None)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.orphans)
+
+    def to_bytes(self):
+        return json.dumps({'orphans': sorted(self.orphans)})
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(json.loads(data)['orphans'])
+
+
+# Functions
+
+def load_rename_index(rename_index_result, region):
+    # Returns None while the index is incomplete.
+    if rename_index_result.get('token', '') != '':
+        return None
+    location = (rename_index_result['bucket'], rename_index_result['key'])
+    with rename_index_cache_lock:
+        if location not in rename_index_cache:
+            s3 = boto3.client('s3', region_name=region)
+            response = s3.get_object(Bucket=location[0], Key=location[1])
+            rename_index_cache.clear()
+            rename_index_cache[location] = RenameIndex.from_bytes(response['Body'].read())
+        return rename_index_cache[location]
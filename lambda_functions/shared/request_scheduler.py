@@ -0,0 +1,246 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# Prefix partition aware scheduling of Amazon S3 requests.
+#
+# Amazon S3 scales request rates per prefix partition (roughly 3,500 writes and 5,500 reads per second). Sorted key
+# batches hit one prefix at a time, so we get SlowDown errors from one partition while others sit idle. The
+# PartitionedQueue hands out keys round-robin across partitions, and the RequestScheduler wraps S3 clients so every
+# request first takes a token from the bucket of its partition.
+#
+# Event attributes, all optional:
+# {
+#     'partitionDelimiter': '/',  # Partitions are key prefixes up to the partitionDepth'th delimiter.
+#     'partitionDepth': 1,
+#     'partitionReadRate': 5500,  # Requests per second per partition, for this invocation.
+#     'partitionWriteRate': 3500
+# }
+#
+# With a request rate or bandwidth budget for the bucket pair (see shared/rate_budget.py), requests also take a token
+# from the budget, and copy_keys takes tokens for the bytes it copies. The time spent waiting for budget tokens is
+# reported as 'budgetThrottledSeconds'.
+#
+
+# Imports
+
+import time
+from collections import deque
+from threading import Lock
+from Queue import Empty
+from shared.rate_budget import create_rate_budget
+
+
+# Constants
+
+PARTITION_DELIMITER = '/'
+PARTITION_DEPTH = 1
+PARTITION_READ_RATE = 5500  # Requests per second.
+PARTITION_WRITE_RATE = 3500  # Requests per second.
+BURST_SECONDS = 0.1  # Token buckets hold this many seconds worth of requests.
+MAX_REPORTED_PARTITIONS = 10  # Keep the output small, Step Functions has a size limit for state data.
+READ_OPERATIONS = [
+    'head_object',
+    'get_object',
+    'get_object_attributes',
+    'get_object_tagging',
+    'list_objects_v2',
+    'list_object_versions'
+]
+COPY_OPERATIONS = ['copy_object', 'upload_part_copy']  # These also read from the source partition.
+
+
+# Functions
+
+def get_partition(key, delimiter=PARTITION_DELIMITER, depth=PARTITION_DEPTH):
+    components = key.split(delimiter)
+    if len(components) <= depth:
+        return ''  # Keys without enough delimiters share the partition at the root of the bucket.
+    return delimiter.join(components[:depth]) + delimiter
+
+
+def create_scheduler(event):
+    return RequestScheduler(
+        delimiter=event.get('partitionDelimiter', PARTITION_DELIMITER),
+        depth=event.get('partitionDepth', PARTITION_DEPTH),
+        read_rate=event.get('partitionReadRate', PARTITION_READ_RATE),
+        write_rate=event.get('partitionWriteRate', PARTITION_WRITE_RATE),
+        budget=create_rate_budget(event)
+    )
+
+
+# Classes
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate * BURST_SECONDS))
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self.lock = Lock()
+
+    def try_acquire(self, tokens=1):
+        # Returns 0 if the tokens were acquired, or the number of seconds to wait before trying again.
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        # Blocks until the tokens are available. Returns the number of seconds spent waiting.
+        waited = 0
+        while True:
+            wait_time = self.try_acquire(tokens)
+            if wait_time == 0:
+                return waited
+            time.sleep(wait_time)
+            waited += wait_time
+
+
+class PartitionedQueue(object):
+    # A subset of the Queue.Queue interface that hands out keys round-robin across their partitions.
+    def __init__(self, delimiter=PARTITION_DELIMITER, depth=PARTITION_DEPTH):
+        self.delimiter = delimiter
+        self.depth = depth
+        self.partitions = {}
+        self.rotation = deque()
+        self.lock = Lock()
+
+    def put(self, key, *_):
+        partition = get_partition(key, self.delimiter, self.depth)
+        with self.lock:
+            if partition not in self.partitions:
+                self.partitions[partition] = deque()
+                self.rotation.append(partition)
+            self.partitions[partition].append(key)
+
+    def get(self, *_):
+        # Never blocks: All keys are queued before the workers start.
+        with self.lock:
+            if len(self.rotation) == 0:
+                raise Empty()
+            partition = self.rotation.popleft()
+            keys = self.partitions[partition]
+            key = keys.popleft()
+            if len(keys) > 0:
+                self.rotation.append(partition)
+            else:
+                del self.partitions[partition]
+            return key
+
+    def empty(self):
+        with self.lock:
+            return len(self.rotation) == 0
+
+
+class ThrottledClient(object):
+    # Wraps a boto3 S3 client. Requests on objects wait for a token of their partition first.
+    def __init__(self, client, scheduler):
+        self.client = client
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            if 'Bucket' in kwargs:
+                kind = 'read' if name in READ_OPERATIONS else 'write'
+                self.scheduler.acquire(kwargs['Bucket'], kwargs.get('Key', kwargs.get('Prefix', '')), kind)
+            if name in COPY_OPERATIONS:
+                self.scheduler.acquire(kwargs['CopySource']['Bucket'], kwargs['CopySource']['Key'], 'read')
+            return attribute(*args, **kwargs)
+
+        return call
+
+
+class RequestScheduler(object):
+    def __init__(
+        self, delimiter=PARTITION_DELIMITER, depth=PARTITION_DEPTH, read_rate=PARTITION_READ_RATE,
+        write_rate=PARTITION_WRITE_RATE, budget=None
+    ):
+        self.delimiter = delimiter
+        self.depth = depth
+        self.rates = {
+            'read': read_rate,
+            'write': write_rate
+        }
+        self.token_buckets = {}
+        self.request_counts = {}
+        self.throttled_seconds = 0.0
+        self.budget = budget  # Replaced per bucket pair when syncing a pack of them, see plan_jobs.
+        self.budget_throttled_seconds = None if budget is None else 0.0
+        self.start_time = time.time()
+        self.lock = Lock()
+
+    def create_queue(self):
+        return PartitionedQueue(self.delimiter, self.depth)
+
+    def wrap(self, client):
+        return ThrottledClient(client, self)
+
+    def acquire(self, bucket, key, kind):
+        partition = (bucket, get_partition(key, self.delimiter, self.depth), kind)
+        with self.lock:
+            if partition not in self.token_buckets:
+                self.token_buckets[partition] = TokenBucket(self.rates[kind])
+            token_bucket = self.token_buckets[partition]
+            self.request_counts[partition] = self.request_counts.get(partition, 0) + 1
+
+        waited = token_bucket.acquire()
+        if waited > 0:
+            with self.lock:
+                self.throttled_seconds += waited
+        if self.budget is not None:
+            self.add_budget_wait(self.budget.acquire_request())
+
+    def acquire_bytes(self, size):
+        if self.budget is not None:
+            self.add_budget_wait(self.budget.acquire_bytes(size))
+
+    def set_budget(self, budget):
+        self.budget = budget
+        if budget is not None and self.budget_throttled_seconds is None:
+            self.budget_throttled_seconds = 0.0
+
+    def add_budget_wait(self, waited):
+        with self.lock:
+            self.budget_throttled_seconds += waited
+
+    def report(self):
+        # Achieved request rates of the busiest partitions, over the lifetime of this scheduler.
+        elapsed = max(time.time() - self.start_time, 0.001)
+        with self.lock:
+            busiest = sorted(self.request_counts.items(), key=lambda i: -i[1])[:MAX_REPORTED_PARTITIONS]
+            throttled_seconds = self.throttled_seconds
+            budget_throttled_seconds = self.budget_throttled_seconds
+
+        result = {
+            'partitionCount': len(set((b, p) for b, p, _ in self.request_counts.keys())),
+            'throttledSeconds': round(throttled_seconds, 3),
+            'busiestPartitions': [
+                {
+                    'bucket': bucket,
+                    'partition': partition,
+                    'kind': kind,
+                    'requests': count,
+                    'rate': round(count / elapsed, 1)
+                } for (bucket, partition, kind), count in busiest
+            ]
+        }
+        if budget_throttled_seconds is not None:
+            result['budgetThrottledSeconds'] = round(budget_throttled_seconds, 3)
+        return result
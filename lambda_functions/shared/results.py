@@ -0,0 +1,75 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# Adding up the results of copy_keys and delete_orphaned_keys, see aggregate_batch_results and checkpoint_progress.
+#
+# Counts are added up, and request rates are combined per partition with the total number of requests and the highest
+# rate a single batch achieved. 'batches' counts the results added up. Results per destination bucket, when syncing to
+# several, are added up per bucket.
+#
+
+# Constants
+
+RESULT_ATTRIBUTES = {  # Where the worker of each branch puts its result, by the bucket the branch lists.
+    'source': 'copyResult',
+    'destination': 'deleteResult'
+}
+MAX_REPORTED_PARTITIONS = 10  # Same as in shared/request_scheduler.py.
+
+
+# Functions
+
+def merge_request_rates(total, rates):
+    result = {
+        'partitionCount': max(total.get('partitionCount', 0), rates.get('partitionCount', 0)),
+        'throttledSeconds': round(total.get('throttledSeconds', 0) + rates.get('throttledSeconds', 0), 3)
+    }
+
+    if 'budgetThrottledSeconds' in total or 'budgetThrottledSeconds' in rates:
+        result['budgetThrottledSeconds'] = round(
+            total.get('budgetThrottledSeconds', 0) + rates.get('budgetThrottledSeconds', 0), 3
+        )
+
+    partitions = {}
+    for p in total.get('busiestPartitions', []) + rates.get('busiestPartitions', []):
+        name = (p['bucket'], p['partition'], p['kind'])
+        if name in partitions:
+            partitions[name]['requests'] += p['requests']
+            partitions[name]['rate'] = max(partitions[name]['rate'], p['rate'])
+        else:
+            partitions[name] = dict(p)
+    result['busiestPartitions'] = sorted(partitions.values(), key=lambda p: -p['requests'])[:MAX_REPORTED_PARTITIONS]
+
+    return result
+
+
+def merge_counts(total, counts):
+    for name, value in counts.items():
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            total[name] = total.get(name, 0) + value
+    return total
+
+
+def merge_results(total, result):
+    for name, value in result.items():
+        if name == 'destinations':
+            destinations = total.setdefault(name, {})
+            for bucket, counts in value.items():
+                merge_counts(destinations.setdefault(bucket, {}), counts)
+        elif name == 'requestRates':
+            total[name] = merge_request_rates(total.get(name, {}), value)
+        elif name == 'batches':
+            continue
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            total[name] = total.get(name, 0) + value
+    total['batches'] = total.get('batches', 0) + result.get('batches', 1)  # Results of single batches don't count.
+    return total
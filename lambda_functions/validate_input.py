@@ -13,15 +13,27 @@
 # YAML front matter with parameters for deployment as a Lambda function.
 #
 # ---
-# Description: "Check if the sourceRegion and destinationRegion attributes of the event dict are equal."
+# Description: "Check if source and destination regions are equal, or objects are streamed between them."
 # MemorySize: 128
 # Timeout: 10
 # Policies:
 # ---
 #
-# Input event: A dict with the sourceRegion and destinationRegion attributes.
+# Input event: A dict with the sourceRegion and destinationRegion attributes, and optionally 'copyMode'. Objects can
+# only be streamed between regions (see copy_keys), server side copies need both buckets in the same region.
 #
+# Options that don't work together fail the execution here, before the copy and delete branches start: Versioned
+# buckets can't be synchronized to a list of destination buckets.
+#
+
+# Imports
+
+from shared.listing import is_bucket_list
+
 
+# Functions
 
 def handler(event, _):
-    return event['sourceRegion'] == event['destinationRegion']
+    if event.get('versioned', False) and is_bucket_list(event.get('destination', None)):
+        raise ValueError('Versioned buckets can only be synchronized to one destination bucket.')
+    return event['sourceRegion'] == event['destinationRegion'] or event.get('copyMode', 'server') == 'stream'
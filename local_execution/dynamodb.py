@@ -0,0 +1,180 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# An in-memory stand-in for the Amazon DynamoDB client, implementing the subset of the boto3 DynamoDB client API used
+# by shared/rate_budget.py and shared/progress.py: Items by a single string hash key, consistent reads, scans,
+# conditional puts and updates with conditions of the form "attribute_not_exists(<name>) OR <name> = :<value>" (or <),
+# and update expressions of the form "SET <name> = :<value>, ... ADD <name> :<number>, ...". Names can be given as
+# #<placeholder> with ExpressionAttributeNames. Use LocalDynamoDB.installed() to make boto3.client('dynamodb') return
+# it.
+#
+
+# Imports
+
+import boto3
+import copy
+import re
+import time
+from botocore.exceptions import ClientError
+from contextlib import contextmanager
+from threading import Lock
+
+
+# Constants
+
+CONDITION_PATTERNS = [
+    (re.compile(r'^attribute_not_exists\(([#\w]+)\)$'), lambda item, name, _: name not in item),
+    (re.compile(r'^([#\w]+) = (:\w+)$'), lambda item, name, value: name in item and item[name] == value),
+    (
+        re.compile(r'^([#\w]+) < (:\w+)$'),
+        lambda item, name, value: name in item and float(item[name]['N']) < float(value['N'])
+    )
+]
+UPDATE_CLAUSE_PATTERN = re.compile(r'^(SET|ADD) ')
+
+
+# Utility functions
+
+def client_error(code, operation_name, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation_name)
+
+
+# Classes
+
+class LocalDynamoDB(object):
+    def __init__(self, latency=0.0):
+        self.latency = latency  # Seconds to wait per request, to simulate the network.
+        self.tables = {}
+        self.hash_keys = {}
+        self.request_counts = {}
+        self.lock = Lock()
+
+    # Setup and inspection, these don't count as requests.
+
+    def add_table(self, table, hash_key):
+        self.tables[table] = {}
+        self.hash_keys[table] = hash_key
+
+    def client(self, *_, **__):
+        return self
+
+    @contextmanager
+    def installed(self):
+        # Make boto3.client('dynamodb') return this stand-in, other services are left alone.
+        original_client = boto3.client
+
+        def client(service_name, *args, **kwargs):
+            if service_name == 'dynamodb':
+                return self.client(*args, **kwargs)
+            return original_client(service_name, *args, **kwargs)
+
+        boto3.client = client
+        try:
+            yield self
+        finally:
+            boto3.client = original_client
+
+    # Internals
+
+    def _request(self, operation_name):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            self.request_counts[operation_name] = self.request_counts.get(operation_name, 0) + 1
+
+    def _table(self, table, operation_name):
+        if table not in self.tables:
+            raise client_error('ResourceNotFoundException', operation_name, 'Requested resource not found')
+        return self.tables[table]
+
+    def _item_key(self, table, key):
+        return key[self.hash_keys[table]]['S']
+
+    def _check_condition(self, item, condition, names, values, operation_name):
+        for clause in condition.split(' OR '):
+            for pattern, check in CONDITION_PATTERNS:
+                match = pattern.match(clause.strip())
+                if match is not None:
+                    value = values.get(match.group(2)) if len(match.groups()) > 1 else None
+                    if check(item, names.get(match.group(1), match.group(1)), value):
+                        return
+                    break
+            else:
+                raise client_error('ValidationException', operation_name, 'Unsupported condition: ' + clause)
+        raise client_error('ConditionalCheckFailedException', operation_name, 'The conditional request failed')
+
+    # Client API
+
+    def get_item(self, TableName, Key, ConsistentRead=False, **_):
+        self._request('GetItem')
+        items = self._table(TableName, 'GetItem')
+        with self.lock:
+            item = items.get(self._item_key(TableName, Key), None)
+            return {} if item is None else {'Item': copy.deepcopy(item)}
+
+    def _update(self, item, expression, names, values, operation_name):
+        # Splits 'SET a = :a, b = :b ADD c :c' into its SET and ADD clauses.
+        action = None
+        for part in re.split(r'\s+(?=(?:SET|ADD) )', expression.strip()):
+            match = UPDATE_CLAUSE_PATTERN.match(part)
+            if match is None:
+                raise client_error('ValidationException', operation_name, 'Unsupported update: ' + part)
+            action = match.group(1)
+            for clause in part[len(action) + 1:].split(','):
+                if action == 'SET':
+                    name, value = [s.strip() for s in clause.split('=')]
+                    item[names.get(name, name)] = copy.deepcopy(values[value])
+                else:
+                    name, value = clause.split()
+                    name = names.get(name, name)
+                    total = float(item.get(name, {'N': '0'})['N']) + float(values[value]['N'])
+                    item[name] = {'N': str(int(total)) if total.is_integer() else repr(total)}
+
+    def put_item(
+        self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+        **_
+    ):
+        self._request('PutItem')
+        items = self._table(TableName, 'PutItem')
+        key = Item[self.hash_keys[TableName]]['S']
+        with self.lock:
+            if ConditionExpression is not None:
+                self._check_condition(
+                    items.get(key, {}), ConditionExpression, ExpressionAttributeNames or {},
+                    ExpressionAttributeValues or {}, 'PutItem'
+                )
+            items[key] = copy.deepcopy(Item)
+        return {}
+
+    def update_item(
+        self, TableName, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+        ExpressionAttributeValues=None, **_
+    ):
+        self._request('UpdateItem')
+        items = self._table(TableName, 'UpdateItem')
+        key = self._item_key(TableName, Key)
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        with self.lock:
+            item = copy.deepcopy(items.get(key, {}))
+            if ConditionExpression is not None:
+                self._check_condition(item, ConditionExpression, names, values, 'UpdateItem')
+            item.update(copy.deepcopy(Key))
+            self._update(item, UpdateExpression, names, values, 'UpdateItem')
+            items[key] = item
+        return {}
+
+    def scan(self, TableName, **_):
+        self._request('Scan')
+        items = self._table(TableName, 'Scan')
+        with self.lock:
+            return {'Items': [copy.deepcopy(items[k]) for k in sorted(items)]}
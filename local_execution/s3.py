@@ -0,0 +1,509 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# An in-memory stand-in for the Amazon S3 client, implementing the subset of the boto3 S3 client API used by the
+# Lambda functions of this project. Use LocalS3.installed() to make boto3.client('s3') return it.
+#
+
+# Imports
+
+import base64
+import boto3
+import time
+import zlib
+from botocore.exceptions import ClientError
+from contextlib import contextmanager
+from datetime import datetime
+from hashlib import md5, sha1, sha256
+from io import BytesIO
+from threading import Lock
+try:
+    from urllib import unquote_plus
+except ImportError:  # Python 3
+    from urllib.parse import unquote_plus
+
+
+# Constants
+
+DEFAULT_REGION = 'us-east-1'
+MAX_LIST_KEYS = 1000
+METADATA_KEYS = [
+    'CacheControl',
+    'ContentDisposition',
+    'ContentEncoding',
+    'ContentLanguage',
+    'ContentType',
+    'Expires',
+    'Metadata',
+    'WebsiteRedirectLocation'
+]
+ARCHIVED_STORAGE_CLASSES = ['GLACIER', 'DEEP_ARCHIVE']
+
+
+# Utility functions
+
+def client_error(code, operation_name, message=''):
+    return ClientError({'Error': {'Code': str(code), 'Message': message}}, operation_name)
+
+
+def quote(digest):
+    return '"' + digest + '"'
+
+
+def crc32c(body):
+    # Bitwise CRC32C (Castagnoli), slow but good enough for test data.
+    crc = 0xffffffff
+    for byte in bytearray(body):
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0x82f63b78 & -(crc & 1))
+    return crc ^ 0xffffffff
+
+
+def crc64nvme(body):
+    # Bitwise CRC64NVME, the default checksum of new objects in S3.
+    crc = 0xffffffffffffffff
+    for byte in bytearray(body):
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0x9a6c9329ac4bc9b5 & -(crc & 1))
+    return crc ^ 0xffffffffffffffff
+
+
+def int_to_digest(value, size=4):
+    return bytes(bytearray([(value >> (8 * i)) & 0xff for i in reversed(range(size))]))
+
+
+def compute_checksum_digest(algorithm, body):
+    if algorithm == 'CRC32':
+        return int_to_digest(zlib.crc32(body) & 0xffffffff)
+    elif algorithm == 'CRC32C':
+        return int_to_digest(crc32c(body))
+    elif algorithm == 'CRC64NVME':
+        return int_to_digest(crc64nvme(body), size=8)
+    elif algorithm == 'SHA1':
+        return sha1(body).digest()
+    elif algorithm == 'SHA256':
+        return sha256(body).digest()
+    raise client_error('InvalidRequest', 'ComputeChecksum', 'Unsupported checksum algorithm: ' + algorithm)
+
+
+def compute_checksum(algorithm, body, part_sizes=None):
+    if part_sizes is None or algorithm == 'CRC64NVME':  # CRC64NVME checksums are of the full object, always.
+        return base64.b64encode(compute_checksum_digest(algorithm, body)).decode('ascii')
+
+    # Multipart objects have a checksum of their part checksums.
+    part_digests = b''
+    offset = 0
+    for part_size in part_sizes:
+        part_digests += compute_checksum_digest(algorithm, body[offset:offset + part_size])
+        offset += part_size
+    composite = base64.b64encode(compute_checksum_digest(algorithm, part_digests)).decode('ascii')
+    return composite + '-' + str(len(part_sizes))
+
+
+def parse_range(byte_range, size):
+    # Parses 'bytes=<first>-<last>' into a (first, last + 1) tuple.
+    first, last = byte_range.split('=', 1)[1].split('-', 1)
+    return int(first), min(int(last), size - 1) + 1
+
+
+def parse_tagging(tagging):
+    tag_set = []
+    for pair in [p for p in tagging.split('&') if p != '']:
+        k, _, v = pair.partition('=')
+        tag_set.append({'Key': unquote_plus(k), 'Value': unquote_plus(v)})
+    return tag_set
+
+
+# Classes
+
+class LocalS3Object(object):
+    def __init__(self, body, part_sizes=None, storage_class=None, metadata=None, tag_set=None, checksum_algorithm=None):
+        self.body = bytes(body)
+        self.part_sizes = part_sizes
+        self.storage_class = storage_class or 'STANDARD'
+        self.metadata = metadata or {}
+        self.tag_set = tag_set or []
+        self.last_modified = datetime.utcnow()
+        self.restore = None
+        self.checksums = {}
+        if checksum_algorithm is not None:
+            checksum = compute_checksum(checksum_algorithm, self.body, part_sizes)
+            self.checksums['Checksum' + checksum_algorithm] = checksum
+
+        if part_sizes is None:
+            self.etag = quote(md5(self.body).hexdigest())
+        else:
+            part_digests = b''
+            offset = 0
+            for part_size in part_sizes:
+                part_digests += md5(self.body[offset:offset + part_size]).digest()
+                offset += part_size
+            self.etag = quote(md5(part_digests).hexdigest() + '-' + str(len(part_sizes)))
+
+    def is_archived(self):
+        return self.storage_class in ARCHIVED_STORAGE_CLASSES and self.restore is None
+
+    def head(self, part_number=None):
+        response = {
+            'ETag': self.etag,
+            'ContentLength': len(self.body),
+            'LastModified': self.last_modified
+        }
+        response.update(self.metadata)
+        if self.storage_class != 'STANDARD':
+            response['StorageClass'] = self.storage_class
+        if self.restore is not None:
+            response['Restore'] = self.restore
+        if part_number is not None:
+            part_sizes = self.part_sizes or [len(self.body)]
+            response['ContentLength'] = part_sizes[part_number - 1]
+            response['PartsCount'] = len(part_sizes)
+        return response
+
+
+class LocalS3(object):
+    def __init__(self, latency=0.0):
+        self.latency = latency  # Seconds to wait per request, to simulate the network.
+        self.buckets = {}
+        self.bucket_regions = {}
+        self.multipart_uploads = {}
+        self.request_counts = {}
+        self.lock = Lock()
+
+    # Setup and inspection, these don't count as requests.
+
+    def add_bucket(self, bucket, region=DEFAULT_REGION):
+        self.buckets[bucket] = {}
+        self.bucket_regions[bucket] = region
+
+    def add_object(self, bucket, key, body, **kwargs):
+        self.buckets[bucket][key] = LocalS3Object(body, **kwargs)
+
+    def client(self, *_, **__):
+        return self
+
+    @contextmanager
+    def installed(self):
+        # Make boto3.client('s3') return this stand-in, other services are left alone.
+        original_client = boto3.client
+
+        def client(service_name, *args, **kwargs):
+            if service_name == 's3':
+                return self.client(*args, **kwargs)
+            return original_client(service_name, *args, **kwargs)
+
+        boto3.client = client
+        try:
+            yield self
+        finally:
+            boto3.client = original_client
+
+    # Internals
+
+    def _request(self, operation_name):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            self.request_counts[operation_name] = self.request_counts.get(operation_name, 0) + 1
+
+    def _bucket(self, bucket, operation_name):
+        if bucket not in self.buckets:
+            raise client_error('NoSuchBucket', operation_name, 'The specified bucket does not exist')
+        return self.buckets[bucket]
+
+    def _object(self, bucket, key, operation_name, if_match=None):
+        objects = self._bucket(bucket, operation_name)
+        if key not in objects:
+            if operation_name == 'HeadObject':
+                raise client_error(404, operation_name, 'Not Found')
+            raise client_error('NoSuchKey', operation_name, 'The specified key does not exist.')
+        o = objects[key]
+        if if_match is not None and if_match != o.etag:
+            raise client_error('PreconditionFailed', operation_name, 'At least one of the preconditions failed')
+        return o
+
+    # Buckets
+
+    def head_bucket(self, Bucket):
+        self._request('HeadBucket')
+        self._bucket(Bucket, 'HeadBucket')
+        return {}
+
+    def create_bucket(self, Bucket, CreateBucketConfiguration=None):
+        self._request('CreateBucket')
+        region = (CreateBucketConfiguration or {}).get('LocationConstraint', DEFAULT_REGION)
+        with self.lock:
+            self.add_bucket(Bucket, region)
+        return {}
+
+    def get_bucket_location(self, Bucket):
+        self._request('GetBucketLocation')
+        self._bucket(Bucket, 'GetBucketLocation')
+        region = self.bucket_regions[Bucket]
+        return {'LocationConstraint': None if region == 'us-east-1' else region}
+
+    # Listing
+
+    def _list(self, bucket, prefix, start_after, max_keys, operation_name):
+        objects = self._bucket(bucket, operation_name)
+        with self.lock:
+            keys = sorted(k for k in objects.keys() if k.startswith(prefix) and k > start_after)
+            entries = [(k, objects[k]) for k in keys[:max_keys]]
+        return entries, len(keys) > max_keys
+
+    def list_objects_v2(self, Bucket, MaxKeys=MAX_LIST_KEYS, Prefix='', StartAfter='', ContinuationToken=None, **_):
+        self._request('ListObjectsV2')
+        start_after = ContinuationToken or StartAfter or ''
+        entries, truncated = self._list(Bucket, Prefix, start_after, min(MaxKeys, MAX_LIST_KEYS), 'ListObjectsV2')
+
+        response = {
+            'KeyCount': len(entries),
+            'IsTruncated': truncated,
+            'Contents': [
+                {
+                    'Key': k,
+                    'ETag': o.etag,
+                    'Size': len(o.body),
+                    'LastModified': o.last_modified,
+                    'StorageClass': o.storage_class
+                } for k, o in entries
+            ]
+        }
+        if truncated:
+            response['NextContinuationToken'] = entries[-1][0]
+        return response
+
+    def list_object_versions(self, Bucket, MaxKeys=MAX_LIST_KEYS, Prefix='', KeyMarker='', **_):
+        # Local buckets are unversioned, so every object has exactly one version called 'null'.
+        self._request('ListObjectVersions')
+        entries, truncated = self._list(
+            Bucket, Prefix, KeyMarker or '', min(MaxKeys, MAX_LIST_KEYS), 'ListObjectVersions'
+        )
+
+        response = {
+            'IsTruncated': truncated,
+            'Versions': [
+                {
+                    'Key': k,
+                    'VersionId': 'null',
+                    'IsLatest': True,
+                    'ETag': o.etag,
+                    'Size': len(o.body),
+                    'LastModified': o.last_modified,
+                    'StorageClass': o.storage_class
+                } for k, o in entries
+            ],
+            'DeleteMarkers': []
+        }
+        if truncated:
+            response['NextKeyMarker'] = entries[-1][0]
+            response['NextVersionIdMarker'] = 'null'
+        return response
+
+    # Objects
+
+    def head_object(self, Bucket, Key, PartNumber=None, IfMatch=None, **_):
+        self._request('HeadObject')
+        return self._object(Bucket, Key, 'HeadObject', if_match=IfMatch).head(PartNumber)
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **_):
+        self._request('GetObject')
+        o = self._object(Bucket, Key, 'GetObject', if_match=IfMatch)
+        if o.is_archived():
+            raise client_error('InvalidObjectState', 'GetObject', 'The object is archived')
+        response = o.head()
+        body = o.body
+        if Range is not None:
+            first, end = parse_range(Range, len(body))
+            body = body[first:end]
+            response['ContentRange'] = 'bytes ' + str(first) + '-' + str(end - 1) + '/' + str(len(o.body))
+        response['ContentLength'] = len(body)
+        response['Body'] = BytesIO(body)
+        return response
+
+    def put_object(self, Bucket, Key, Body=b'', StorageClass=None, Tagging='', ChecksumAlgorithm=None, **kwargs):
+        self._request('PutObject')
+        objects = self._bucket(Bucket, 'PutObject')
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        Body = bytes(Body)  # Callers may reuse their buffer.
+        metadata = dict((k, v) for k, v in kwargs.items() if k in METADATA_KEYS)
+        o = LocalS3Object(
+            Body, storage_class=StorageClass, metadata=metadata, tag_set=parse_tagging(Tagging),
+            checksum_algorithm=ChecksumAlgorithm
+        )
+        with self.lock:
+            objects[Key] = o
+        return {'ETag': o.etag}
+
+    def copy_object(
+        self, CopySource, Bucket, Key, MetadataDirective='COPY', TaggingDirective='COPY', StorageClass=None,
+        CopySourceIfMatch=None, ChecksumAlgorithm=None, Tagging='', IfMatch=None, IfNoneMatch=None, **kwargs
+    ):
+        self._request('CopyObject')
+        source = self._object(CopySource['Bucket'], CopySource['Key'], 'CopyObject', if_match=CopySourceIfMatch)
+        if source.is_archived():
+            raise client_error('InvalidObjectState', 'CopyObject', 'The source object is archived')
+        if MetadataDirective == 'COPY':
+            metadata = dict(source.metadata)
+        else:
+            metadata = dict((k, v) for k, v in kwargs.items() if k in METADATA_KEYS)
+        if TaggingDirective == 'COPY':
+            tag_set = list(source.tag_set)
+        else:
+            tag_set = parse_tagging(Tagging)
+        if ChecksumAlgorithm is None and len(source.checksums) > 0:
+            ChecksumAlgorithm = list(source.checksums.keys())[0][len('Checksum'):]
+
+        o = LocalS3Object(
+            source.body, storage_class=StorageClass, metadata=metadata, tag_set=tag_set,
+            checksum_algorithm=ChecksumAlgorithm
+        )
+        objects = self._bucket(Bucket, 'CopyObject')
+        with self.lock:
+            # Conditional writes, see https://docs.aws.amazon.com/AmazonS3/latest/userguide/conditional-requests.html
+            if (
+                (IfNoneMatch == '*' and Key in objects) or
+                (IfMatch is not None and (Key not in objects or objects[Key].etag != IfMatch))
+            ):
+                raise client_error('PreconditionFailed', 'CopyObject', 'At least one of the preconditions failed')
+            objects[Key] = o
+        result = {'ETag': o.etag, 'LastModified': o.last_modified}
+        result.update(o.checksums)
+        return {'CopyObjectResult': result}
+
+    def delete_object(self, Bucket, Key, **_):
+        self._request('DeleteObject')
+        objects = self._bucket(Bucket, 'DeleteObject')
+        with self.lock:
+            objects.pop(Key, None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        self._request('DeleteObjects')
+        objects = self._bucket(Bucket, 'DeleteObjects')
+        with self.lock:
+            for o in Delete['Objects']:
+                objects.pop(o['Key'], None)
+        response = {}
+        if not Delete.get('Quiet', False):
+            response['Deleted'] = [{'Key': o['Key']} for o in Delete['Objects']]
+        return response
+
+    def get_object_tagging(self, Bucket, Key, **_):
+        self._request('GetObjectTagging')
+        return {'TagSet': list(self._object(Bucket, Key, 'GetObjectTagging').tag_set)}
+
+    def get_object_attributes(self, Bucket, Key, ObjectAttributes=None, **_):
+        self._request('GetObjectAttributes')
+        o = self._object(Bucket, Key, 'GetObjectAttributes')
+        return {
+            'ETag': o.etag.strip('"'),
+            'ObjectSize': len(o.body),
+            'StorageClass': o.storage_class,
+            'Checksum': dict(o.checksums)
+        }
+
+    def restore_object(self, Bucket, Key, RestoreRequest=None, **_):
+        # Restores complete instantly, which is convenient for testing follow-up copies.
+        self._request('RestoreObject')
+        o = self._object(Bucket, Key, 'RestoreObject')
+        if o.storage_class not in ARCHIVED_STORAGE_CLASSES:
+            raise client_error('InvalidObjectState', 'RestoreObject', 'The object is not archived')
+        o.restore = 'ongoing-request="false", expiry-date="Fri, 01 Jan 2100 00:00:00 GMT"'
+        return {}
+
+    # Multipart uploads
+
+    def create_multipart_upload(self, Bucket, Key, StorageClass=None, Tagging='', ChecksumAlgorithm=None, **kwargs):
+        self._request('CreateMultipartUpload')
+        self._bucket(Bucket, 'CreateMultipartUpload')
+        with self.lock:
+            upload_id = str(len(self.multipart_uploads) + 1)
+            self.multipart_uploads[upload_id] = {
+                'Bucket': Bucket,
+                'Key': Key,
+                'StorageClass': StorageClass,
+                'Metadata': dict((k, v) for k, v in kwargs.items() if k in METADATA_KEYS),
+                'TagSet': parse_tagging(Tagging),
+                'ChecksumAlgorithm': ChecksumAlgorithm,
+                'Parts': {}
+            }
+        return {'UploadId': upload_id}
+
+    def _upload(self, upload_id, operation_name):
+        if upload_id not in self.multipart_uploads:
+            raise client_error('NoSuchUpload', operation_name, 'The specified upload does not exist.')
+        return self.multipart_uploads[upload_id]
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **_):
+        self._request('UploadPart')
+        upload = self._upload(UploadId, 'UploadPart')
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        etag = quote(md5(Body).hexdigest())
+        with self.lock:
+            upload['Parts'][PartNumber] = (bytes(Body), etag)
+        return {'ETag': etag}
+
+    def upload_part_copy(
+        self, CopySource, Bucket, Key, UploadId, PartNumber, CopySourceRange=None, CopySourceIfMatch=None, **_
+    ):
+        self._request('UploadPartCopy')
+        upload = self._upload(UploadId, 'UploadPartCopy')
+        source = self._object(CopySource['Bucket'], CopySource['Key'], 'UploadPartCopy', if_match=CopySourceIfMatch)
+        body = source.body
+        if CopySourceRange is not None:
+            first, end = parse_range(CopySourceRange, len(body))
+            body = body[first:end]
+        etag = quote(md5(body).hexdigest())
+        with self.lock:
+            upload['Parts'][PartNumber] = (body, etag)
+        result = {'ETag': etag, 'LastModified': datetime.utcnow()}
+        if upload['ChecksumAlgorithm'] is not None:
+            result['Checksum' + upload['ChecksumAlgorithm']] = compute_checksum(upload['ChecksumAlgorithm'], body)
+        return {'CopyPartResult': result}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._request('CompleteMultipartUpload')
+        upload = self._upload(UploadId, 'CompleteMultipartUpload')
+        parts = [upload['Parts'][p['PartNumber']] for p in MultipartUpload['Parts']]
+        o = LocalS3Object(
+            b''.join(body for body, _ in parts),
+            part_sizes=[len(body) for body, _ in parts],
+            storage_class=upload['StorageClass'],
+            metadata=upload['Metadata'],
+            tag_set=upload['TagSet'],
+            checksum_algorithm=upload['ChecksumAlgorithm']
+        )
+        objects = self._bucket(Bucket, 'CompleteMultipartUpload')
+        with self.lock:
+            objects[Key] = o
+            del self.multipart_uploads[UploadId]
+        return {'ETag': o.etag, 'Bucket': Bucket, 'Key': Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._request('AbortMultipartUpload')
+        with self.lock:
+            self.multipart_uploads.pop(UploadId, None)
+        return {}
+
+
+# Functions
+
+def populate_bucket(s3, bucket, count, size=1024, prefix='', start=0):
+    # Fill a bucket with count synthetic objects of the given size, named like: '<prefix>00000042'.
+    for i in range(start, start + count):
+        key = prefix + '%08d' % i
+        s3.add_object(bucket, key, (key * (size // len(key) + 1))[:size].encode('utf-8'))
@@ -0,0 +1,177 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# An in-memory stand-in for the Amazon S3 Control client, implementing the subset of the boto3 S3 Control client API
+# used by batch_copy: Batch Operations jobs with the S3PutObjectCopy operation, a CSV manifest of bucket and key, and a
+# CSV completion report of the failed tasks, all in a LocalS3. Jobs run when they are first described after they were
+# created, so a job is 'New' right after create_job and 'Complete' the next time batch_copy looks at it. Keys in
+# fail_keys fail, for trying out the retries. Use LocalS3Control.installed() to make boto3.client('s3control') return
+# it.
+#
+
+# Imports
+
+import boto3
+import csv
+import json
+import time
+from botocore.exceptions import ClientError
+from contextlib import contextmanager
+from io import BytesIO
+from threading import Lock
+from urllib import quote, unquote
+
+
+# Constants
+
+MANIFEST_FORMAT = 'S3BatchOperations_CSV_20180820'
+REPORT_FORMAT = 'Report_CSV_20180820'
+
+
+# Utility functions
+
+def client_error(code, operation_name, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation_name)
+
+
+def parse_bucket_arn(arn):
+    # 'arn:aws:s3:::bucket' or 'arn:aws:s3:::bucket/key' -> ('bucket', 'key')
+    bucket, _, key = arn.split(':::', 1)[1].partition('/')
+    return bucket, key
+
+
+# Classes
+
+class LocalS3Control(object):
+    def __init__(self, s3, fail_keys=None):
+        self.s3 = s3  # The LocalS3 with the buckets.
+        self.fail_keys = set(fail_keys or [])
+        self.jobs = {}
+        self.request_tokens = {}
+        self.request_counts = {}
+        self.lock = Lock()
+
+    def client(self, *_, **__):
+        return self
+
+    @contextmanager
+    def installed(self):
+        # Make boto3.client('s3control') return this stand-in, other services are left alone.
+        original_client = boto3.client
+
+        def client(service_name, *args, **kwargs):
+            if service_name == 's3control':
+                return self.client(*args, **kwargs)
+            return original_client(service_name, *args, **kwargs)
+
+        boto3.client = client
+        try:
+            yield self
+        finally:
+            boto3.client = original_client
+
+    # Internals
+
+    def _request(self, operation_name):
+        with self.lock:
+            self.request_counts[operation_name] = self.request_counts.get(operation_name, 0) + 1
+
+    def _run(self, job):
+        # Copies the keys of the manifest and writes the completion report.
+        bucket, key = parse_bucket_arn(job['Manifest']['Location']['ObjectArn'])
+        manifest = self.s3.buckets[bucket][key]
+        if manifest.etag != job['Manifest']['Location']['ETag']:
+            job['Status'] = 'Failed'
+            job['FailureReasons'] = [{'FailureCode': 'ManifestETagMismatch', 'FailureReason': 'Manifest changed'}]
+            return
+
+        operation = job['Operation']['S3PutObjectCopy']
+        destination, _ = parse_bucket_arn(operation['TargetResource'])
+        args = dict(
+            (k, operation[k]) for k in ['MetadataDirective', 'StorageClass', 'ChecksumAlgorithm'] if k in operation
+        )
+        failed_rows = []
+        succeeded = 0
+        for row in csv.reader(BytesIO(manifest.body)):
+            source_bucket, source_key = row[0], unquote(row[1]).decode('utf-8')
+            try:
+                if source_key in self.fail_keys:
+                    raise client_error('SlowDown', 'CopyObject', 'Please reduce your request rate.')
+                self.s3.copy_object(
+                    CopySource={'Bucket': source_bucket, 'Key': source_key}, Bucket=destination, Key=source_key, **args
+                )
+                succeeded += 1
+            except ClientError as e:
+                error = e.response['Error']
+                failed_rows.append([source_bucket, row[1], '', 'failed', error['Code'], '500', error['Message']])
+
+        job['ProgressSummary'] = {
+            'TotalNumberOfTasks': succeeded + len(failed_rows),
+            'NumberOfTasksSucceeded': succeeded,
+            'NumberOfTasksFailed': len(failed_rows)
+        }
+        job['Status'] = 'Complete'
+
+        report = job['Report']
+        report_bucket, _ = parse_bucket_arn(report['Bucket'])
+        prefix = report.get('Prefix', '').rstrip('/') + '/job-' + job['JobId'] + '/'
+        results = []
+        if len(failed_rows) > 0:
+            body = BytesIO()
+            csv.writer(body).writerows(failed_rows)
+            result_key = prefix + 'results/' + quote(job['JobId']) + '.csv'
+            self.s3.put_object(Bucket=report_bucket, Key=result_key, Body=body.getvalue())
+            results.append({'TaskExecutionStatus': 'failed', 'Bucket': report_bucket, 'Key': result_key})
+        self.s3.put_object(Bucket=report_bucket, Key=prefix + 'manifest.json', Body=json.dumps({
+            'Format': REPORT_FORMAT,
+            'ReportCreationDate': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'Results': results,
+            'ReportSchema': 'Bucket, Key, VersionId, TaskStatus, ErrorCode, HTTPStatusCode, ResultMessage'
+        }))
+
+    # Client API
+
+    def create_job(
+        self, AccountId, Operation, Report, ClientRequestToken, Manifest, Priority, RoleArn,
+        ConfirmationRequired=True, **_
+    ):
+        self._request('CreateJob')
+        if 'S3PutObjectCopy' not in Operation:
+            raise client_error('InvalidRequest', 'CreateJob', 'Only S3PutObjectCopy jobs are supported locally.')
+        if Manifest['Spec']['Format'] != MANIFEST_FORMAT or Manifest['Spec']['Fields'] != ['Bucket', 'Key']:
+            raise client_error('InvalidRequest', 'CreateJob', 'Only CSV manifests of bucket and key are supported.')
+        with self.lock:
+            if ClientRequestToken in self.request_tokens:  # Requests are idempotent by token.
+                return {'JobId': self.request_tokens[ClientRequestToken]}
+            job_id = 'local-job-' + str(len(self.jobs) + 1)
+            self.jobs[job_id] = {
+                'JobId': job_id,
+                'AccountId': AccountId,
+                'Operation': Operation,
+                'Report': Report,
+                'Manifest': Manifest,
+                'Priority': Priority,
+                'RoleArn': RoleArn,
+                'Status': 'Suspended' if ConfirmationRequired else 'New',
+                'ProgressSummary': {'TotalNumberOfTasks': 0, 'NumberOfTasksSucceeded': 0, 'NumberOfTasksFailed': 0}
+            }
+            self.request_tokens[ClientRequestToken] = job_id
+        return {'JobId': job_id}
+
+    def describe_job(self, AccountId, JobId):
+        self._request('DescribeJob')
+        if JobId not in self.jobs:
+            raise client_error('NotFoundException', 'DescribeJob', 'Job not found: ' + JobId)
+        job = self.jobs[JobId]
+        if job['Status'] == 'New':
+            self._run(job)
+        return {'Job': json.loads(json.dumps(job))}
@@ -0,0 +1,560 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# A local interpreter for the subset of the Amazon States Language used by the state machines of this project: Task,
+# Parallel, Map, Choice, Pass, Wait, Succeed and Fail states, Retry and Catch, and InputPath, Parameters, ResultPath and
+# OutputPath, with the Execution and StateMachine fields of the context object. Task resources are the names of Lambda
+# functions in the lambda_functions directory, their handlers are run in-process. Functions that come from another file
+# or have another handler, like the variants of a function, are given by their 'module.function' handler in
+# lambda_handlers. Map states run their iterations in threads, up to MaxConcurrency at a time. Distributed Map states
+# are run the same way, their ItemReader reads JSON arrays through boto3, so they work with LocalS3. Executions started
+# with the states:startExecution integration are run after the current one, so chains of continuation executions run to
+# the end.
+#
+# Every execution records per-state wall time, payload sizes and transition counts, so changes to a state machine
+# can be benchmarked before deploying them.
+#
+
+# Imports
+
+import copy
+import imp
+import json
+import logging
+import os
+import sys
+import time
+import _strptime  # Imported lazily by time.strptime() otherwise, which fails when Map iterations do it in parallel.
+import yaml
+import boto3
+from datetime import datetime
+from threading import Thread, Lock
+from uuid import uuid4
+from Queue import Queue, Empty
+
+
+# Constants
+
+LAMBDA_FUNCTION_DIRECTORY = 'lambda_functions'
+DEFAULT_REGION = 'us-east-1'
+DEFAULT_ACCOUNT_ID = '000000000000'
+MAX_PAYLOAD_SIZE = 32768  # Characters, the Step Functions limit this project was designed for.
+DEFAULT_TASK_TIMEOUT = 60  # seconds, like in Step Functions.
+DEFAULT_RETRY_INTERVAL = 1  # seconds
+DEFAULT_RETRY_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_BACKOFF_RATE = 2.0
+STATE_MACHINE_NAME = 'LocalStateMachine'
+START_EXECUTION_RESOURCE = 'arn:aws:states:::states:startExecution'
+
+
+# Globals
+
+logger = logging.getLogger(__name__)
+
+lambda_modules = {}
+lambda_modules_lock = Lock()
+
+
+# Utility functions
+
+def roundtrip(data):
+    # State data is JSON between states, this catches anything that Step Functions couldn't serialize either.
+    return json.loads(json.dumps(data))
+
+
+def parse_path(path):
+    # Turns '$.a.b[2]' into ['a', 'b', 2].
+    assert(path == '$' or path.startswith('$.') or path.startswith('$['))
+    components = []
+    for part in path[1:].replace('[', '.[').split('.'):
+        if part == '':
+            continue
+        if part.startswith('['):
+            components.append(int(part.strip('[]')))
+        else:
+            components.append(part)
+    return components
+
+
+def get_path(data, path):
+    if path is None:
+        return {}
+    for component in parse_path(path):
+        try:
+            data = data[component]
+        except (KeyError, IndexError, TypeError):
+            raise StateMachineError('States.Runtime', 'Invalid path: ' + path)
+    return data
+
+
+def has_path(data, path):
+    try:
+        get_path(data, path)
+        return True
+    except StateMachineError:
+        return False
+
+
+def set_path(data, path, value):
+    # Implements ResultPath semantics: Returns a copy of data with value placed at path.
+    if path is None:
+        return data
+    components = parse_path(path)
+    if len(components) == 0:
+        return value
+
+    result = copy.deepcopy(data)
+    node = result
+    for component in components[:-1]:
+        if isinstance(node, dict):
+            node = node.setdefault(component, {})
+        else:
+            node = node[component]
+    node[components[-1]] = value
+    return result
+
+
+def apply_payload_template(template, data, context):
+    # Implements Parameters and ItemSelector: Values of keys ending in '.$' are paths into data, or into the context
+    # object if they start with '$$'.
+    if isinstance(template, dict):
+        result = {}
+        for key, value in template.items():
+            if key.endswith('.$'):
+                if value.startswith('$$'):
+                    result[key[:-2]] = get_path(context, value[1:])
+                else:
+                    result[key[:-2]] = get_path(data, value)
+            else:
+                result[key] = apply_payload_template(value, data, context)
+        return result
+    elif isinstance(template, list):
+        return [apply_payload_template(i, data, context) for i in template]
+    return template
+
+
+def payload_size(data):
+    return len(json.dumps(data))
+
+
+def error_name(e):
+    if isinstance(e, StateMachineError):
+        return e.error
+    return e.__class__.__name__  # That's how AWS Lambda reports errors raised by Python functions.
+
+
+def errors_match(error_equals, error, is_task=True):
+    for e in error_equals:
+        if e == error or e == 'States.ALL' or (e == 'States.TaskFailed' and is_task and error != 'States.Timeout'):
+            return True
+    return False
+
+
+def evaluate_choice_rule(rule, data):
+    if 'And' in rule:
+        return all(evaluate_choice_rule(r, data) for r in rule['And'])
+    if 'Or' in rule:
+        return any(evaluate_choice_rule(r, data) for r in rule['Or'])
+    if 'Not' in rule:
+        return not evaluate_choice_rule(rule['Not'], data)
+
+    variable = rule['Variable']
+    if 'IsPresent' in rule:
+        return has_path(data, variable) == rule['IsPresent']
+    value = get_path(data, variable)
+    for operator, expected in rule.items():
+        if operator in ['Variable', 'Next']:
+            continue
+        if operator == 'IsNull':
+            return (value is None) == expected
+        if operator.startswith('String') and not isinstance(value, (type(u''), type(''))):
+            return False
+        if operator.startswith('Numeric') and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            return False
+        if operator.startswith('Boolean') and not isinstance(value, bool):
+            return False
+        for suffix, compare in [
+            ('GreaterThanEquals', lambda a, b: a >= b),
+            ('LessThanEquals', lambda a, b: a <= b),
+            ('GreaterThan', lambda a, b: a > b),
+            ('LessThan', lambda a, b: a < b),
+            ('Equals', lambda a, b: a == b)
+        ]:
+            if operator.endswith(suffix):
+                return compare(value, expected)
+        raise StateMachineError('States.Runtime', 'Unsupported choice operator: ' + operator)
+    raise StateMachineError('States.Runtime', 'Empty choice rule.')
+
+
+def load_lambda_module(lambda_function_name, lambda_function_directory=LAMBDA_FUNCTION_DIRECTORY):
+    with lambda_modules_lock:
+        if lambda_function_name not in lambda_modules:
+            if lambda_function_directory not in sys.path:  # Lambda functions import shared modules from there.
+                sys.path.insert(0, lambda_function_directory)
+            path = os.path.join(lambda_function_directory, lambda_function_name + '.py')
+            level = logging.getLogger().level  # Lambda functions set the root log level on import, keep ours.
+            lambda_modules[lambda_function_name] = imp.load_source(lambda_function_name, path)
+            logging.getLogger().setLevel(level)
+        return lambda_modules[lambda_function_name]
+
+
+# Classes
+
+class StateMachineError(Exception):
+    def __init__(self, error, cause=''):
+        super(StateMachineError, self).__init__(error + ': ' + cause)
+        self.error = error
+        self.cause = cause
+
+
+class LocalLambdaContext(object):
+    def __init__(self, function_name, region=DEFAULT_REGION, timeout=DEFAULT_TASK_TIMEOUT):
+        self.function_name = function_name
+        self.invoked_function_arn = (
+            'arn:aws:lambda:' + region + ':' + DEFAULT_ACCOUNT_ID + ':function:' + function_name
+        )
+        self.aws_request_id = str(uuid4())  # Unique per invocation, like in Lambda.
+        self.deadline = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.time()) * 1000))
+
+
+class ExecutionStats(object):
+    def __init__(self):
+        self.states = {}
+        self.transitions = {}
+        self.lock = Lock()
+        self.start_time = time.time()
+        self.end_time = None
+        self.executions = 0
+
+    def record_state(self, name, state_type, seconds, input_size, output_size):
+        with self.lock:
+            s = self.states.setdefault(name, {
+                'type': state_type,
+                'count': 0,
+                'seconds': 0.0,
+                'maxInputSize': 0,
+                'maxOutputSize': 0,
+                'totalOutputSize': 0
+            })
+            s['count'] += 1
+            s['seconds'] += seconds
+            s['maxInputSize'] = max(s['maxInputSize'], input_size)
+            s['maxOutputSize'] = max(s['maxOutputSize'], output_size)
+            s['totalOutputSize'] += output_size
+
+    def record_transition(self, from_state, to_state):
+        with self.lock:
+            key = from_state + ' -> ' + to_state
+            self.transitions[key] = self.transitions.get(key, 0) + 1
+
+    def as_dict(self):
+        return {
+            'seconds': (self.end_time or time.time()) - self.start_time,
+            'executions': self.executions,
+            'states': self.states,
+            'transitions': self.transitions
+        }
+
+    def format_report(self):
+        lines = ['Execution time: {0:.3f}s'.format((self.end_time or time.time()) - self.start_time)]
+        if self.executions > 1:
+            lines.append('Executions: ' + str(self.executions))
+        lines.append('')
+        lines.append('{0:<36} {1:<9} {2:>7} {3:>10} {4:>10} {5:>11} {6:>11}'.format(
+            'State', 'Type', 'Count', 'Total (s)', 'Avg (s)', 'Max in', 'Max out'
+        ))
+        for name, s in sorted(self.states.items(), key=lambda i: -i[1]['seconds']):
+            lines.append('{0:<36} {1:<9} {2:>7} {3:>10.3f} {4:>10.4f} {5:>11} {6:>11}'.format(
+                name, s['type'], s['count'], s['seconds'], s['seconds'] / s['count'], s['maxInputSize'],
+                s['maxOutputSize']
+            ))
+        lines.append('')
+        lines.append('Transitions: ' + str(sum(self.transitions.values())))
+        for transition, count in sorted(self.transitions.items()):
+            lines.append('    {0}: {1}'.format(transition, count))
+        return '\n'.join(lines)
+
+
+class LocalStateMachine(object):
+    def __init__(
+        self, definition, lambda_function_directory=LAMBDA_FUNCTION_DIRECTORY, region=DEFAULT_REGION,
+        max_payload_size=MAX_PAYLOAD_SIZE, sleep=True, lambda_handlers=None
+    ):
+        self.definition = definition
+        self.lambda_function_directory = lambda_function_directory
+        self.lambda_handlers = lambda_handlers or {}  # By Lambda function name, default: '<name>.handler'.
+        self.region = region
+        self.max_payload_size = max_payload_size
+        self.sleep = sleep  # Set to False to skip Wait states and Retry intervals.
+        self.stats = ExecutionStats()
+        self.deadline = None
+        self.context = {}
+        self.started_executions = []
+        self.outputs = []
+
+    def run(self, execution_input):
+        # Runs an execution and the executions it starts, one after the other. Returns the output of the last one, the
+        # outputs of all of them are kept in self.outputs.
+        self.stats = ExecutionStats()
+        self.started_executions = [roundtrip(execution_input)]
+        self.outputs = []
+        try:
+            while len(self.started_executions) > 0:
+                output = self.run_execution(self.started_executions.pop(0))
+                self.outputs.append(output)
+        finally:
+            self.stats.end_time = time.time()
+        return output
+
+    def run_execution(self, execution_input):
+        self.stats.executions += 1
+        name = 'local-' + str(self.stats.executions)
+        state_machine_arn = (
+            'arn:aws:states:' + self.region + ':' + DEFAULT_ACCOUNT_ID + ':stateMachine:' + STATE_MACHINE_NAME
+        )
+        self.context = {
+            'Execution': {
+                'Id': state_machine_arn.replace(':stateMachine:', ':execution:') + ':' + name,
+                'Name': name,
+                'Input': execution_input,
+                'StartTime': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+            },
+            'StateMachine': {
+                'Id': state_machine_arn,
+                'Name': STATE_MACHINE_NAME
+            }
+        }
+        timeout = self.definition.get('TimeoutSeconds', None)
+        self.deadline = None if timeout is None else time.time() + timeout
+        return self.run_states(self.definition, execution_input)
+
+    def run_states(self, definition, data):
+        states = definition['States']
+        name = definition['StartAt']
+        while True:
+            if self.deadline is not None and time.time() > self.deadline:
+                raise StateMachineError('States.Timeout', 'Execution timed out before state: ' + name)
+
+            state = states[name]
+            start = time.time()
+            input_size = payload_size(data)
+            next_name, data = self.run_state(name, state, data)
+            output_size = payload_size(data)
+            self.stats.record_state(name, state['Type'], time.time() - start, input_size, output_size)
+            if output_size > self.max_payload_size:
+                raise StateMachineError(
+                    'States.DataLimitExceeded', 'Output of state: ' + name + ' has ' + str(output_size) + ' characters.'
+                )
+
+            if next_name is None:
+                return data
+            self.stats.record_transition(name, next_name)
+            name = next_name
+
+    def run_state(self, name, state, data):
+        # Returns a (name of the next state or None, output) tuple.
+        state_type = state['Type']
+        if state_type == 'Choice':
+            effective_input = get_path(data, state.get('InputPath', '$'))
+            for rule in state['Choices']:
+                if evaluate_choice_rule(rule, effective_input):
+                    return rule['Next'], self.apply_output_path(state, effective_input)
+            if 'Default' not in state:
+                raise StateMachineError('States.NoChoiceMatched', 'No choice matched in state: ' + name)
+            return state['Default'], self.apply_output_path(state, effective_input)
+        elif state_type == 'Succeed':
+            return None, self.apply_output_path(state, get_path(data, state.get('InputPath', '$')))
+        elif state_type == 'Fail':
+            raise StateMachineError(state.get('Error', 'States.Fail'), state.get('Cause', ''))
+        elif state_type == 'Wait':
+            if self.sleep:
+                time.sleep(state.get('Seconds', 0))
+            output = self.apply_output_path(state, get_path(data, state.get('InputPath', '$')))
+            return self.next_state(state), output
+
+        effective_input = get_path(data, state.get('InputPath', '$'))
+        if 'Parameters' in state and state_type != 'Map':  # Map states use them like an ItemSelector.
+            effective_input = apply_payload_template(state['Parameters'], effective_input, self.context)
+        try:
+            result = self.run_with_retries(name, state, effective_input)
+        except Exception as e:
+            for catcher in state.get('Catch', []):
+                if errors_match(catcher['ErrorEquals'], error_name(e), state_type == 'Task'):
+                    error_output = {'Error': error_name(e), 'Cause': str(e)}
+                    return catcher['Next'], set_path(data, catcher.get('ResultPath', '$'), error_output)
+            raise
+
+        output = set_path(data, state.get('ResultPath', '$'), result)
+        return self.next_state(state), self.apply_output_path(state, output)
+
+    def run_with_retries(self, name, state, effective_input):
+        attempts = {}
+        while True:
+            try:
+                return self.run_state_body(name, state, effective_input)
+            except Exception as e:
+                error = error_name(e)
+                for i, retrier in enumerate(state.get('Retry', [])):
+                    if errors_match(retrier['ErrorEquals'], error, state['Type'] == 'Task'):
+                        attempts[i] = attempts.get(i, 0) + 1
+                        if attempts[i] > retrier.get('MaxAttempts', DEFAULT_RETRY_MAX_ATTEMPTS):
+                            raise
+                        interval = retrier.get('IntervalSeconds', DEFAULT_RETRY_INTERVAL) * (
+                            retrier.get('BackoffRate', DEFAULT_RETRY_BACKOFF_RATE) ** (attempts[i] - 1)
+                        )
+                        logger.warning('Retrying state: ' + name + ' after error: ' + error)
+                        self.stats.record_transition(name, name + ' (retry)')
+                        if self.sleep:
+                            time.sleep(interval)
+                        break
+                else:
+                    raise
+
+    def run_state_body(self, name, state, effective_input):
+        state_type = state['Type']
+        if state_type == 'Pass':
+            return state['Result'] if 'Result' in state else effective_input
+        elif state_type == 'Task':
+            return self.run_task(name, state, effective_input)
+        elif state_type == 'Parallel':
+            return self.run_parallel(state, effective_input)
+        elif state_type == 'Map':
+            return self.run_map(state, effective_input)
+        raise StateMachineError('States.Runtime', 'Unsupported state type: ' + state_type)
+
+    def run_task(self, name, state, effective_input):
+        if state['Resource'] == START_EXECUTION_RESOURCE:
+            return self.start_execution(effective_input)
+
+        lambda_function_name = state['Resource'].split(':')[-1]
+        module_name, handler_name = self.lambda_handlers.get(
+            lambda_function_name, lambda_function_name + '.handler'
+        ).rsplit('.', 1)
+        handler = getattr(load_lambda_module(module_name, self.lambda_function_directory), handler_name)
+        timeout = state.get('TimeoutSeconds', DEFAULT_TASK_TIMEOUT)
+        context = LocalLambdaContext(lambda_function_name, region=self.region, timeout=timeout)
+
+        start = time.time()
+        result = roundtrip(handler(roundtrip(effective_input), context))
+        if time.time() - start > timeout:
+            raise StateMachineError('States.Timeout', 'Task state: ' + name + ' timed out.')
+        return result
+
+    def start_execution(self, parameters):
+        if parameters['StateMachineArn'] != self.context['StateMachine']['Id']:
+            raise StateMachineError('States.Runtime', 'Only executions of this state machine can be started locally.')
+        execution_input = parameters.get('Input', {})
+        if isinstance(execution_input, basestring):
+            execution_input = json.loads(execution_input)
+        self.started_executions.append(roundtrip(execution_input))
+
+        name = 'local-' + str(self.stats.executions + len(self.started_executions))
+        return {
+            'ExecutionArn': self.context['Execution']['Id'].rsplit(':', 1)[0] + ':' + name,
+            'StartDate': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        }
+
+    def run_parallel(self, state, effective_input):
+        results = [None] * len(state['Branches'])
+        errors = []
+
+        def run_branch(i, branch):
+            try:
+                results[i] = self.run_states(branch, copy.deepcopy(effective_input))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=run_branch, args=(i, b)) for i, b in enumerate(state['Branches'])]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+    def read_items(self, item_reader, effective_input):
+        resource = item_reader['Resource']
+        if not resource.endswith(':s3:getObject') or item_reader.get('ReaderConfig', {}).get('InputType') != 'JSON':
+            raise StateMachineError('States.Runtime', 'Unsupported ItemReader: ' + resource)
+        parameters = apply_payload_template(item_reader['Parameters'], effective_input, {})
+        s3 = boto3.client('s3', region_name=self.region)
+        response = s3.get_object(Bucket=parameters['Bucket'], Key=parameters['Key'])
+        return json.loads(response['Body'].read())
+
+    def run_map(self, state, effective_input):
+        if 'ItemReader' in state:
+            items = self.read_items(state['ItemReader'], effective_input)
+        else:
+            items = get_path(effective_input, state.get('ItemsPath', '$'))
+        if not isinstance(items, list):
+            raise StateMachineError('States.Runtime', 'Map state items are not a list.')
+
+        if 'MaxConcurrencyPath' in state:
+            max_concurrency = get_path(effective_input, state['MaxConcurrencyPath'])
+        else:
+            max_concurrency = state.get('MaxConcurrency', 0)  # 0 means no limit.
+        processor = state.get('ItemProcessor', state.get('Iterator'))
+        selector = state.get('ItemSelector', state.get('Parameters'))
+
+        results = [None] * len(items)
+        errors = []
+        indexes = Queue()
+        for i in range(len(items)):
+            indexes.put(i)
+
+        def run_items():
+            while len(errors) == 0:
+                try:
+                    i = indexes.get_nowait()
+                except Empty:
+                    return
+                item_input = items[i]
+                if selector is not None:
+                    context = dict(self.context, Map={'Item': {'Index': i, 'Value': items[i]}})
+                    item_input = apply_payload_template(selector, effective_input, context)
+                try:
+                    results[i] = self.run_states(processor, copy.deepcopy(item_input))
+                except Exception as e:
+                    errors.append(e)
+
+        thread_count = len(items) if max_concurrency == 0 else min(max_concurrency, len(items))
+        threads = [Thread(target=run_items) for _ in range(thread_count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+    @staticmethod
+    def next_state(state):
+        if state.get('End', False):
+            return None
+        return state['Next']
+
+    @staticmethod
+    def apply_output_path(state, data):
+        return get_path(data, state.get('OutputPath', '$'))
+
+
+# Functions
+
+def load_state_machine(path, **kwargs):
+    with open(path) as f:
+        return LocalStateMachine(yaml.safe_load(f), **kwargs)
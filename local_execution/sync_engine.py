@@ -0,0 +1,307 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# A standalone sync engine for large hosts, without the state machine: The source bucket is listed in shards of
+# SHARD_KEYS keys, which a pool of processes synchronizes in parallel. Each shard covers the key range from the end of
+# the previous shard to its last source key. The process lists the destination bucket in that range, then runs the
+# handlers of copy_keys (for the source keys) and delete_orphaned_keys (for destination keys missing from the source)
+# in-process, each with its own worker threads, request scheduler and rate budgets, like the Lambda functions do.
+#
+# Options are the execution input of the state machine (see README.md), for a single, unversioned destination bucket.
+# Key filters, rename detection and batch mode are left to the state machine.
+#
+# With a checkpoint file, the engine records the end of the shards completed so far, with their results added up, after
+# each shard. Shards complete out of order, so the checkpoint is the end of the last shard before the first one still
+# running. A sync started with the same checkpoint file continues from there.
+#
+# A status line on stderr shows the keys, copies and deletes per second while the sync runs. With a 'progressTable', the
+# handlers add their results to the progress record of the sync (see shared/progress.py), and the engine sets the
+# position of both listings to the checkpoint.
+#
+# Use processes=0 to run the shards in threads of this process instead, e.g. against LocalS3, whose buckets live in
+# the memory of this process.
+#
+
+# Imports
+
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from multiprocessing.dummy import Pool as ThreadPool
+from Queue import Queue, Empty
+from local_execution.state_machine import LAMBDA_FUNCTION_DIRECTORY, LocalLambdaContext, load_lambda_module
+
+
+# Constants
+
+SHARD_KEYS = 1000  # Source keys per shard, one list request.
+SHARDS_IN_FLIGHT = 2  # Per process, so the next shard is ready when one completes.
+SHARD_TIMEOUT = 3600  # seconds, for the Lambda context of the handlers.
+DISPLAY_INTERVAL = 1.0  # seconds between status line updates.
+DEFAULT_REGION = 'us-east-1'
+UNSUPPORTED_OPTIONS = ['versioned', 'keyFilter', 'renameDetection', 'jobs']
+
+
+# Globals
+
+logger = logging.getLogger(__name__)
+
+
+# Utility functions
+
+def import_shared_module(name):
+    # The shared modules are imported as the Lambda functions see them, from the Lambda function directory.
+    if LAMBDA_FUNCTION_DIRECTORY not in sys.path:
+        sys.path.insert(0, LAMBDA_FUNCTION_DIRECTORY)
+    return __import__('shared.' + name, fromlist=[name])
+
+
+def write_checkpoint(checkpoint_file, checkpoint):
+    # Replace the file in one step, so an interrupted sync never leaves half a checkpoint behind.
+    temporary_file = checkpoint_file + '.tmp'
+    with open(temporary_file, 'w') as f:
+        json.dump(checkpoint, f, indent=4, sort_keys=True)
+    os.rename(temporary_file, checkpoint_file)
+
+
+def read_checkpoint(checkpoint_file, options):
+    if checkpoint_file is None or not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+    for attribute in ['source', 'destination', 'prefix']:
+        if checkpoint.get(attribute, '') != options.get(attribute, ''):
+            raise ValueError(
+                'Checkpoint file: ' + checkpoint_file + ' is for another ' + attribute + ': ' +
+                checkpoint.get(attribute, '')
+            )
+    return checkpoint
+
+
+def list_source_shards(options, region, start_after):
+    # Yields (first key after, last key, source listing) tuples. The last key of the last shard is None, so it covers
+    # the rest of the destination bucket.
+    listing = import_shared_module('listing')
+    clients = import_shared_module('clients')
+    s3 = clients.create_s3_client(options, 'source', region)
+    args = {
+        'Bucket': options['source'],
+        'MaxKeys': SHARD_KEYS,
+        'Prefix': options.get('prefix', '')
+    }
+    list_filter = listing.create_list_filter(options)
+    token = start_after
+    while True:
+        page, _ = listing.list_next_page(s3, args, token, '', 'source', False, False, True, list_filter=list_filter)
+        if page['token'] == '':
+            yield start_after, None, page
+            return
+        token = page['token']
+        if len(page['keys']) > 0:
+            yield start_after, page['keys'][-1], page
+            start_after = page['keys'][-1]
+
+
+def list_destination_range(options, region, start_after, last_key):
+    # Returns the destination keys after start_after, up to and including last_key.
+    listing = import_shared_module('listing')
+    clients = import_shared_module('clients')
+    s3 = clients.create_s3_client(options, 'destination', region)
+    args = {
+        'Bucket': options['destination'],
+        'MaxKeys': listing.MAX_KEYS,
+        'Prefix': options.get('prefix', '')
+    }
+    list_filter = listing.create_list_filter(options)
+    keys = []
+    token = start_after
+    while True:
+        page, _ = listing.list_next_page(
+            s3, args, token, '', 'destination', False, False, True, list_filter=list_filter
+        )
+        keys.extend(k for k in page['keys'] if last_key is None or k <= last_key)
+        token = page['token']
+        if token == '' or (last_key is not None and token >= last_key):
+            return keys
+
+
+def sync_shard(options, region, start_after, last_key, source_page):
+    # Runs in the pool. Returns a (result, error) tuple, the error being a formatted traceback: Exceptions don't make it
+    # through the pool intact.
+    try:
+        source_keys = set(source_page['keys'])
+        destination_keys = list_destination_range(options, region, start_after, last_key)
+        orphans = [k for k in destination_keys if k not in source_keys]
+        results = import_shared_module('results')
+
+        copy_event = dict(options, listResult=source_page)
+        result = load_lambda_module('copy_keys').handler(
+            copy_event, LocalLambdaContext('copy_keys', region, SHARD_TIMEOUT)
+        )
+        if len(orphans) > 0:
+            delete_event = dict(options, listResult={'keys': orphans})
+            results.merge_results(result, load_lambda_module('delete_orphaned_keys').handler(
+                delete_event, LocalLambdaContext('delete_orphaned_keys', region, SHARD_TIMEOUT)
+            ))
+        # delete_orphaned_keys only sees the orphans, count the other destination keys looked at, too.
+        import_shared_module('progress').publish_progress(
+            options, region, {'destinationKeys': len(destination_keys) - len(orphans)}
+        )
+        result['keys'] = len(source_page['keys'])
+        result['orphans'] = len(orphans)
+        return result, None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+# Classes
+
+class ThroughputDisplay(object):
+    # A status line on stderr, rewritten in place.
+    def __init__(self, enabled=True, stream=sys.stderr):
+        self.enabled = enabled
+        self.stream = stream
+        self.start_time = time.time()
+        self.last_update = 0
+        self.width = 0
+
+    def update(self, totals, shards_running, force=False):
+        now = time.time()
+        if not self.enabled or (not force and now - self.last_update < DISPLAY_INTERVAL):
+            return
+        self.last_update = now
+        elapsed = max(now - self.start_time, 0.001)
+        line = '{0:.0f}s: '.format(elapsed) + ', '.join(
+            '{0} {1} ({2:.0f}/s)'.format(totals.get(name, 0), label, totals.get(name, 0) / elapsed)
+            for name, label in [('keys', 'keys'), ('copied', 'copied'), ('deleted', 'deleted')]
+        ) + ', ' + str(shards_running) + ' shards running'
+        if 'streamedBytes' in totals:
+            line += ', {0:.1f} MB/s streamed'.format(totals['streamedBytes'] / elapsed / 1000000)
+        self.stream.write('\r' + line.ljust(self.width))
+        self.stream.flush()
+        self.width = len(line)
+
+    def close(self):
+        if self.enabled:
+            self.stream.write('\n')
+            self.stream.flush()
+
+
+# Functions
+
+def sync_buckets(options, processes=None, checkpoint_file=None, display=True):
+    # Returns the results of all shards added up. processes defaults to the number of CPUs.
+    unsupported_options = [o for o in UNSUPPORTED_OPTIONS if options.get(o, False)]
+    if len(unsupported_options) > 0:
+        raise ValueError('The sync engine does not support: ' + ', '.join(unsupported_options))
+    if isinstance(options['destination'], list):
+        raise ValueError('The sync engine works with a single destination bucket only.')
+    results = import_shared_module('results')
+    clients = import_shared_module('clients')
+
+    options = dict(options)
+    for bucket_attribute in ['source', 'destination']:
+        if bucket_attribute + 'Region' not in options:
+            s3 = clients.create_s3_client(options, bucket_attribute, DEFAULT_REGION)
+            options[bucket_attribute + 'Region'] = clients.lookup_bucket_region(s3, options[bucket_attribute])
+    region = options['sourceRegion']
+
+    checkpoint = read_checkpoint(checkpoint_file, options) or {
+        'source': options['source'],
+        'destination': options['destination'],
+        'prefix': options.get('prefix', ''),
+        'position': options.get('startAfter', ''),
+        'done': False,
+        'result': {}
+    }
+    if checkpoint['done']:
+        logger.info('Checkpoint file: ' + checkpoint_file + ' is for a completed sync.')
+        return checkpoint['result']
+    totals = checkpoint['result']
+    if 'progressTable' in options:  # Resumed syncs keep their progress record.
+        checkpoint.setdefault('syncStartTime', options.get('syncStartTime', int(time.time())))
+        options['syncStartTime'] = checkpoint['syncStartTime']
+    progress = import_shared_module('progress')
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes) if processes > 0 else ThreadPool(max(1, multiprocessing.cpu_count()))
+    max_shards_in_flight = max(1, processes) * SHARDS_IN_FLIGHT
+    completed = Queue()
+    shard_ends = []  # Last key of each shard submitted, by shard number.
+    shard_results = {}  # Completed shards that aren't part of the checkpoint yet, by shard number.
+    next_checkpoint_shard = [0]  # In a list, so the nested functions can change it.
+    running_totals = {}  # Of this run, for the status line.
+    status_line = ThroughputDisplay(enabled=display)
+
+    def advance_checkpoint():
+        # Add the shards completed in order to the checkpoint.
+        changed = False
+        while next_checkpoint_shard[0] in shard_results:
+            shard_number = next_checkpoint_shard[0]
+            results.merge_results(totals, shard_results.pop(shard_number))
+            if shard_ends[shard_number] is None:
+                checkpoint['done'] = True
+            else:
+                checkpoint['position'] = shard_ends[shard_number]
+            next_checkpoint_shard[0] += 1
+            changed = True
+        if changed and checkpoint_file is not None:
+            write_checkpoint(checkpoint_file, checkpoint)
+        if changed:
+            progress.publish_progress(options, region, attributes=dict(
+                (bucket_attribute + attribute, value) for bucket_attribute in ['source', 'destination']
+                for attribute, value in [('Position', checkpoint['position']), ('Done', checkpoint['done'])]
+            ))
+
+    def collect(timeout):
+        # Waits for the next shard to complete. Returns the number of shards completed, 0 or 1.
+        try:
+            shard_number, (result, error) = completed.get(timeout=timeout)
+        except Empty:
+            return 0
+        if error is not None:
+            start_after = shard_ends[shard_number - 1] if shard_number > 0 else checkpoint['position']
+            raise RuntimeError('The shard after key: ' + repr(start_after) + ' failed:\n' + error)
+        results.merge_results(running_totals, result)
+        shard_results[shard_number] = result
+        advance_checkpoint()
+        return 1
+
+    try:
+        shards_running = 0
+        for start_after, last_key, page in list_source_shards(options, region, checkpoint['position']):
+            while shards_running >= max_shards_in_flight:
+                shards_running -= collect(DISPLAY_INTERVAL)
+                status_line.update(running_totals, shards_running)
+            shard_number = len(shard_ends)
+            shard_ends.append(last_key)
+            pool.apply_async(
+                sync_shard, (options, region, start_after, last_key, page),
+                callback=lambda r, shard_number=shard_number: completed.put((shard_number, r))
+            )
+            shards_running += 1
+
+        while shards_running > 0:
+            shards_running -= collect(DISPLAY_INTERVAL)
+            status_line.update(running_totals, shards_running)
+    finally:
+        status_line.update(running_totals, 0, force=True)
+        status_line.close()
+        pool.terminate()
+        pool.join()
+
+    return totals
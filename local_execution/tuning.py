@@ -0,0 +1,156 @@
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# Benchmarks for `fab tune`: Runs the handler of a worker function on a synthetic workload (see WORKLOADS) against a
+# LocalS3 with a latency model, for each combination of memory size and number of threads, and recommends the cheapest
+# setting that comes close to the best throughput.
+#
+# The latency model: Every S3 request waits 'latency' seconds for the network, which threads can do at the same time,
+# and takes REQUEST_CPU_SECONDS of CPU time (signing the request, parsing the response) at one vCPU, which they can't.
+# Lambda functions get one vCPU at VCPU_MEMORY_SIZE MB and a proportional share of it below, so small functions with
+# many threads wait for the CPU, and Python threads never use more than one vCPU.
+#
+# Costs are those of Lambda, per million keys: GB-seconds at the memory size, and one invocation per 'keys' keys. S3
+# request costs are the same for all settings, they're left out.
+#
+
+# Imports
+
+import math
+import time
+from threading import Lock
+from local_execution.s3 import LocalS3, populate_bucket
+from local_execution.state_machine import LocalLambdaContext, load_lambda_module
+
+
+# Constants
+
+VCPU_MEMORY_SIZE = 1769  # MB, Lambda functions get one full vCPU at this memory size.
+REQUEST_CPU_SECONDS = 0.002  # Per S3 request at one full vCPU.
+PRICE_PER_GB_SECOND = 0.0000166667  # USD, x86 in us-east-1.
+PRICE_PER_INVOCATION = 0.0000002  # USD.
+THROUGHPUT_SHARE = 0.9  # Recommend the cheapest setting with at least this share of the best throughput.
+PAGE_KEYS = 1000  # Keys per invocation at most in the state machine, they need to fit into the timeout.
+TIMEOUT_SHARE = 0.5  # Of the timeout a page of keys may take, leaves room for slower buckets.
+TRIAL_TIMEOUT = 900  # seconds, for the Lambda context of the handler.
+
+
+# Utility functions
+
+def create_copy_workload(s3, keys):
+    # Half of the source keys are missing from the destination.
+    s3.add_bucket('tune-source')
+    s3.add_bucket('tune-destination')
+    populate_bucket(s3, 'tune-source', keys, size=1024)
+    populate_bucket(s3, 'tune-destination', keys // 2, size=1024)
+    return {
+        'source': 'tune-source',
+        'destination': 'tune-destination',
+        'listResult': {'keys': sorted(s3.buckets['tune-source'])}
+    }
+
+
+def create_delete_workload(s3, keys):
+    # Half of the destination keys are orphans.
+    s3.add_bucket('tune-source')
+    s3.add_bucket('tune-destination')
+    populate_bucket(s3, 'tune-source', keys // 2, size=1024)
+    populate_bucket(s3, 'tune-destination', keys, size=1024)
+    return {
+        'source': 'tune-source',
+        'destination': 'tune-destination',
+        'listResult': {'keys': sorted(s3.buckets['tune-destination'])}
+    }
+
+
+WORKLOADS = {  # By Lambda function name, functions that can be tuned.
+    'copy_keys': create_copy_workload,
+    'delete_orphaned_keys': create_delete_workload
+}
+
+
+# Classes
+
+class LambdaCPU(object):
+    # The vCPU share of a Lambda function with the given memory size, one request at a time.
+    def __init__(self, memory_size):
+        self.share = min(1.0, float(memory_size) / VCPU_MEMORY_SIZE)
+        self.lock = Lock()
+
+    def run(self, cpu_seconds):
+        with self.lock:
+            time.sleep(cpu_seconds / self.share)
+
+
+class ModeledS3(LocalS3):
+    # A LocalS3 whose requests take CPU time on a LambdaCPU, too.
+    def __init__(self, latency, cpu):
+        super(ModeledS3, self).__init__(latency=latency)
+        self.cpu = cpu
+
+    def _request(self, operation_name):
+        self.cpu.run(REQUEST_CPU_SECONDS)
+        super(ModeledS3, self)._request(operation_name)
+
+
+# Functions
+
+def run_trial(function_name, memory_size, parallelism, keys, latency):
+    # Returns the throughput and cost of one invocation with the given settings.
+    s3 = ModeledS3(latency, LambdaCPU(memory_size))
+    event = WORKLOADS[function_name](s3, keys)
+    module = load_lambda_module(function_name)
+    default_parallelism = module.THREAD_PARALLELISM
+    module.THREAD_PARALLELISM = parallelism
+    try:
+        with s3.installed():
+            start = time.time()
+            module.handler(event, LocalLambdaContext(function_name, timeout=TRIAL_TIMEOUT))
+            seconds = time.time() - start
+    finally:
+        module.THREAD_PARALLELISM = default_parallelism
+
+    billed_seconds = math.ceil(seconds * 1000) / 1000  # Lambda bills by the millisecond.
+    invocation_cost = billed_seconds * memory_size / 1024.0 * PRICE_PER_GB_SECOND + PRICE_PER_INVOCATION
+    return {
+        'memorySize': memory_size,
+        'parallelism': parallelism,
+        'seconds': round(seconds, 3),
+        'requests': sum(s3.request_counts.values()),
+        'keysPerSecond': round(keys / seconds, 1),
+        'costPerMillionKeys': round(invocation_cost * 1000000 / keys, 4)
+    }
+
+
+def recommend(trials, timeout):
+    # The cheapest trial within THROUGHPUT_SHARE of the best throughput, among those that copy a page of keys within
+    # TIMEOUT_SHARE of the timeout. None if there is none.
+    trials = [t for t in trials if PAGE_KEYS / t['keysPerSecond'] <= timeout * TIMEOUT_SHARE]
+    if len(trials) == 0:
+        return None
+    best_throughput = max(t['keysPerSecond'] for t in trials)
+    candidates = [t for t in trials if t['keysPerSecond'] >= best_throughput * THROUGHPUT_SHARE]
+    return min(candidates, key=lambda t: (t['costPerMillionKeys'], -t['keysPerSecond']))
+
+
+def tune_function(function_name, memory_sizes, parallelisms, keys, latency, timeout, report=None):
+    # Returns the (trials, recommended trial) tuple. report is called with each trial as it completes.
+    if function_name not in WORKLOADS:
+        raise ValueError('No tuning workload for: ' + function_name + ', only for: ' + ', '.join(sorted(WORKLOADS)))
+    trials = []
+    for memory_size in memory_sizes:
+        for parallelism in parallelisms:
+            trial = run_trial(function_name, memory_size, parallelism, keys, latency)
+            trials.append(trial)
+            if report is not None:
+                report(trial)
+    return trials, recommend(trials, timeout)